@@ -0,0 +1,2 @@
+.INCLUDE "lib.inc"
+LD REG
@@ -0,0 +1,11 @@
+.INCLUDE "vasm.inc"
+    NP
+    MOVI r1 #0
+loop:
+    ADDI r1 r1 #1
+    MOV r2 r1
+    ADD r3 r2 r1
+    NP
+    NP
+    GOTO_IF NC loop
+    HALT
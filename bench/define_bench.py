@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Benchmark for define substitution in the preprocessor.
+
+Generates a program with many .DEFINEs and compares Defines.substitute with
+the previous approach of one re.sub per define and per line.
+
+Usage:
+    python bench/define_bench.py [--lines 10000] [--defines 1000]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'py'))
+import assembler
+
+
+def generate(lines:int, defines:int) -> list[str]:
+    source = [f".DEFINE REG_{n} r{n % 16}" for n in range(defines)]
+    for n in range(lines):
+        source.append(f"    LD REG_{(n * 7) % defines}  ; load")
+        if n % 3 == 0:
+            source.append(f"    AD REG_{(n * 13) % defines}")
+    return source[:defines + lines]
+
+
+def legacy_substitute(defines:assembler.Defines, line:str) -> str:
+    for def_key, def_value in defines.items():
+        line = re.sub(rf"\b{re.escape(def_key)}\b", def_value, line)
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Define substitution benchmark')
+    parser.add_argument('--lines', type=int, default=10000, help='Number of instruction lines (default: 10000)')
+    parser.add_argument('--defines', type=int, default=1000, help='Number of defines (default: 1000)')
+    parser.add_argument('--legacy-sample', type=int, default=500,
+                        help='Lines timed with the old substitution, extrapolated to the full program (default: 500)')
+    args = parser.parse_args()
+
+    source = generate(args.lines, args.defines)
+    defines = assembler.Defines()
+    for n in range(args.defines):
+        defines.add_def(f"REG_{n}", f"r{n % 16}")
+    body = [line.split(";")[0].strip() for line in source[args.defines:]]
+
+    sample = body[:args.legacy_sample]
+    t0 = time.perf_counter()
+    expected = [legacy_substitute(defines, line) for line in sample]
+    legacy = (time.perf_counter() - t0) * len(body) / len(sample)
+
+    t0 = time.perf_counter()
+    result = [defines.substitute(line) for line in body]
+    table = time.perf_counter() - t0
+
+    if result[:len(sample)] != expected:
+        raise SystemExit("[FAIL] substitution results differ")
+
+    t0 = time.perf_counter()
+    assembler.preprocess(source, False, 0, [], assembler.Defines(), assembler.Macros())
+    full = time.perf_counter() - t0
+
+    print(f"{len(body)} lines, {args.defines} defines")
+    print(f"  re.sub per define : {legacy * 1000:10.2f} ms ({len(body) / legacy:12.0f} lines/s, from {len(sample)} lines)")
+    print(f"  token table       : {table * 1000:10.2f} ms ({len(body) / table:12.0f} lines/s)")
+    print(f"  speedup           : {legacy / table:10.1f}x")
+    print(f"  full preprocess   : {full * 1000:10.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the instruction encoder (assembler.assemble).
+
+Compares the table driven encoder with the previous implementation, which
+ran re.findall for every operand, on the py/test_files programs and on a
+generated program, and checks that both produce the same machine code.
+
+Usage:
+    python bench/encoder_bench.py [--instructions 100000] [--repeat 5]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'py'))
+import assembler
+from assembler import INST_DICT_M, INST_TYPES, LinkState, insttype
+
+
+def legacy_assemble(code, ls:LinkState, arch:str) -> dict[int, tuple[int, int]]:
+    """The encoder before it became table driven, kept as the reference."""
+    JMP_FLAGS = {"C" : 0x02, "NC" : 0x03, "Z" : 0x04, "NZ" : 0x05, }
+    INST_DICT = INST_DICT_M.get(arch)
+    if INST_DICT is None:
+        raise KeyError(f"[Error] Unsupported architecture: {arch}")
+    machine_code: dict[int, tuple[int, int]] = {}
+    address = 0
+    for line, lineno in code:
+        if line.strip() == "":
+            continue
+        tok = line.strip().split(" ")
+        if tok[0].upper().endswith(":"):
+            label = tok[0].upper()[:-1]
+            tok.pop(0)
+            ls.add_label(label, len(machine_code))
+            if len(tok) == 0:
+                continue
+        opcode = INST_DICT.get(tok[0].upper())
+        if opcode is None:
+            raise KeyError(f"[Error] Invalid instruction: {tok[0]} in line {lineno}")
+        match INST_TYPES.get(tok[0].upper()):
+            case None:
+                raise KeyError(f"[Error] Oops! : {tok[0]} is found in INST_DICT but not in INST_TYPES")
+            case insttype.INHERENT:
+                machine_code[address] = ((opcode, lineno))
+                address += 1
+            case insttype.REGISTER:
+                oprand = int(re.findall(r"[rR]([0-9]*)", tok[1])[0])
+                if oprand > 15:
+                    raise ValueError(f"Too big register designator : {oprand} in line {lineno}")
+                machine_code[address] = ((opcode + oprand, lineno))
+                address += 1
+            case insttype.IMMEDIATE:
+                label = re.findall(r"#([A-Za-z_][A-Za-z0-9_]*:[0-3])", tok[1])
+                if label:
+                    ls.add_unresolved(label[0], len(machine_code))
+                    machine_code[address] = ((opcode, lineno))
+                    address += 1
+                    continue
+                try:
+                    oprand = int(re.findall(r"#((0x|0b)?[0-9a-fA-F]+)", tok[1])[0][0], 0)
+                except ValueError:
+                    raise ValueError(f"Invalid immediate value : {tok[1]} in line {lineno}")
+                if oprand > 15:
+                    raise ValueError(f"Too big immediate value : {oprand} in line {lineno}")
+                machine_code[address] = ((opcode + oprand, lineno))
+                address += 1
+            case insttype.JUMP:
+                if len(tok) == 1:
+                    machine_code[address] = ((opcode, lineno))
+                    address += 1
+                else:
+                    flag = tok[1].upper()
+                    if flag not in JMP_FLAGS:
+                        raise ValueError(f"Invalid jump flag : {flag} in line {lineno}")
+                    machine_code[address] = ((opcode + JMP_FLAGS[flag], lineno))
+                    address += 1
+    for addr, label in ls.unresolved.items():
+        value = ls.parse_label(label)
+        if value is None:
+            raise KeyError(f"[Error] Undefined label: {label}")
+        machine_code[addr] = (machine_code[addr][0] + value, machine_code[addr][1])
+    return machine_code
+
+
+def generate(instructions:int) -> list[tuple[str, int]]:
+    templates = ["LD r{r}", "LI #{i}", "AD r{r}", "SA r{r}", "LI #0x{i:X}", "LI #L{l}:1", "LI #L{l}:0", "JP NC", "XR r{r}", "NP"]
+    code = []
+    for n in range(instructions):
+        if n % 50 == 0:
+            code.append((f"L{n // 50}:", n))
+        code.append((templates[n % len(templates)].format(r=n % 16, i=n % 16, l=n // 500 * 10), n))
+    return code
+
+
+def fixture(name:str, arch:str) -> list[tuple[str, int]]:
+    lines = (ROOT / 'py' / 'test_files' / name).read_text(encoding='utf-8').splitlines()
+    processed = assembler.preprocess(lines, False, 0, [str(ROOT / 'include')], assembler.Defines(), assembler.Macros())
+    return [(pl[0], pl[1]) for pl in processed]
+
+
+def measure(func, code, arch:str, repeat:int) -> tuple[float, dict]:
+    best = float('inf')
+    result: dict = {}
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func(code, LinkState(), arch)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Instruction encoder micro-benchmark')
+    parser.add_argument('--instructions', type=int, default=100000, help='Size of the generated program (default: 100000)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement, the best is reported (default: 5)')
+    args = parser.parse_args()
+
+    cases = [
+        ('alltest.asm', 'HC4', fixture('alltest.asm', 'HC4')),
+        ('countlcd.asm', 'HC4', fixture('countlcd.asm', 'HC4')),
+        ('dice4e.asm', 'HC4E', fixture('dice4e.asm', 'HC4E')),
+        ('inctest.asm', 'HC4E', fixture('inctest.asm', 'HC4E')),
+        (f'generated ({args.instructions})', 'HC4', generate(args.instructions)),
+    ]
+    print(f"{'program':<22} {'instr':>7} {'legacy ns/inst':>15} {'table ns/inst':>14} {'speedup':>8}")
+    for name, arch, code in cases:
+        legacy_time, legacy_result = measure(legacy_assemble, code, arch, args.repeat)
+        table_time, table_result = measure(assembler.assemble, code, arch, args.repeat)
+        if legacy_result != table_result:
+            raise SystemExit(f"[FAIL] encoders disagree on {name}")
+        count = max(1, len(table_result))
+        print(f"{name:<22} {count:>7} {legacy_time / count * 1e9:>15.0f} {table_time / count * 1e9:>14.0f} {legacy_time / table_time:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the Intel HEX / Verilog HEX writers and the Intel HEX reader (py/hexfile.py).
+
+Formats a random image of --size bytes with the writers and with the
+per-byte string building hcxasm.py used before, writes each to a file in one
+write, and reads the Intel HEX back. The old writer has no extended address
+records, so its output is only checked against the new one below 64 KiB.
+
+Usage:
+    python bench/hex_bench.py [--size 1048576] [--record-length 16] [--repeat 3]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'py'))
+import hexfile
+
+
+def legacy_format_intel_hex(machine_code:list[int]) -> str:
+    records = []
+    address = 0
+    for i in range(0, len(machine_code), 16):
+        chunk = machine_code[i:i+16]
+        data_len = len(chunk)
+        checksum = data_len + (address >> 8) + (address & 0xFF)
+        for byte_val in chunk:
+            checksum += byte_val
+        checksum = (~checksum + 1) & 0xFF
+        hex_line = f":{data_len:02X}{address:04X}00"
+        for byte_val in chunk:
+            hex_line += f"{byte_val:02X}"
+        hex_line += f"{checksum:02X}"
+        records.append(hex_line + '\n')
+        address += data_len
+    records.append(":00000001FF\n")
+    return "".join(records)
+
+
+def legacy_format_verilog_hex(machine_code:list[int]) -> str:
+    return "".join(f"{i:02X}\n" for i in machine_code)
+
+
+def best(func, repeat:int) -> tuple[float, object]:
+    times = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t0)
+    return min(times) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Intel HEX / Verilog HEX writer and reader benchmark')
+    parser.add_argument('--size', type=int, default=1 << 20, help='Image size in bytes (default: 1 MiB)')
+    parser.add_argument('--record-length', type=int, default=16, help='Data bytes per Intel HEX record (default: 16)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement, the best is reported (default: 3)')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    image = bytearray(rng.getrandbits(8) for _ in range(args.size))
+    as_list = list(image)
+    view = memoryview(image)
+
+    legacy_ihex_ms, legacy_ihex = best(lambda: legacy_format_intel_hex(as_list), args.repeat)
+    legacy_vhex_ms, legacy_vhex = best(lambda: legacy_format_verilog_hex(as_list), args.repeat)
+    ihex_ms, ihex = best(lambda: hexfile.format_intel_hex(view, record_length=args.record_length), args.repeat)
+    vhex_ms, vhex = best(lambda: hexfile.format_verilog_hex(view), args.repeat)
+    assert vhex == legacy_vhex
+    if args.record_length == 16:
+        low = min(args.size, 0x10000) // 16
+        assert ihex.splitlines()[:low] == legacy_ihex.splitlines()[:low]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'image.hex')
+        def write():
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write(hexfile.format_intel_hex(view, record_length=args.record_length))
+        write_ms, _ = best(write, args.repeat)
+        with open(filename, 'rb') as f:
+            data = f.read()
+    read_ms, (read_image, regions) = best(lambda: hexfile.read_intel_hex(data), args.repeat)
+    assert read_image == image and regions == [(0, args.size)]
+
+    print(f"{args.size} bytes, {len(ihex.splitlines())} Intel HEX records of up to {args.record_length} bytes, best of {args.repeat}")
+    print(f"Intel HEX format:   {legacy_ihex_ms:8.1f} ms before, {ihex_ms:8.1f} ms now ({legacy_ihex_ms / ihex_ms:.1f}x)")
+    print(f"Verilog HEX format: {legacy_vhex_ms:8.1f} ms before, {vhex_ms:8.1f} ms now ({legacy_vhex_ms / vhex_ms:.1f}x)")
+    print(f"Intel HEX format + one write: {write_ms:.1f} ms ({args.size / write_ms / 1000:.1f} MB/s)")
+    print(f"Intel HEX read:     {read_ms:8.1f} ms ({args.size / read_ms / 1000:.1f} MB/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Benchmark for incremental re-assembly (assembler.IncrementalAssembler).
+
+Generates a program of several thousand lines and measures single-line edits
+(same address layout, an inserted line, a deleted line) against assembling
+the whole buffer again, checking every incremental result against the full
+rebuild.
+
+Usage:
+    python bench/incremental_bench.py [--lines 5000] [--edits 200]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'py'))
+import assembler
+
+
+def generate(lines:int) -> list[str]:
+    source = [".DEF OUT r14", ".MACRO PUT X", "LD X", "SA OUT", ".ENDM"]
+    n = 0
+    while len(source) < lines:
+        source.append(f"L{n}:")
+        source.append(f"    LD r{n % 14}")
+        source.append(f"    AD r{(n + 1) % 14}   ; add")
+        source.append(f"    PUT r{n % 14}")
+        source.append(f"    LI #L{max(0, n - 3)}:0")
+        source.append(f"    LI #L{max(0, n - 3)}:1")
+        source.append("    JP NC")
+        n += 1
+    return source
+
+
+def edit(source:list[str], rng:random.Random, kind:str) -> list[str]:
+    at = rng.randrange(5, len(source))
+    if kind == 'replace':
+        # keeps the address layout: one instruction for another
+        return source[:at] + [f"    LD r{rng.randrange(14)}" if source[at].strip().startswith(("LD", "AD")) else source[at] + " "] + source[at + 1:]
+    if kind == 'insert':
+        return source[:at] + ["    NP"] + source[at:]
+    return source[:at] + source[at + 1:] if not source[at].strip().endswith(":") else source
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental re-assembly benchmark')
+    parser.add_argument('--lines', type=int, default=5000, help='Program size in source lines (default: 5000)')
+    parser.add_argument('--edits', type=int, default=200, help='Edits per kind (default: 200)')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    source = generate(args.lines)
+    t0 = time.perf_counter()
+    full = assembler.Assembler("HC4").run(source)
+    full_ms = (time.perf_counter() - t0) * 1000
+    print(f"{len(source)} lines, {len(full.machine_code)} instructions, full build {full_ms:.2f} ms")
+
+    for kind in ('replace', 'insert', 'delete'):
+        inc = assembler.IncrementalAssembler("HC4")
+        inc.update(source)
+        current = source
+        times = []
+        for _ in range(args.edits):
+            current = edit(current, rng, kind)
+            t0 = time.perf_counter()
+            result = inc.update(current)
+            times.append((time.perf_counter() - t0) * 1000)
+            expected = assembler.Assembler("HC4").run(current)
+            if (result.lines, result.machine_code, result.ls.labels) != (expected.lines, expected.machine_code, expected.ls.labels):
+                raise SystemExit(f"[FAIL] incremental result differs from a full build after a {kind} edit")
+        print(f"  {kind:<8}: median {statistics.median(times):7.3f} ms  p95 {sorted(times)[int(len(times) * 0.95)]:7.3f} ms"
+              f"  ({full_ms / statistics.median(times):6.1f}x, {inc.full_builds - 1} full rebuilds)")
+
+
+if __name__ == '__main__':
+    main()
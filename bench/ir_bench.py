@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Memory and wall time of the assembler pipeline on a large generated program.
+
+Generates a program of --lines source lines (labels, comments, .DEF, macro
+calls and instructions), then runs preprocess, assemble, the bitstream and
+the list file formatter, the way hcxasm.py does. For every stage it reports
+the wall time and the memory the stage's result holds on to, measured with
+tracemalloc, plus the peak over the whole pipeline.
+
+Usage:
+    python bench/ir_bench.py [--lines 100000] [--repeat 3]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'py'))
+import assembler
+import hcxasm
+
+
+def generate(lines:int) -> list[str]:
+    source = [".DEF OUT r14", ".MACRO PUT X", "LD X", "SA OUT", ".ENDM"]
+    n = 0
+    while len(source) < lines:
+        source.append(f"L{n}:")
+        source.append(f"    LD r{n % 14}")
+        source.append(f"    AD r{(n + 1) % 14}   ; add")
+        source.append("; comment line")
+        source.append(f"    PUT r{n % 14}")
+        source.append(f"    LI #L{max(0, n - 3)}:0")
+        source.append(f"    LI #L{max(0, n - 3)}:1")
+        source.append(f"    LI #L{max(0, n - 3)}:2")
+        source.append("    JP NC")
+        n += 1
+    return source[:lines]
+
+
+def run(source:list[str], measure:bool) -> dict[str, tuple[float, int]]:
+    """stage -> (ms, bytes retained by the stage's result)"""
+    stages: dict[str, tuple[float, int]] = {}
+    keep = []
+
+    def stage(name, func):
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0] if measure else 0
+        t0 = time.perf_counter()
+        result = func()
+        ms = (time.perf_counter() - t0) * 1000
+        keep.append(result)
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0] if measure else 0
+        stages[name] = (ms, after - before)
+        return result
+
+    session = assembler.Assembler("HC4")
+    processed = stage('preprocess', lambda: session.preprocess(source))
+    machine_code = stage('assemble', lambda: session.assemble(processed))
+    stage('bitstream', lambda: assembler.adrlist2bitstream(machine_code, 255))
+    stage('list', lambda: hcxasm.format_list(processed, machine_code, session.ls))
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Assembler pipeline memory and time benchmark')
+    parser.add_argument('--lines', type=int, default=100000, help='Program size in source lines (default: 100000)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs, the best is reported (default: 3)')
+    args = parser.parse_args()
+
+    source = generate(args.lines)
+    best: dict[str, float] = {}
+    for _ in range(args.repeat):
+        for name, (ms, _) in run(source, False).items():
+            best[name] = min(best.get(name, ms), ms)
+
+    tracemalloc.start()
+    retained = run(source, True)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f"{args.lines} source lines, best of {args.repeat} runs")
+    print(f"{'stage':<12}{'ms':>10}{'retained MiB':>15}")
+    for name, (_, size) in retained.items():
+        print(f"{name:<12}{best[name]:>10.1f}{size / (1 << 20):>15.2f}")
+    print(f"{'total':<12}{sum(best.values()):>10.1f}{sum(size for _, size in retained.values()) / (1 << 20):>15.2f}")
+    print(f"peak traced memory: {peak / (1 << 20):.2f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Round-trip latency of a register read through load4e.py.
+
+Compares starting `load4e.py register --json` for every read, as the editor
+did, with requests to one `load4e.py serve` process that keeps the port open.
+The board is py/fakedevice.py on a pty pair, so the port open / board reset
+time of real hardware is not included in the per-process numbers.
+
+Usage:
+    python bench/load4e_latency.py [--reads 20]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'py'))
+from fakedevice import FakeDevice
+
+
+def per_process(port:str, reads:int) -> list[float]:
+    times = []
+    for _ in range(reads):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, 'load4e.py', 'register', '--json', '--port', port],
+                       check=True, capture_output=True, cwd=ROOT)
+        times.append((time.perf_counter() - t0) * 1000)
+    return times
+
+
+def session(port:str, reads:int) -> list[float]:
+    proc = subprocess.Popen([sys.executable, 'load4e.py', 'serve', '--port', port], cwd=ROOT,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    times = []
+    try:
+        # wait until the process has started and opened the port
+        proc.stdin.write(json.dumps({'id': -1, 'op': 'ping'}) + '\n')
+        proc.stdin.flush()
+        proc.stdout.readline()
+        for n in range(reads):
+            t0 = time.perf_counter()
+            proc.stdin.write(json.dumps({'id': n, 'op': 'register'}) + '\n')
+            proc.stdin.flush()
+            response = json.loads(proc.stdout.readline())
+            times.append((time.perf_counter() - t0) * 1000)
+            if not response['ok']:
+                raise SystemExit(f"[FAIL] {response}")
+    finally:
+        proc.stdin.close()
+        proc.wait()
+    return times
+
+
+def report(name:str, times:list[float]):
+    times = sorted(times)
+    print(f"{name:<28} mean {statistics.mean(times):8.2f} ms  median {statistics.median(times):8.2f} ms  max {times[-1]:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load4e.py register read latency')
+    parser.add_argument('--reads', type=int, default=20, help='Register reads per mode (default: 20)')
+    args = parser.parse_args()
+
+    with FakeDevice() as device:
+        report('process per read', per_process(device.port, args.reads))
+        report('load4e.py serve', session(device.port, args.reads))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Benchmark for macro expansion in the preprocessor.
+
+Generates a program of GOTO / GOTO_IF / ADD calls on top of include/vasm.inc
+and compares compiled macro templates with preprocessing every macro body
+again on each call.
+
+Usage:
+    python bench/macro_bench.py [--calls 50000]
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import Optional
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.join(ROOT, 'py'))
+import assembler
+
+
+class UncompiledMacros(assembler.Macros):
+    """Macros without templates: every call runs preprocess() on the body."""
+    def get_template(self, name:str) -> Optional[assembler.MacroTemplate]:
+        return None
+
+
+def generate(calls:int) -> list[str]:
+    source = ['.INCLUDE "vasm.inc"']
+    for n in range(calls):
+        kind = n % 3
+        if kind == 0:
+            source.append(f"L{n}:")
+            source.append(f"    ADD r{n % 14} r{(n + 1) % 14} r{(n + 2) % 14}")
+        elif kind == 1:
+            source.append(f"    GOTO L{n - 1}")
+        else:
+            source.append(f"    GOTO_IF NC L{n - 2}")
+    return source
+
+
+def run(source:list[str], macros:assembler.Macros) -> tuple[float, list]:
+    include_pathes = [os.path.join(ROOT, 'include')]
+    t0 = time.perf_counter()
+    processed = assembler.preprocess(source, False, 0, include_pathes, assembler.Defines(), macros)
+    return time.perf_counter() - t0, processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Macro expansion benchmark')
+    parser.add_argument('--calls', type=int, default=50000, help='Number of macro invocations (default: 50000)')
+    args = parser.parse_args()
+
+    source = generate(args.calls)
+    template_time, compiled = run(source, assembler.Macros())
+    legacy_time, uncompiled = run(source, UncompiledMacros())
+    if compiled != uncompiled:
+        raise SystemExit("[FAIL] template expansion differs from preprocessing the body")
+
+    half_time, _ = run(source[:len(source) // 2], assembler.Macros())
+
+    print(f"{args.calls} macro invocations, {len(compiled)} preprocessed lines")
+    print(f"  preprocess per call : {legacy_time * 1000:10.2f} ms ({args.calls / legacy_time:10.0f} calls/s)")
+    print(f"  compiled templates  : {template_time * 1000:10.2f} ms ({args.calls / template_time:10.0f} calls/s)")
+    print(f"  speedup             : {legacy_time / template_time:10.1f}x")
+    print(f"  half the calls      : {half_time * 1000:10.2f} ms (linear scaling: {template_time / half_time:.2f}x for 2x calls)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Stage timing of the assembler pipeline on generated programs, and a compare
+command for two runs.
+
+Generates programs of every --kinds at every --sizes (source lines):
+    instruction  plain instructions and comments
+    define       .DEF / .DEFINE names used by the instructions
+    macro        .MACRO definitions and calls
+    include      .INCLUDE of many small files written to a temporary directory
+    label        a label on every few lines, referenced with LI #label:n
+and times preprocess, assemble, build_image, adrlist2bitstream and the
+Intel HEX, Verilog HEX and list writers separately (best of --repeat runs, the
+include cache cleared before each run). Throughput is reported in source
+lines and image bytes per second, peak memory of the whole pipeline is
+measured in an extra run under tracemalloc. --output saves the results as
+JSON; compare flags every stage that got slower than --threshold percent.
+
+Usage:
+    python bench/pipeline_bench.py run [--kinds instruction,macro] [--sizes 1000,10000,100000]
+                                       [--repeat 3] [--output results.json]
+    python bench/pipeline_bench.py compare before.json after.json [--threshold 10] [--min-ms 1]
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'py'))
+import assembler
+import hcxasm
+import hexfile
+
+STAGES = ('preprocess', 'assemble', 'image', 'bitstream', 'ihex', 'vhex', 'list')
+
+
+def instruction_heavy(lines:int, _:str) -> list[str]:
+    source = []
+    n = 0
+    while len(source) < lines:
+        source.append(f"    LD r{n % 14}")
+        source.append(f"    AD r{(n + 3) % 14}   ; add")
+        source.append(f"    SA r{(n + 5) % 14}")
+        source.append("; comment line")
+        source.append(f"    LI #{n % 16}")
+        source.append("    JP NC")
+        n += 1
+    return source[:lines]
+
+
+def define_heavy(lines:int, _:str) -> list[str]:
+    # at least REG_1 and VAL_0; the odd numbers below defines are registers, the even ones values
+    defines = max(2, lines // 4)
+    source = [f".DEF REG_{n} r{n % 14}" if n % 2 else f".DEFINE VAL_{n} #{n % 16}" for n in range(defines)]
+    n = 0
+    while len(source) < lines:
+        source.append(f"    LD REG_{(n * 7 % (defines // 2)) * 2 + 1}")
+        source.append(f"    LI VAL_{(n * 6) % defines & ~1}")
+        n += 1
+    return source[:lines]
+
+
+def macro_heavy(lines:int, _:str) -> list[str]:
+    macros = max(1, lines // 100)
+    source = []
+    for m in range(macros):
+        source += [f".MACRO PUT{m} X Y", "LD X", "AD Y", "SA X", ".ENDM"]
+    n = 0
+    while len(source) < lines:
+        source.append(f"    PUT{n % macros} r{n % 14} r{(n + 1) % 14}")
+        n += 1
+    return source[:lines]
+
+
+def include_heavy(lines:int, directory:str) -> list[str]:
+    """Writes lib<n>.inc files of 20 lines into directory; the count includes their lines."""
+    source = []
+    total = 0
+    n = 0
+    while total < lines:
+        filename = os.path.join(directory, f"lib{n}.inc")
+        body = [f".DEF LIB{n}_{k} r{k % 14}" for k in range(10)] + [f"    LD LIB{n}_{k}" for k in range(10)]
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write("\n".join(body) + "\n")
+        source.append(f'.INCLUDE "lib{n}.inc"')
+        source += [f"    AD r{n % 14}", f"    SA r{(n + 1) % 14}"]
+        total += len(body) + 3
+        n += 1
+    return source
+
+
+def label_heavy(lines:int, _:str) -> list[str]:
+    source = []
+    n = 0
+    while len(source) < lines:
+        source.append(f"L{n}:")
+        source.append(f"    LI #L{max(0, n - 2)}:0")
+        source.append(f"    LI #L{n // 2}:1")
+        source.append(f"    LI #L{max(0, n - 1)}:2")
+        source.append("    JP NC")
+        n += 1
+    return source[:lines]
+
+
+GENERATORS: dict[str, Callable[[int, str], list[str]]] = {
+    'instruction': instruction_heavy,
+    'define': define_heavy,
+    'macro': macro_heavy,
+    'include': include_heavy,
+    'label': label_heavy,
+}
+
+
+def run_pipeline(source:list[str], include_pathes:list[str], arch:str) -> tuple[dict[str, float], int, int]:
+    """(stage -> seconds, preprocessed lines, image bytes) of one run."""
+    assembler.INCLUDE_CACHE.clear()
+    times: dict[str, float] = {}
+
+    def stage(name, func):
+        t0 = time.perf_counter()
+        result = func()
+        times[name] = time.perf_counter() - t0
+        return result
+
+    session = assembler.Assembler(arch, include_pathes)
+    processed = stage('preprocess', lambda: session.preprocess(source))
+    machine_code = stage('assemble', lambda: session.assemble(processed))
+    image = stage('image', lambda: assembler.build_image(machine_code, 255))
+    stage('bitstream', lambda: assembler.adrlist2bitstream(machine_code, 255))
+    stage('ihex', lambda: hexfile.format_intel_hex(image.view(), image.regions))
+    stage('vhex', lambda: hexfile.format_verilog_hex(image.view()))
+    stage('list', lambda: hcxasm.format_list(processed, machine_code, session.ls, image))
+    return times, len(processed), len(image)
+
+
+def measure(kind:str, lines:int, repeat:int, arch:str) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        source = GENERATORS[kind](lines, directory)
+        include_pathes = [directory]
+        best: dict[str, float] = {}
+        for _ in range(repeat):
+            gc.collect()
+            times, processed_lines, size = run_pipeline(source, include_pathes, arch)
+            for name, seconds in times.items():
+                best[name] = min(best.get(name, seconds), seconds)
+        gc.collect()
+        tracemalloc.start()
+        run_pipeline(source, include_pathes, arch)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    total = sum(best.values())
+    stages = {name: {'ms': round(best[name] * 1000, 3),
+                     'lines_per_s': round(lines / best[name]) if best[name] > 0 else None,
+                     'bytes_per_s': round(size / best[name]) if best[name] > 0 else None}
+              for name in STAGES}
+    return {'kind': kind, 'lines': lines, 'processed_lines': processed_lines, 'bytes': size,
+            'ms': round(total * 1000, 3), 'lines_per_s': round(lines / total), 'bytes_per_s': round(size / total),
+            'peak_mib': round(peak / (1 << 20), 3), 'stages': stages}
+
+
+def run_command(args):
+    kinds = args.kinds.split(',')
+    for kind in kinds:
+        if kind not in GENERATORS:
+            raise SystemExit(f"[Error] Unknown kind '{kind}', choose from {', '.join(GENERATORS)}")
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = {'python': platform.python_version(), 'machine': platform.machine(), 'arch': args.architecture,
+               'repeat': args.repeat, 'cases': {}}
+    print(f"{'case':<20}{'ms':>10}{'lines/s':>12}{'bytes/s':>12}{'peak MiB':>10}  " + " ".join(f"{s:>10}" for s in STAGES))
+    for kind in kinds:
+        for lines in sizes:
+            case = measure(kind, lines, args.repeat, args.architecture)
+            results['cases'][f"{kind}/{lines}"] = case
+            print(f"{kind + '/' + str(lines):<20}{case['ms']:>10.1f}{case['lines_per_s']:>12}{case['bytes_per_s']:>12}"
+                  f"{case['peak_mib']:>10.2f}  " + " ".join(f"{case['stages'][s]['ms']:>10.2f}" for s in STAGES))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+        print(f"[Info] Results written to '{args.output}'.")
+
+
+def compare(before:dict, after:dict, threshold:float, min_ms:float) -> list[str]:
+    """
+    Stages (and peak memory) of the cases in both runs that got more than
+    threshold percent worse; a stage must also have lost min_ms.
+    """
+    regressions = []
+    limit = 1 + threshold / 100
+    for name, new in after['cases'].items():
+        old = before['cases'].get(name)
+        if old is None:
+            continue
+        for stage_name in STAGES:
+            old_ms = old['stages'][stage_name]['ms']
+            new_ms = new['stages'][stage_name]['ms']
+            if new_ms > old_ms * limit and new_ms - old_ms > min_ms:
+                regressions.append(f"{name} {stage_name}: {old_ms:.2f} ms -> {new_ms:.2f} ms (+{(new_ms / old_ms - 1) * 100:.0f}%)")
+        if new['peak_mib'] > old['peak_mib'] * limit:
+            regressions.append(f"{name} peak memory: {old['peak_mib']:.2f} MiB -> {new['peak_mib']:.2f} MiB")
+    return regressions
+
+
+def compare_command(args):
+    with open(args.before, 'r', encoding='utf-8') as f:
+        before = json.load(f)
+    with open(args.after, 'r', encoding='utf-8') as f:
+        after = json.load(f)
+    for name, new in after['cases'].items():
+        old = before['cases'].get(name)
+        if old is None:
+            print(f"{name:<20} only in {args.after}")
+            continue
+        print(f"{name:<20}{old['ms']:>10.1f} ms -> {new['ms']:>10.1f} ms ({new['ms'] / old['ms']:.2f}x), "
+              f"peak {old['peak_mib']:.2f} -> {new['peak_mib']:.2f} MiB")
+    regressions = compare(before, after, args.threshold, args.min_ms)
+    for line in regressions:
+        print(f"[Regression] {line}")
+    if regressions:
+        sys.exit(1)
+    print(f"[OK] No stage more than {args.threshold:g}% slower.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Assembler pipeline benchmark')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('run', help='Time every stage on generated programs')
+    run.add_argument('--kinds', default=','.join(GENERATORS), help=f"Program kinds (default: {','.join(GENERATORS)})")
+    run.add_argument('--sizes', default='1000,10000,100000', help='Program sizes in source lines (default: 1000,10000,100000)')
+    run.add_argument('--repeat', type=int, default=3, help='Timed runs, the best is reported (default: 3)')
+    run.add_argument('-a', '--architecture', default='HC4', help='Target architecture (default: HC4)')
+    run.add_argument('--output', help='Write the results to this JSON file')
+    cmp = sub.add_parser('compare', help='Flag stages that got slower between two result files')
+    cmp.add_argument('before')
+    cmp.add_argument('after')
+    cmp.add_argument('--threshold', type=float, default=10.0, help='Allowed slowdown in percent (default: 10)')
+    cmp.add_argument('--min-ms', type=float, default=1.0, help='Ignore stages that lost less than this (default: 1 ms)')
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_command(args)
+    else:
+        compare_command(args)
+
+
+if __name__ == '__main__':
+    main()
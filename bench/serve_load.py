@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Load test for the assembler daemon (hcxasm.py --serve).
+
+Fires many assemble requests at one daemon process and compares the latency
+with spawning hcxasm.py once per request, the way the editor used to.
+
+Usage:
+    python bench/serve_load.py [-n 5000] [--spawn 20] [--pipeline 64]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+SAMPLE = PROJECT_ROOT / 'py' / 'test_files' / 'dice4e.asm'
+
+
+def percentile(values:list[float], pct:float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(name:str, latencies_ms:list[float], wall_s:float):
+    print(f"{name}:")
+    print(f"  requests   : {len(latencies_ms)}")
+    print(f"  wall time  : {wall_s:.3f} s ({len(latencies_ms) / wall_s:.1f} req/s)")
+    print(f"  latency ms : mean {statistics.mean(latencies_ms):.3f}  p50 {percentile(latencies_ms, 50):.3f}"
+          f"  p99 {percentile(latencies_ms, 99):.3f}  max {max(latencies_ms):.3f}")
+
+
+def bench_daemon(source:str, count:int, pipeline:int) -> tuple[list[float], list[float], float]:
+    """Returns (client round-trip latencies, server-side assemble times, wall time)."""
+    proc = subprocess.Popen([sys.executable, str(PROJECT_ROOT / 'hcxasm.py'), '--serve'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            cwd=PROJECT_ROOT)
+    assert proc.stdin is not None and proc.stdout is not None
+    # Wait until the interpreter and the assembler import are out of the way.
+    proc.stdin.write(b'{"op": "ping"}\n')
+    proc.stdin.flush()
+    proc.stdout.readline()
+
+    round_trip: list[float] = []
+    server_side: list[float] = []
+    sent_at: dict[int, float] = {}
+    start = time.perf_counter()
+    sent = 0
+    received = 0
+    while received < count:
+        while sent < count and sent - received < pipeline:
+            request = {'id': sent, 'source': source, 'arch': 'HC4E', 'formats': ['ihex']}
+            sent_at[sent] = time.perf_counter()
+            proc.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+            sent += 1
+        proc.stdin.flush()
+        response = json.loads(proc.stdout.readline())
+        if not response['ok']:
+            raise RuntimeError(f"daemon error: {response['diagnostics']}")
+        round_trip.append((time.perf_counter() - sent_at.pop(response['id'])) * 1000)
+        server_side.append(response['timing']['total_ms'])
+        received += 1
+    wall = time.perf_counter() - start
+
+    proc.stdin.write(b'{"op": "shutdown"}\n')
+    proc.stdin.close()
+    proc.wait()
+    return round_trip, server_side, wall
+
+
+def bench_spawn(source:str, count:int) -> tuple[list[float], float]:
+    latencies: list[float] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        asm_path = Path(tmp) / 'sample.asm'
+        hex_path = Path(tmp) / 'sample.hex'
+        asm_path.write_text(source, encoding='utf-8')
+        start = time.perf_counter()
+        for _ in range(count):
+            t0 = time.perf_counter()
+            subprocess.run([sys.executable, str(PROJECT_ROOT / 'hcxasm.py'), str(asm_path),
+                            '-o', str(hex_path), '-f', 'ihex', '-a', 'HC4E', '-q'],
+                           check=True, stdout=subprocess.DEVNULL, cwd=PROJECT_ROOT)
+            latencies.append((time.perf_counter() - t0) * 1000)
+        wall = time.perf_counter() - start
+    return latencies, wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test for hcxasm.py --serve')
+    parser.add_argument('-n', '--requests', type=int, default=5000, help='Number of daemon requests (default: 5000)')
+    parser.add_argument('--pipeline', type=int, default=1, help='Requests kept in flight at once (default: 1)')
+    parser.add_argument('--spawn', type=int, default=20, help='Number of spawn-per-request runs for comparison (default: 20, 0 to skip)')
+    args = parser.parse_args()
+
+    source = SAMPLE.read_text(encoding='utf-8')
+
+    round_trip, server_side, wall = bench_daemon(source, args.requests, args.pipeline)
+    report(f"daemon (pipeline={args.pipeline}) round trip", round_trip, wall)
+    print(f"  server-side assemble ms : mean {statistics.mean(server_side):.3f}  p99 {percentile(server_side, 99):.3f}")
+
+    if args.spawn > 0:
+        spawn_latencies, spawn_wall = bench_spawn(source, args.spawn)
+        report("spawn per request", spawn_latencies, spawn_wall)
+        print(f"  speedup (mean latency)  : {statistics.mean(spawn_latencies) / statistics.mean(round_trip):.1f}x")
+
+
+if __name__ == '__main__':
+    main()
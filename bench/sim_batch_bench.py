@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for hcxsim.BatchMachine (requires numpy).
+
+Runs one py/test_files program on many lanes with different input ports and
+register files, and compares it with running a scalar hcxsim.Machine per
+lane, checking that every lane ends in the same state.
+
+Usage:
+    python bench/sim_batch_bench.py [--program dice4e.asm] [--arch HC4E] [--lanes 1,64,1024,4096] [--steps 2000]
+"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'py'))
+import assembler
+import hcxsim
+
+
+def scalar(rom:list[int], arch:str, input_ports:list[int], registers:list[list[int]], steps:int) -> tuple[float, int, list[dict]]:
+    t0 = time.perf_counter()
+    machine = hcxsim.Machine(rom, arch, stop_on_loop=False)
+    dumps = []
+    executed = 0
+    for input_port, regs in zip(input_ports, registers):
+        machine.reset()
+        machine.input_port = input_port
+        machine.regs[:] = regs
+        executed += machine.run(steps)
+        dumps.append(machine.registers())
+    return time.perf_counter() - t0, executed, dumps
+
+
+def batch(rom:list[int], arch:str, input_ports:list[int], registers:list[list[int]], steps:int) -> tuple[float, int, hcxsim.BatchMachine]:
+    t0 = time.perf_counter()
+    machine = hcxsim.BatchMachine(rom, arch, input_ports=input_ports, registers=registers, stop_on_loop=False)
+    machine.run(steps)
+    return time.perf_counter() - t0, int(machine.cycles.sum()), machine
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch simulator benchmark')
+    parser.add_argument('--program', default='dice4e.asm', help='Program in py/test_files (default: dice4e.asm)')
+    parser.add_argument('--arch', choices=['HC4', 'HC4E'], default='HC4E', help='Target architecture (default: HC4E)')
+    parser.add_argument('--lanes', default='1,64,1024,4096', help='Comma separated lane counts (default: 1,64,1024,4096)')
+    parser.add_argument('--steps', type=int, default=2000, help='Instructions per lane (default: 2000)')
+    args = parser.parse_args()
+    if hcxsim.np is None:
+        raise SystemExit("[Error] numpy is not installed")
+
+    text = (ROOT / 'py' / 'test_files' / args.program).read_text(encoding='utf-8')
+    rom = assembler.assemble_source(text, args.arch, [str(ROOT / 'py' / 'test_files'), str(ROOT / 'include')]).bitstream
+    rng = random.Random(1)
+    print(f"{args.program} ({args.arch}), {args.steps} steps per lane")
+    print(f"{'lanes':>6} {'scalar Minst/s':>15} {'batch Minst/s':>14} {'speedup':>8}")
+    for lanes in [int(n) for n in args.lanes.split(',')]:
+        input_ports = [rng.randrange(16) for _ in range(lanes)]
+        registers = [[rng.randrange(16) for _ in range(16)] for _ in range(lanes)]
+        scalar_time, scalar_count, dumps = scalar(rom, args.arch, input_ports, registers, args.steps)
+        batch_time, batch_count, result = batch(rom, args.arch, input_ports, registers, args.steps)
+        for lane, dump in enumerate(dumps):
+            if result.registers(lane) != dump:
+                raise SystemExit(f"[FAIL] lane {lane} differs from the scalar machine")
+        print(f"{lanes:>6} {scalar_count / scalar_time / 1e6:>15.2f} {batch_count / batch_time / 1e6:>14.2f} {scalar_time / batch_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
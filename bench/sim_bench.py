@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the simulator (py/hcxsim.py).
+
+Runs every py/test_files program for a fixed number of instructions, starting
+over whenever the program halts, and compares Machine.run with the
+bit-decoding reference interpreter.
+
+Usage:
+    python bench/sim_bench.py [--steps 2000000] [--reference-steps 200000]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'py'))
+import assembler
+import hcxsim
+
+PROGRAMS = [
+    ('alltest.asm', 'HC4'),
+    ('countlcd.asm', 'HC4'),
+    ('macrotest.asm', 'HC4'),
+    ('dice4e.asm', 'HC4E'),
+    ('inctest.asm', 'HC4E'),
+]
+
+
+def load(name:str, arch:str) -> list[int]:
+    text = (ROOT / 'py' / 'test_files' / name).read_text(encoding='utf-8')
+    return assembler.assemble_source(text, arch, [str(ROOT / 'py' / 'test_files'), str(ROOT / 'include')]).bitstream
+
+
+def run_machine(rom:list[int], arch:str, steps:int) -> tuple[float, int, int]:
+    machine = hcxsim.Machine(rom, arch, input_port=5)
+    executed = restarts = 0
+    t0 = time.perf_counter()
+    while executed < steps:
+        executed += machine.run(steps - executed)
+        if machine.halted is not None:
+            machine.reset()
+            restarts += 1
+    return time.perf_counter() - t0, executed, restarts
+
+
+def run_reference(rom:list[int], arch:str, steps:int) -> float:
+    t0 = time.perf_counter()
+    hcxsim._reference_run(rom, arch, steps, 5)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulator throughput benchmark')
+    parser.add_argument('--steps', type=int, default=2000000, help='Instructions per program (default: 2000000)')
+    parser.add_argument('--reference-steps', type=int, default=200000, help='Instructions for the reference interpreter (default: 200000)')
+    args = parser.parse_args()
+
+    print(f"{'program':<15} {'arch':<5} {'ROM':>5} {'restarts':>9} {'Minst/s':>9} {'reference':>10} {'speedup':>8}")
+    for name, arch in PROGRAMS:
+        rom = load(name, arch)
+        elapsed, executed, restarts = run_machine(rom, arch, args.steps)
+        rate = executed / elapsed
+        # the reference stops at the first halt, so time it on a program that keeps running
+        reference_rate = args.reference_steps / run_reference(rom, arch, args.reference_steps) if restarts == 0 else None
+        reference = f"{reference_rate / 1e6:>10.2f}" if reference_rate else f"{'-':>10}"
+        speedup = f"{rate / reference_rate:>7.1f}x" if reference_rate else f"{'-':>8}"
+        print(f"{name:<15} {arch:<5} {len(rom):>5} {restarts:>9} {rate / 1e6:>9.2f} {reference} {speedup}")
+
+
+if __name__ == '__main__':
+    main()
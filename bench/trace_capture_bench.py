@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Sustained trace rate of `load4e.py capture` against a fake board.
+
+A child process plays a board that streams trace lines as fast as the pty
+takes them, so the rate is set by the consumer. It compares the old trace
+loop (readline, decode, split, map(int), json.dumps, print per frame) with
+`load4e.py capture` (bulk reads, ring buffer, gzip file, decimated summary).
+
+Usage:
+    python bench/trace_capture_bench.py [--frames 200000]
+"""
+
+import argparse
+import json
+import os
+import re
+import select
+import subprocess
+import sys
+import time
+import tty
+from pathlib import Path
+
+import serial
+
+ROOT = Path(__file__).resolve().parent.parent
+HEADER = b"Trace start\r\nR0,R1,R2,R3,R4,R5,R6,R7,R8,R9,R10,R11,R12,R13,R14,R15,PC,INST\r\n"
+
+
+def firehose():
+    """Board side: after 't', stream frames until 'q'."""
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    print(os.ttyname(slave), flush=True)
+    blob = b"".join((",".join(str((n + i) % 16) for i in range(16)) + f",{n % 256},{0xA0 + n % 16}\r\n").encode() for n in range(1024))
+    received = b""
+    while b"t\n" not in received:
+        received += os.read(master, 1024)
+    os.write(master, HEADER)
+    while True:
+        readable, writable, _ = select.select([master], [master], [])
+        if readable and b"q" in os.read(master, 1024):
+            break
+        if writable:
+            os.write(master, blob)
+
+
+def legacy(port:str, frames:int) -> float:
+    """The trace loop before capture, printing JSON to /dev/null."""
+    with serial.Serial(port, 115200, timeout=1) as ser, open(os.devnull, "w") as out:
+        ser.write(b't\n')
+        ser.readline()
+        ser.readline()
+        t0 = time.perf_counter()
+        for _ in range(frames):
+            res = ser.readline()
+            regs = list(map(int, res.decode().strip().split(',')))
+            print(json.dumps({"regs": regs[0:16], "pc": regs[16], "inst": regs[17]}), file=out)
+        elapsed = time.perf_counter() - t0
+        ser.write(b'q\n')
+    return frames / elapsed
+
+
+def capture(port:str, frames:int) -> float:
+    run = subprocess.run([sys.executable, 'load4e.py', 'capture', '--port', port, '--frames', str(frames),
+                          '--output', str(ROOT / '__temp__' / 'bench.hxt')], capture_output=True, text=True, cwd=ROOT, check=True)
+    match = re.search(r"\((\d+) frames/s\), (\d+) dropped", run.stdout)
+    if match is None:
+        raise SystemExit(f"[FAIL] unexpected output:\n{run.stdout}{run.stderr}")
+    return float(match.group(1))
+
+
+def measure(consumer, frames:int) -> float:
+    board = subprocess.Popen([sys.executable, __file__, '--firehose'], stdout=subprocess.PIPE, text=True)
+    try:
+        port = board.stdout.readline().strip()
+        return consumer(port, frames)
+    finally:
+        board.kill()
+        board.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Trace capture benchmark')
+    parser.add_argument('--frames', type=int, default=200000, help='Frames per measurement (default: 200000)')
+    parser.add_argument('--firehose', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.firehose:
+        firehose()
+        return
+    (ROOT / '__temp__').mkdir(exist_ok=True)
+    legacy_rate = measure(legacy, args.frames)
+    capture_rate = measure(capture, args.frames)
+    size = (ROOT / '__temp__' / 'bench.hxt').stat().st_size
+    print(f"{args.frames} frames")
+    print(f"  readline + json print : {legacy_rate:10.0f} frames/s")
+    print(f"  load4e.py capture     : {capture_rate:10.0f} frames/s ({capture_rate / legacy_rate:.1f}x, {size / args.frames:.2f} bytes/frame on disk)")
+
+
+if __name__ == '__main__':
+    main()
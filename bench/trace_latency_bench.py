@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Latency of `load4e.py trace` against the pty fake board.
+
+Types commands into the trace while it runs and measures keypress -> device
+(until the board has the line) and device -> display (from the board sending
+a frame to the frame being read from the trace's stdout). Compares the
+asyncio trace loop with the previous readline(timeout=1) worker thread and
+input() loop, kept here as the reference.
+
+Usage:
+    python bench/trace_latency_bench.py [--commands 20] [--interval 0.05]
+"""
+
+import argparse
+import json
+import queue
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'py'))
+from fakedevice import FakeDevice
+
+
+def legacy_trace(port:str):
+    """The trace loop before asyncio (load4e.trace / tracewk)."""
+    import serial
+    with serial.Serial(port, 115200, timeout=1) as ser:
+        ser.write(b't\n')
+        ser.readline()
+        ser.readline()
+        q = queue.Queue()
+
+        def tracewk():
+            while True:
+                res = ser.readline()
+                if not q.empty():
+                    com = q.get()
+                    ser.write(com.encode() + b'\n')
+                    if com.strip().lower() == 'q':
+                        break
+                if not res:
+                    continue
+                regs = list(map(int, res.decode().strip().split(',')))
+                print(json.dumps({"regs": regs[0:16], "pc": regs[16], "inst": regs[17]}), flush=True)
+            ser.write(b'\x03\n')
+
+        worker = threading.Thread(target=tracewk)
+        worker.start()
+        while worker.is_alive():
+            com = input()
+            if com:
+                q.put(com)
+            if com.strip().lower() == 'q':
+                break
+        worker.join()
+
+
+def measure(cmd:list[str], commands:int, interval:float) -> tuple[list[float], list[float]]:
+    with FakeDevice(trace_interval=interval) as device:
+        proc = subprocess.Popen(cmd + ['--port', device.port], cwd=ROOT, text=True,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        display = []
+        lines = []
+
+        def reader():
+            for line in proc.stdout:
+                lines.append(time.perf_counter())
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        while not lines:
+            if proc.poll() is not None:
+                raise SystemExit(f"[FAIL] {cmd} exited with {proc.returncode}")
+            time.sleep(0.01)
+        keypress = []
+        for n in range(commands):
+            before = len(device.commands)
+            typed = time.perf_counter()
+            proc.stdin.write('s\n')
+            proc.stdin.flush()
+            while len(device.commands) == before:
+                time.sleep(0.0005)
+            keypress.append(device.command_times[before] - typed)
+            time.sleep(interval * 1.7)
+        proc.stdin.write('q\n')
+        proc.stdin.flush()
+        proc.wait(timeout=10)
+        thread.join()
+        # the nth line printed is the nth frame sent
+        display = [shown - sent for sent, shown in zip(device.trace_times, lines)]
+    return keypress, display
+
+
+def report(name:str, keypress:list[float], display:list[float]):
+    print(f"{name:<16} keypress -> device: median {statistics.median(keypress) * 1000:7.2f} ms, max {max(keypress) * 1000:7.2f} ms"
+          f"   device -> display: median {statistics.median(display) * 1000:7.2f} ms, max {max(display) * 1000:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Trace latency benchmark')
+    parser.add_argument('--commands', type=int, default=20, help='Commands typed per measurement (default: 20)')
+    parser.add_argument('--interval', type=float, default=0.05, help='Seconds between trace frames (default: 0.05)')
+    parser.add_argument('--legacy', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.legacy:
+        legacy_trace(args.port)
+        return
+    report('asyncio', *measure([sys.executable, 'load4e.py', 'trace', '-j'], args.commands, args.interval))
+    report('thread + queue', *measure([sys.executable, __file__, '--legacy'], args.commands, args.interval))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,25 +4,49 @@ HCX アセンブラ - .asmファイルをアセンブルして機械語コード
 
 使用方法:
     python hcxasm.py input.asm [-o output.bin] [-a architecture] [-f format]
+    python hcxasm.py a.asm b.asm "roms/*.asm" @manifest.txt [-o outdir] [-j jobs]
+    python hcxasm.py --serve [--listen PORT]
 
 引数:
-    input.asm           : 入力アセンブリファイル
-    -o, --output        : 出力ファイル名 (デフォルト: input.bin)
+    input.asm           : 入力アセンブリファイル (複数指定, ワイルドカード, @マニフェストも可)
+    -o, --output        : 出力ファイル名 (デフォルト: input.bin), 複数入力時は出力ディレクトリ
     -a, --architecture  : アーキテクチャ (HC4 または HC4E, デフォルト: HC4)
-    -f, --format        : 出力形式 (binary, hex, text, デフォルト: binary)
+    -f, --format        : 出力形式 (binary, hex, ihex, vhex, text, list, カンマ区切りで複数指定可, デフォルト: binary)
+    --record-length     : Intel HEXの1レコードのデータバイト数 (1-255, デフォルト: 16)
+    -O, --optimize      : のぞき穴最適化で命令を減らし、減ったバイト数とサイクル数を表示する
     -v, --verbose       : 詳細出力
+    -j, --jobs          : 複数入力時の並列プロセス数 (デフォルト: CPU数)
+    --force             : 複数入力時に変更のないファイルも再アセンブルする
+    --serve             : 常駐モード (行区切りJSONでアセンブル要求を受け付ける)
+    --listen            : 常駐モードで標準入出力の代わりにTCPポートで待ち受ける
+    --profile           : 工程・インクルードファイル・マクロ・defineごとの時間をJSONで書き出す
+    --pstats            : cProfileの結果をpstats形式で書き出す
+    --no-cache          : ビルドキャッシュを使わない
+    --cache-dir         : ビルドキャッシュのディレクトリ (デフォルト: ~/.cache/hcxasm)
+    --cache-size        : ビルドキャッシュの上限 (MiB, デフォルト: 64)
     -h, --help          : ヘルプ表示
 """
 
 import argparse
+import contextlib
+import functools
+import glob
+import hashlib
+import json
+import socketserver
 import sys
 import os
-from typing import Optional, Sequence
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional, Sequence, TextIO
 from pathlib import Path
 import re
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'py'))
 import assembler
+import buildcache
+import hexfile
+import optimizer
 
 def parse_arguments():
     """コマンドライン引数の解析"""
@@ -35,20 +59,32 @@ Output Formats:
     ihex       : Intel HEX file (.hex)
     hex, vhex  : Verilog HEX file (.hex)
     list, text : List file with source code correspondence (.lst, .txt)
+    Several formats separated by commas are written from one assembly; with -o the
+    name without its extension is shared, formats whose extension is taken by an
+    earlier one use the format name (-f ihex,vhex -o a.hex -> a.hex, a.vhex).
 
 Examples:
     python hcxasm.py program.asm
     python hcxasm.py program.asm -o output.bin
     python hcxasm.py program.asm -a HC4E -f ihex
     python hcxasm.py program.asm -o program.hex -f ihex -v
+    python hcxasm.py program.asm -f ihex,list,vhex
+    python hcxasm.py program.asm -a HC4E -O -f ihex,list
+    python hcxasm.py "roms/*.asm" -o build -f ihex -j 4
+    python hcxasm.py @roms.txt -o build -f ihex
+    python hcxasm.py --serve
+    python hcxasm.py --serve --listen 127.0.0.1:5050
+    python hcxasm.py program.asm --profile profile.json --pstats program.pstats
         """
     )
     
-    parser.add_argument('input_file', 
-                        help='Input assembly file (.asm)')
+    parser.add_argument('input_files', 
+                        nargs='*',
+                        metavar='input_file',
+                        help='Input assembly file (.asm). Several files, glob patterns and @manifest files assemble in parallel')
     
     parser.add_argument('-o', '--output',
-                        help='Output file name (default: input file name with .bin extension)')
+                        help='Output file name (default: input file name with .bin extension), or the output directory for several inputs')
     
     parser.add_argument('-a', '--architecture',
                         choices=['HC4', 'HC4E'],
@@ -56,10 +92,21 @@ Examples:
                         help='Target architecture (default: HC4)')
     
     parser.add_argument('-f', '--format',
-                        choices=['binary', 'hex', 'ihex', 'vhex', 'text', 'list'],
-                        default='binary',
-                        help='Output format (default: binary)')
+                        type=parse_formats,
+                        default=['binary'],
+                        metavar='FORMAT[,FORMAT...]',
+                        help='Output format, or several separated by commas (binary, hex, ihex, vhex, text, list; default: binary)')
     
+    parser.add_argument('--record-length',
+                        type=int,
+                        default=hexfile.RECORD_LENGTH,
+                        metavar='BYTES',
+                        help=f'Data bytes per Intel HEX record, 1 to 255 (default: {hexfile.RECORD_LENGTH})')
+
+    parser.add_argument('-O', '--optimize',
+                        action='store_true',
+                        help='Remove instructions that do not change what the program does (checked in the simulator)')
+
     parser.add_argument('-v', '--verbose',
                         action='store_true',
                         help='Enable verbose output messages')
@@ -72,8 +119,85 @@ Examples:
                         action='append',
                         default=[],
                         help='Additional include path for .INCLUDE directives')
-    
-    return parser.parse_args()
+
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help='Worker processes for several inputs (default: number of CPUs)')
+
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='With several inputs, assemble files even if they have not changed since the last build')
+
+    parser.add_argument('--build-state',
+                        metavar='FILE',
+                        help='With several inputs, where to remember the last build (default: .hcxasm-build.json in the output directory)')
+
+    parser.add_argument('--serve',
+                        action='store_true',
+                        help='Run as a long-lived assembler daemon speaking line-delimited JSON')
+
+    parser.add_argument('--listen',
+                        metavar='[HOST:]PORT',
+                        help='With --serve, accept connections on a local TCP port instead of stdin/stdout')
+
+    parser.add_argument('--profile',
+                        metavar='FILE',
+                        help='Write the time of every stage, include file, macro and define as JSON to FILE')
+
+    parser.add_argument('--pstats',
+                        metavar='FILE',
+                        help='Run under cProfile and write the statistics to FILE (read with python -m pstats)')
+
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='Do not look up or store builds in the build cache')
+
+    parser.add_argument('--cache-dir',
+                        metavar='DIR',
+                        help='Build cache directory (default: $HCXASM_CACHE_DIR or ~/.cache/hcxasm)')
+
+    parser.add_argument('--cache-size',
+                        type=int,
+                        default=buildcache.DEFAULT_MAX_BYTES >> 20,
+                        metavar='MIB',
+                        help=f'Size the build cache is kept under, in MiB (default: {buildcache.DEFAULT_MAX_BYTES >> 20})')
+
+    args = parser.parse_args()
+    if not args.serve and not args.input_files:
+        parser.error('the following arguments are required: input_file')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if not 1 <= args.record_length <= 255:
+        parser.error('--record-length must be 1 to 255')
+    args.input_file = args.input_files[0] if args.input_files else None
+    return args
+
+
+def expand_inputs(patterns:Sequence[str]) -> list[str]:
+    """
+    Expand the input_file arguments into a list of files.
+    Glob patterns are expanded (** included), and @FILE reads one input per line
+    from a manifest (blank lines and lines starting with # are ignored, relative
+    entries are relative to the manifest).
+    """
+    inputs: list[str] = []
+    for pattern in patterns:
+        if pattern.startswith('@'):
+            manifest = pattern[1:]
+            base = os.path.dirname(manifest)
+            with open(manifest, 'r', encoding='utf-8') as f:
+                entries = [line.strip() for line in f]
+            inputs += expand_inputs([os.path.join(base, e) for e in entries if e and not e.startswith('#')])
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                raise FileNotFoundError(f"[Error] No input files match '{pattern}'.")
+            inputs += matches
+        else:
+            inputs.append(pattern)
+    # keep the first occurrence of every file
+    return list(dict.fromkeys(inputs))
 
 
 def read_asm_file(filename:str):
@@ -92,110 +216,142 @@ def read_asm_file(filename:str):
         print(f"[Error]: An error occurred while reading the file '{filename}': {e}", file=sys.stderr)
         sys.exit(1)
 
-def write_binary_output(filename:str, machine_code:list[int]):
+def write_binary_output(filename:str, machine_code:"bytes | bytearray | memoryview | list[int]"):
     """バイナリ形式で出力"""
     try:
         with open(filename, 'wb') as f:
-            f.write(bytes(machine_code))
+            f.write(bytes(machine_code) if isinstance(machine_code, list) else machine_code)
         return True
     except Exception as e:
         print(f"[Error]: An error occurred while writing the binary file '{filename}': {e}", file=sys.stderr)
         return False
     
-def write_verilog_hex_output(filename:str, machine_code:list[int]):
+def format_verilog_hex(machine_code:Sequence[int]) -> str:
+    """verilogのHEX形式の文字列を生成"""
+    return hexfile.format_verilog_hex(machine_code)
+
+
+def write_verilog_hex_output(filename:str, machine_code:Sequence[int]):
     """verilogのHEX形式で出力"""
     try:
         with open(filename, 'w', encoding='utf-8') as f:
-            for i in machine_code:
-                f.write(f"{i:02X}\n")
+            f.write(format_verilog_hex(machine_code))
         return True
     except Exception as e:
         print(f"[Error]: An error occurred while writing the HEX file '{filename}': {e}", file=sys.stderr)
         return False
 
 
-def write_intel_hex_output(filename:str, machine_code:list[int]):
+def format_intel_hex(machine_code:Sequence[int], regions:Optional[Sequence[tuple[int, int]]]=None, record_length:int=hexfile.RECORD_LENGTH) -> str:
+    """Intel HEX形式の文字列を生成 (regionsを指定するとその範囲のレコードだけを出力, 64KiBを超えると拡張リニアアドレスレコードを付ける)"""
+    return hexfile.format_intel_hex(machine_code, regions, record_length)
+
+
+def write_intel_hex_output(filename:str, machine_code:Sequence[int], regions:Optional[Sequence[tuple[int, int]]]=None, record_length:int=hexfile.RECORD_LENGTH):
     """Intel HEX形式で出力"""
     try:
         with open(filename, 'w', encoding='utf-8') as f:
-            # Intel HEX形式のヘッダー
-            address = 0
-            for i in range(0, len(machine_code), 16):
-                chunk = machine_code[i:i+16]
-                data_len = len(chunk)
-                
-                # チェックサムの計算
-                checksum = data_len + (address >> 8) + (address & 0xFF)
-                for byte_val in chunk:
-                    checksum += byte_val
-                checksum = (~checksum + 1) & 0xFF
-                
-                # Intel HEX行の生成
-                hex_line = f":{data_len:02X}{address:04X}00"
-                for byte_val in chunk:
-                    hex_line += f"{byte_val:02X}"
-                hex_line += f"{checksum:02X}"
-                
-                f.write(hex_line + '\n')
-                address += data_len
-            
-            # EOF レコード
-            f.write(":00000001FF\n")
+            f.write(format_intel_hex(machine_code, regions, record_length))
         return True
     except Exception as e:
         print(f"[Error]: An error occurred while writing the HEX file '{filename}': {e}", file=sys.stderr)
         return False
 
 
-def write_list_output(filename:str, lines:Sequence[tuple[str, int, str, int]], adr_list: dict[int, tuple[int, int]], ls:assembler.LinkState):
+def format_list(lines:Sequence[tuple[str, int, str, int]], adr_list:assembler.MachineCode, ls:assembler.LinkState,
+                image:Optional[assembler.Image]=None) -> str:
+    """
+    Build the list file text with machine code and source code correspondence.
+    Args:
+        lines (Sequence[tuple[str, int, str, int]]): Preprocessed lines, tuple(line:str, lineno:int, unprocessed_line:str, address:int).
+        adr_list (assembler.MachineCode): Machine code and line number of every address.
+        ls (assembler.LinkState): Link state containing label information.
+        image (assembler.Image, optional): Image of adr_list for the hex dump, built if not given.
+    Returns:
+        str: Contents of the list file.
+    """
+    out: list[str] = []
+    out.append("HCX Assemble Results\n")
+    out.append("=" * 50 + "\n\n")
+    
+    out.append("Labels and Symbols:\n")
+    for label, address in ls.labels.items():
+        out.append(f"{label}: {address:04X}\n")
+    
+    # Machine code and source code correspondence table
+    out.append("line  address  machine code  source code\n")
+    out.append("-" * 50 + "\n")
+    
+    codes, code_linenos, start = adr_list.codes, adr_list.linenos, adr_list.start
+    for source_line, line_num, unprocessed_line, address_src in lines:
+        # an instruction line is the one its address was encoded from; label-only lines share the address
+        n = address_src - start
+        if source_line and source_line[-1] != ":" and 0 <= n < len(codes) and code_linenos[n] == line_num:
+            out.append(f"{line_num:4d}  {address_src:04X}     {codes[n]:02X}            {unprocessed_line}\n")
+        else:
+            out.append(f"{line_num:4d}  {address_src:04X}                   {unprocessed_line}\n")
+
+    if image is None:
+        image = assembler.build_image(adr_list, 255)
+    bitstream = image.view()
+
+    out.append("\n" + "-" * 50 + "\n")
+    out.append(f"Generated machine code: {len(bitstream)} bytes\n\n")
+    
+    # Hex dump
+    out.append("Hex dump:\n")
+    for i in range(0, len(bitstream), 16):
+        chunk = bitstream[i:i+16]
+        hex_str = " ".join(f"{byte_val:02X}" for byte_val in chunk)
+        out.append(f"{i:04X}: {hex_str:<47}\n")
+    return "".join(out)
+
+
+def write_list_output(filename:str, lines:Sequence[tuple[str, int, str, int]], adr_list:assembler.MachineCode, ls:assembler.LinkState,
+                      image:Optional[assembler.Image]=None, listing:Optional[str]=None):
     """
     Write output in text format with machine code and source code correspondence.
     Args:
         filename (str): Output text file name.
         lines (Sequence[tuple[str, int, str]]): List of tuple(line:str, lineno:int, unprocessed_line:str).
-        adr_list (dict[int, tuple[int, int]]): Dictionary mapping addresses to tuples of machine code and line numbers.
+        adr_list (assembler.MachineCode): Machine code and line number of every address.
         ls (assembler.LinkState): Link state containing label information.
+        image (assembler.Image, optional): Image of adr_list for the hex dump, built if not given.
+        listing (str, optional): Text of format_list() made earlier, written instead of formatting again.
     Returns:
         bool: True if writing is successful, False otherwise.
     """
     try:
         with open(filename, 'w', encoding='utf-8') as f:
-            f.write("HCX Assemble Results\n")
-            f.write("=" * 50 + "\n\n")
-            
-            f.write("Labels and Symbols:\n")
-            for label, address in ls.labels.items():
-                f.write(f"{label}: {address:04X}\n")
-            
-            # Machine code and source code correspondence table
-            f.write("line  address  machine code  source code\n")
-            f.write("-" * 50 + "\n")
-            
-            for source_line, line_num, unprocessed_line, address_src in lines:
-                if address_src in adr_list and adr_list[address_src][1] == line_num and unprocessed_line and unprocessed_line.strip().split()[0].upper() in assembler.INST_TYPES:
-                    byte_val, _ = adr_list[address_src]
-                    f.write(f"{line_num:4d}  {address_src:04X}     {byte_val:02X}            {unprocessed_line}\n")
-                else:
-                    f.write(f"{line_num:4d}  {address_src:04X}                   {unprocessed_line}\n")
-
-            bitstream = assembler.adrlist2bitstream(adr_list, 255)
-
-            f.write("\n" + "-" * 50 + "\n")
-            f.write(f"Generated machine code: {len(bitstream)} bytes\n\n")
-            
-            # Hex dump
-            f.write("Hex dump:\n")
-            for i in range(0, len(bitstream), 16):
-                chunk = bitstream[i:i+16]
-                hex_str = " ".join(f"{byte_val:02X}" for byte_val in chunk)
-                f.write(f"{i:04X}: {hex_str:<47}\n")
-                
+            f.write(listing if listing is not None else format_list(lines, adr_list, ls, image))
         return True
     except Exception as e:
         print(f"[Error]: An error occurred while writing the list file '{filename}': {e}", file=sys.stderr)
         return False
 
 
+# 出力形式 -> 拡張子
+OUTPUT_EXTENSIONS = {
+    'binary': '.bin',
+    'hex': '.hex',
+    'ihex': '.hex',
+    'vhex': '.hex',
+    'text': '.lst',
+    'list': '.lst'
+}
+
+
+def parse_formats(text:str) -> list[str]:
+    """-f の値 (カンマ区切りで複数指定可) を出力形式のリストにする"""
+    formats = list(dict.fromkeys(f.strip() for f in text.split(',') if f.strip()))
+    for format_type in formats:
+        if format_type not in OUTPUT_EXTENSIONS:
+            raise argparse.ArgumentTypeError(f"invalid format: '{format_type}' (choose from {', '.join(OUTPUT_EXTENSIONS)})")
+    if not formats:
+        raise argparse.ArgumentTypeError("no output format given")
+    return formats
+
+
 def determine_output_filename(input_file:str, output_file:str, format_type:str):
     """出力ファイル名を決定"""
     if output_file:
@@ -206,15 +362,503 @@ def determine_output_filename(input_file:str, output_file:str, format_type:str):
     base_name = input_path.stem
     
     # 形式に応じた拡張子を決定
-    extensions = {
-        'binary': '.bin',
-        'hex': '.hex',
-        'ihex': '.hex',
-        'vhex': '.hex',
-        'text': '.lst'
+    return base_name + OUTPUT_EXTENSIONS[format_type]
+
+
+def determine_output_filenames(input_file:str, output_file:Optional[str], formats:Sequence[str]) -> dict[str, str]:
+    """
+    出力形式ごとの出力ファイル名を決定する。
+    複数形式のときは output_file (拡張子を除く) または入力ファイル名を共通の名前にし、
+    拡張子が重なる形式には形式名を拡張子にする (例: -f ihex,vhex -> a.hex, a.vhex)
+    """
+    if len(formats) == 1:
+        return {formats[0]: determine_output_filename(input_file, output_file, formats[0])}
+    base_name = str(Path(output_file).with_suffix('')) if output_file else Path(input_file).stem
+    filenames: dict[str, str] = {}
+    for format_type in formats:
+        filename = base_name + OUTPUT_EXTENSIONS[format_type]
+        if filename in filenames.values():
+            filename = base_name + '.' + format_type
+        filenames[format_type] = filename
+    return filenames
+
+
+def write_output(filename:str, format_type:str, processed_lines:Sequence[tuple[str, int, str, int]], machine_code:assembler.MachineCode, ls:assembler.LinkState,
+                 image:Optional[assembler.Image]=None, record_length:int=hexfile.RECORD_LENGTH, listing:Optional[str]=None) -> bool:
+    """指定形式で出力ファイルを書き込む (imageを渡すと全形式でそのバッファを共有する, listingを渡すとlist形式はそれを書き込む)"""
+    if image is None:
+        image = assembler.build_image(machine_code, 255)
+    if format_type == 'binary':
+        return write_binary_output(filename, image.view())
+    elif format_type == 'ihex':
+        return write_intel_hex_output(filename, image.view(), image.regions, record_length)
+    elif format_type == 'hex' or format_type == 'vhex':
+        return write_verilog_hex_output(filename, image.view())
+    elif format_type == 'list' or format_type == 'text':
+        return write_list_output(filename, processed_lines, machine_code, ls, image, listing)
+    return False
+
+
+def profile_stage(profile:Optional[assembler.Profile], name:str):
+    """profileがあれば工程nameの時間を計るコンテキスト (なければ何もしない)"""
+    return profile.stage(name) if profile is not None else contextlib.nullcontext()
+
+
+def write_profile(filename:str, profile:assembler.Profile, **fields):
+    """プロファイル結果をJSONで書き出し、工程ごとの時間を1行で表示する"""
+    report = dict(fields, **profile.report())
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    stages = ", ".join(f"{s['name']} {s['ms']:.2f} ms" for s in report['stages'])
+    print(f"[Info] Profile: {stages} (total {report['total_ms']:.2f} ms), written to '{filename}'.")
+
+
+def write_outputs(filenames:dict[str, str], processed_lines:Sequence[tuple[str, int, str, int]], machine_code:assembler.MachineCode, ls:assembler.LinkState,
+                  image:Optional[assembler.Image]=None, record_length:int=hexfile.RECORD_LENGTH,
+                  profile:Optional[assembler.Profile]=None, listing:Optional[str]=None) -> bool:
+    """形式 -> ファイル名 の全出力を、一度だけ作ったイメージから書き込む (profileには形式ごとの書き込み時間を記録する)"""
+    if image is None:
+        image = assembler.build_image(machine_code, 255)
+    success = True
+    for format_type, filename in filenames.items():
+        with profile_stage(profile, f"write {format_type}"):
+            success = write_output(filename, format_type, processed_lines, machine_code, ls, image, record_length, listing) and success
+    return success
+
+
+@functools.lru_cache(maxsize=None)
+def cache_version() -> str:
+    """ビルドキャッシュのバージョン (アセンブラと出力形式のソースのハッシュ)"""
+    return buildcache.code_version(os.path.abspath(__file__), assembler.__file__, hexfile.__file__)
+
+
+def open_build_cache(args) -> Optional[buildcache.BuildCache]:
+    """オプションに従ってビルドキャッシュを開く (--no-cacheならNone)"""
+    if args.no_cache:
+        return None
+    return buildcache.BuildCache(args.cache_dir or buildcache.default_directory(), args.cache_size << 20, cache_version())
+
+
+def file_signature(filename:str) -> list:
+    """[mtime_ns, size, sha1] of a file, as stored in the build state."""
+    with open(filename, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    st = os.stat(filename)
+    return [st.st_mtime_ns, st.st_size, digest]
+
+
+class BuildState:
+    """
+    What the last batch build produced, so that unchanged inputs can be skipped.\n
+    For every input the file keeps the output name, the options it was built
+    with and the signature of the input and of every file it included,
+    transitively. A file whose mtime or size changed is hashed again, so
+    touching a file without editing it does not force a rebuild.
+    """
+    def __init__(self, filename:str):
+        self.filename = filename
+        self.entries: dict[str, dict] = {}
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f).get('inputs', {})
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def is_current(self, input_file:str, output_filenames:Sequence[str], options:list) -> bool:
+        entry = self.entries.get(os.path.abspath(input_file))
+        if entry is None or entry.get('outputs') != [os.path.abspath(f) for f in output_filenames] or entry['options'] != options:
+            return False
+        if not all(os.path.exists(f) for f in output_filenames):
+            return False
+        for filename, (mtime_ns, size, digest) in entry['files'].items():
+            try:
+                st = os.stat(filename)
+                if st.st_mtime_ns == mtime_ns and st.st_size == size:
+                    continue
+                if file_signature(filename)[2] != digest:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def update(self, input_file:str, output_filenames:Sequence[str], options:list, files:dict[str, list]):
+        self.entries[os.path.abspath(input_file)] = {
+            'outputs': [os.path.abspath(f) for f in output_filenames],
+            'options': options,
+            'files': files,
+        }
+
+    def save(self):
+        with open(self.filename, 'w', encoding='utf-8') as f:
+            json.dump({'inputs': self.entries}, f, indent=1)
+
+
+def format_output(format_type:str, image:assembler.Image, record_length:int, listing:Callable[[], str]) -> str:
+    """1つの出力形式の内容を文字列で返す (binaryは16進文字列, listingはlist形式の本文を返す関数)"""
+    if format_type == 'binary':
+        return image.data.hex().upper()
+    elif format_type == 'ihex':
+        return format_intel_hex(image.view(), image.regions, record_length)
+    elif format_type == 'hex' or format_type == 'vhex':
+        return format_verilog_hex(image.view())
+    elif format_type == 'list' or format_type == 'text':
+        return listing()
+    raise ValueError(f"[Error] Unsupported output format: {format_type}")
+
+
+def assemble_in_memory(source:str, arch:str, include_pathes:list[str], formats:Sequence[str]=('ihex',),
+                       incremental:Optional[assembler.IncrementalAssembler]=None, record_length:int=hexfile.RECORD_LENGTH,
+                       profile:Optional[assembler.Profile]=None, cache:Optional[buildcache.BuildCache]=None,
+                       optimize:bool=False) -> dict:
+    """
+    Assemble source text without touching the file system for input or output.
+    Returns a dict holding the requested output formats (as text), the label table
+    and the size of the generated image. Errors propagate as exceptions.
+    With an IncrementalAssembler only the lines changed since its last run are assembled again.
+    With a Profile the stages, include files, macros and defines of this run are recorded in it.
+    With a BuildCache a build of the same source and includes is taken from the cache
+    ('cached' is True in the response, and the lookup is the only stage of the Profile),
+    and a new build is stored in it.
+    With optimize the program goes through the optimizer and 'optimized' holds its report;
+    optimized builds are not cached.
+    """
+    timing: dict[str, float] = {}
+    t0 = time.perf_counter()
+    with_listing = any(fmt in ('list', 'text') for fmt in formats)
+    if optimize:
+        cache = None
+    if cache is not None:
+        with profile_stage(profile, 'cache'):
+            entry = cache.get(source, arch, include_pathes, with_listing)
+        if entry is not None:
+            image = entry.image
+            outputs = {fmt: format_output(fmt, image, record_length, lambda: entry.listing) for fmt in formats}
+            timing['cache_ms'] = (time.perf_counter() - t0) * 1000
+            return {'outputs': outputs, 'labels': entry.labels, 'lines': entry.lines, 'size': len(image), 'timing': timing, 'cached': True}
+    full_builds = 0
+    if incremental is not None:
+        full_builds = incremental.full_builds
+        incremental.profile = profile
+        try:
+            with profile_stage(profile, 'incremental update'):
+                result = incremental.update(source.splitlines())
+        finally:
+            incremental.profile = None
+        processed_lines, ls, machine_code = result.lines, result.ls, result.machine_code
+        dependencies, shadows = result.dependencies, result.shadows
+        t1 = t2 = time.perf_counter()
+    else:
+        session = assembler.Assembler(arch, include_pathes, profile=profile)
+        processed_lines = session.preprocess(source.splitlines())
+        t1 = time.perf_counter()
+        ls = session.ls
+        machine_code = session.assemble(processed_lines)
+        dependencies, shadows = session.dependencies, session.shadows
+        t2 = time.perf_counter()
+    optimized = None
+    if optimize:
+        with profile_stage(profile, 'optimize'):
+            optimized = optimizer.optimize(processed_lines, machine_code, ls, arch)
+        processed_lines, machine_code, ls = optimized.lines, optimized.machine_code, optimized.ls
+        timing['optimize_ms'] = (time.perf_counter() - t2) * 1000
+    t_output = time.perf_counter()
+    with profile_stage(profile, 'image'):
+        image = assembler.build_image(machine_code, 255)
+    listing: list[str] = []
+
+    def make_listing() -> str:
+        if not listing:
+            listing.append(format_list(processed_lines, machine_code, ls, image))
+        return listing[0]
+
+    outputs: dict[str, str] = {}
+    for fmt in formats:
+        with profile_stage(profile, f"output {fmt}"):
+            outputs[fmt] = format_output(fmt, image, record_length, make_listing)
+    t3 = time.perf_counter()
+    timing['preprocess_ms'] = (t1 - t0) * 1000
+    timing['assemble_ms'] = (t2 - t1) * 1000
+    timing['output_ms'] = (t3 - t_output) * 1000
+    response = {
+        'outputs': outputs,
+        'labels': dict(ls.labels),
+        'lines': len(processed_lines),
+        'size': len(image),
+        'timing': timing,
+        'cached': False,
     }
-    
-    return base_name + extensions[format_type]
+    if incremental is not None:
+        response['incremental'] = incremental.full_builds == full_builds
+    if optimized is not None:
+        response['optimized'] = optimized.report()
+    if cache is not None:
+        cache.put(source, arch, include_pathes, dependencies,
+                  buildcache.CacheEntry(image.data, image.regions, response['labels'], len(processed_lines), listing[0] if listing else None),
+                  shadows)
+    return response
+
+
+# editor buffers the daemon keeps incremental assembly state for
+MAX_EDITOR_SESSIONS = 8
+
+
+class ServeStats:
+    """Counters reported by the daemon's "stats" request."""
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, elapsed_ms:float, ok:bool):
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def as_dict(self) -> dict:
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'total_ms': self.total_ms,
+            'mean_ms': self.total_ms / self.requests if self.requests else 0.0,
+            'max_ms': self.max_ms,
+            'include_cache': {'hits': assembler.INCLUDE_CACHE.hits, 'misses': assembler.INCLUDE_CACHE.misses},
+        }
+
+
+def handle_request(request:dict, stats:ServeStats, sessions:Optional[dict]=None, cache:Optional[buildcache.BuildCache]=None) -> dict:
+    """
+    Handle a single daemon request.
+    Request fields:
+        op (str): "assemble" (default), "ping", "stats" or "shutdown".
+        id: Echoed back unchanged so that clients can pipeline requests.
+        source (str): Assembly source text.
+        arch (str): Target architecture (default: HC4).
+        include_paths (list[str]): Additional include paths for .INCLUDE directives.
+        formats (list[str]): Output formats to return (default: ["ihex"]).
+        record_length (int): Data bytes per Intel HEX record (default: 16).
+        session (str): Optional name of an editor buffer. Requests with the same name
+            re-assemble only the lines that changed since the previous request.
+        profile (bool): Add a "profile" report (see assembler.Profile.report) to the response.
+            The build cache lookup is its "cache" stage, the only one when the build is taken from it.
+        optimize (bool): Run the optimizer (hcxasm.py -O) and add its report as "optimized".
+    """
+    op = request.get('op', 'assemble')
+    response: dict = {'id': request.get('id'), 'op': op}
+    if op == 'ping':
+        response['ok'] = True
+        return response
+    if op == 'stats':
+        response['ok'] = True
+        response['stats'] = stats.as_dict()
+        return response
+    if op == 'shutdown':
+        response['ok'] = True
+        return response
+    if op != 'assemble':
+        response['ok'] = False
+        response['diagnostics'] = [{'severity': 'error', 'message': f"[Error] Unknown op: {op}"}]
+        return response
+
+    start = time.perf_counter()
+    include_dir = Path(__file__).resolve().parent / 'include'
+    include_pathes = list(request.get('include_paths', [])) + [str(include_dir)]
+    try:
+        arch = request.get('arch', 'HC4')
+        if arch not in assembler.INST_DICT_M:
+            raise KeyError(f"[Error] Unsupported architecture: {arch}")
+        incremental = None
+        if sessions is not None and request.get('session') is not None:
+            key = (str(request['session']), arch, tuple(include_pathes))
+            incremental = sessions.pop(key, None) or assembler.IncrementalAssembler(arch, include_pathes)
+            sessions[key] = incremental
+            while len(sessions) > MAX_EDITOR_SESSIONS:
+                del sessions[next(iter(sessions))]
+        profile = assembler.Profile() if request.get('profile') else None
+        result = assemble_in_memory(request.get('source', ''), arch, include_pathes, request.get('formats', ['ihex']), incremental,
+                                    int(request.get('record_length', hexfile.RECORD_LENGTH)), profile, cache,
+                                    bool(request.get('optimize')))
+        response['ok'] = True
+        response.update(result)
+        if profile is not None:
+            response['profile'] = profile.report()
+        response['diagnostics'] = []
+    except Exception as e:
+        message = e.args[0] if isinstance(e, KeyError) and e.args else str(e)
+        response['ok'] = False
+        response['diagnostics'] = [{'severity': 'error', 'message': str(message)}]
+        response['timing'] = {}
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    response['timing']['total_ms'] = elapsed_ms
+    stats.record(elapsed_ms, response['ok'])
+    return response
+
+
+def serve_stream(rfile, wfile, stats:ServeStats, sessions:Optional[dict]=None, cache:Optional[buildcache.BuildCache]=None) -> bool:
+    """
+    Serve line-delimited JSON requests from a binary stream until EOF.
+    Returns True when a shutdown request was received.
+    """
+    for raw in rfile:
+        if not raw.strip():
+            continue
+        try:
+            request = json.loads(raw)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+        except ValueError as e:
+            response = {'id': None, 'ok': False, 'diagnostics': [{'severity': 'error', 'message': f"[Error] Invalid request: {e}"}]}
+        else:
+            # Anything printed while assembling must not corrupt the protocol stream.
+            with contextlib.redirect_stdout(sys.stderr):
+                response = handle_request(request, stats, sessions, cache)
+        wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        wfile.flush()
+        if response.get('op') == 'shutdown':
+            return True
+    return False
+
+
+def serve(args):
+    """Run hcxasm as a daemon on stdin/stdout or on a local TCP port."""
+    stats = ServeStats()
+    # (session, arch, include paths) -> IncrementalAssembler, least recently used first
+    sessions: dict = {}
+    cache = open_build_cache(args)
+    if not args.listen:
+        print("[Info] hcxasm daemon ready on stdin/stdout.", file=sys.stderr, flush=True)
+        serve_stream(sys.stdin.buffer, sys.stdout.buffer, stats, sessions, cache)
+        return
+
+    host, _, port = args.listen.rpartition(':')
+    host = host or '127.0.0.1'
+    stop = False
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            nonlocal stop
+            if serve_stream(self.rfile, self.wfile, stats, sessions, cache):
+                stop = True
+
+    with socketserver.TCPServer((host, int(port)), Handler) as server:
+        print(f"[Info] hcxasm daemon listening on {host}:{server.server_address[1]}.", file=sys.stderr, flush=True)
+        while not stop:
+            server.handle_request()
+
+
+def build_file(input_file:str, output_filenames:dict[str, str], arch:str, include_path:Sequence[str],
+               record_length:int=hexfile.RECORD_LENGTH, optimize:bool=False) -> dict:
+    """
+    Assemble one file of a batch into every format of output_filenames (format -> file).
+    Runs in a worker process.
+    Returns a dict with the result, the time it took and the signature of every
+    file the output depends on.
+    """
+    start = time.perf_counter()
+    result: dict = {'input': input_file, 'outputs': list(output_filenames.values()), 'ok': False}
+    try:
+        files = {os.path.abspath(input_file): file_signature(input_file)}
+        with open(input_file, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        include_dir = Path(__file__).resolve().parent / 'include'
+        session = assembler.Assembler(arch, [os.path.dirname(input_file)] + list(include_path) + [str(include_dir)])
+        processed_lines = session.preprocess(lines)
+        machine_code = session.assemble(processed_lines)
+        ls = session.ls
+        for dependency in session.dependencies:
+            files[os.path.abspath(dependency)] = file_signature(dependency)
+        if optimize:
+            optimized = optimizer.optimize(processed_lines, machine_code, ls, arch)
+            processed_lines, machine_code, ls = optimized.lines, optimized.machine_code, optimized.ls
+            result['optimized'] = optimized.summary()
+        image = assembler.build_image(machine_code, 255)
+        result['ok'] = write_outputs(output_filenames, processed_lines, machine_code, ls, image, record_length)
+        if not result['ok']:
+            result['error'] = f"[Error] Could not write '{', '.join(output_filenames.values())}'."
+        result['lines'] = len(processed_lines)
+        result['size'] = len(image)
+        result['files'] = files
+    except Exception as e:
+        message = e.args[0] if isinstance(e, KeyError) and e.args else str(e)
+        result['error'] = str(message)
+    result['ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def batch_main(args, inputs:list[str]):
+    """Assemble several files in worker processes, skipping the ones that have not changed."""
+    if args.profile:
+        raise ValueError("[Error] --profile needs a single input file.")
+    wall_start = time.perf_counter()
+    output_dir = args.output
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    state = BuildState(args.build_state or os.path.join(output_dir or '.', '.hcxasm-build.json'))
+    options = [",".join(args.format), args.architecture, list(args.include_path)]
+    if args.record_length != hexfile.RECORD_LENGTH:
+        options.append(args.record_length)
+    if args.optimize:
+        options.append('-O')
+
+    jobs: list[tuple[str, dict[str, str]]] = []
+    skipped: list[str] = []
+    outputs: dict[str, str] = {}
+    for input_file in inputs:
+        if not os.path.exists(input_file):
+            raise FileNotFoundError(f"[Error] Input file '{input_file}' does not exist.")
+        output_filenames = determine_output_filenames(input_file, None, args.format)
+        for format_type, output_filename in output_filenames.items():
+            if output_dir:
+                output_filename = output_filenames[format_type] = os.path.join(output_dir, output_filename)
+            if output_filename in outputs:
+                raise ValueError(f"[Error] '{input_file}' and '{outputs[output_filename]}' would both be written to '{output_filename}'.")
+            outputs[output_filename] = input_file
+        if not args.force and state.is_current(input_file, list(output_filenames.values()), options):
+            skipped.append(input_file)
+        else:
+            jobs.append((input_file, output_filenames))
+
+    build_start = time.perf_counter()
+    if args.jobs == 1 or len(jobs) <= 1:
+        results = [build_file(i, o, args.architecture, args.include_path, args.record_length, args.optimize) for i, o in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(args.jobs, len(jobs))) as pool:
+            results = list(pool.map(build_file, [i for i, _ in jobs], [o for _, o in jobs],
+                                    [args.architecture] * len(jobs), [args.include_path] * len(jobs),
+                                    [args.record_length] * len(jobs), [args.optimize] * len(jobs)))
+    build_time = time.perf_counter() - build_start
+
+    failed = 0
+    for result in results:
+        if result['ok']:
+            state.update(result['input'], result['outputs'], options, result['files'])
+            if not args.quiet:
+                print(f"[OK] {result['input']} -> {', '.join(result['outputs'])} ({result['lines']} lines, {result['size']} bytes, {result['ms']:.1f} ms)")
+                if args.verbose and 'optimized' in result:
+                    print(f"     {result['optimized']}")
+        else:
+            failed += 1
+            print(f"[Error] {result['input']}: {result['error']}", file=sys.stderr)
+    if args.verbose:
+        for input_file in skipped:
+            print(f"[Info] {input_file} is up to date.")
+    state.save()
+
+    wall = time.perf_counter() - wall_start
+    if not args.quiet:
+        built = len(results) - failed
+        print(f"[Info] {len(inputs)} files: {built} assembled, {len(skipped)} up to date, {failed} failed.")
+        if results:
+            per_file = [r['ms'] for r in results]
+            print(f"[Info] Per file: mean {sum(per_file) / len(per_file):.1f} ms, max {max(per_file):.1f} ms "
+                  f"({min(args.jobs, len(jobs))} worker(s)).")
+            print(f"[Info] Wall time {wall:.3f} s, {len(results) / build_time if build_time > 0 else 0.0:.1f} files/s.")
+        else:
+            print(f"[Info] Wall time {wall:.3f} s.")
+    if failed:
+        sys.exit(1)
 
 
 def main(args):
@@ -224,51 +868,106 @@ def main(args):
     if not os.path.exists(args.input_file):
         raise FileNotFoundError(f"[Error] Input file '{args.input_file}' does not exist.")
     
-    # Determine output file name
-    output_filename = determine_output_filename(args.input_file, args.output, args.format)
+    # Determine output file names
+    output_filenames = determine_output_filenames(args.input_file, args.output, args.format)
     
     if args.verbose:
         print(f"HCX Assembler")
         print(f"Input file: {args.input_file}")
-        print(f"Output file: {output_filename}")
-        print(f"Output format: {args.format}")
+        print(f"Output file: {', '.join(output_filenames.values())}")
+        print(f"Output format: {','.join(args.format)}")
         print()
     
+    profile = assembler.Profile() if args.profile else None
     # Read assembly file
-    lines = read_asm_file(args.input_file)
+    with profile_stage(profile, 'read'):
+        lines = read_asm_file(args.input_file)
     # Write output file
     include_dir = Path(__file__).resolve().parent / 'include'
     default_include_pathes = [os.path.dirname(args.input_file)] + args.include_path + [str(include_dir)]
-    processed_lines = assembler.preprocess(lines, False, 0, default_include_pathes)
-    if args.verbose:
-        print(f"[Info] Preprocessed {len(processed_lines)} lines.")
-        # print(processed_lines)
-    ls = assembler.LinkState()
-    
-    machine_code = assembler.assemble(tuple((pl[0], pl[1]) for pl in processed_lines), ls, args.architecture)
-
-    success = False
-    if args.format == 'binary':
-        success = write_binary_output(output_filename, assembler.adrlist2bitstream(machine_code, 255))
-    elif args.format == 'ihex':
-        success = write_intel_hex_output(output_filename, assembler.adrlist2bitstream(machine_code, 255))
-    elif args.format == 'hex' or args.format == 'vhex':
-        success = write_verilog_hex_output(output_filename, assembler.adrlist2bitstream(machine_code, 255))
-    elif args.format == 'list' or args.format == 'text':
-        success = write_list_output(output_filename, processed_lines, machine_code, ls)
-    
+    # a profiled run always assembles, optimized builds are not cached
+    cache = open_build_cache(args) if profile is None and not args.optimize else None
+    source = "\n".join(lines)
+    with_listing = any(f in ('list', 'text') for f in args.format)
+    entry = None
+    if cache is not None:
+        t0 = time.perf_counter()
+        entry = cache.get(source, args.architecture, default_include_pathes, with_listing)
+        if args.verbose:
+            print(f"[Info] Build cache {'hit' if entry is not None else 'miss'} in {(time.perf_counter() - t0) * 1e6:.0f} us ({cache.directory}).")
+    if entry is not None:
+        image = entry.image
+        labels = entry.labels
+        line_count = entry.lines
+        success = write_outputs(output_filenames, (), assembler.MachineCode(), assembler.LinkState(), image, args.record_length,
+                                listing=entry.listing)
+    else:
+        session = assembler.Assembler(args.architecture, default_include_pathes, profile=profile)
+        processed_lines = session.preprocess(lines)
+        if args.verbose:
+            print(f"[Info] Preprocessed {len(processed_lines)} lines.")
+            print(f"[Info] Include cache: {assembler.INCLUDE_CACHE.hits} hits, {assembler.INCLUDE_CACHE.misses} misses.")
+            # print(processed_lines)
+        ls = session.ls
+
+        machine_code = session.assemble(processed_lines)
+        if args.optimize:
+            with profile_stage(profile, 'optimize'):
+                optimized = optimizer.optimize(processed_lines, machine_code, ls, args.architecture)
+            processed_lines, machine_code, ls = optimized.lines, optimized.machine_code, optimized.ls
+            if not args.quiet:
+                print(optimized.summary())
+
+        # one image shared by every output format
+        with profile_stage(profile, 'image'):
+            image = assembler.build_image(machine_code, 255)
+        listing = None
+        if with_listing:
+            with profile_stage(profile, 'list'):
+                listing = format_list(processed_lines, machine_code, ls, image)
+        success = write_outputs(output_filenames, processed_lines, machine_code, ls, image, args.record_length, profile, listing)
+        labels = dict(ls.labels)
+        line_count = len(processed_lines)
+        if cache is not None and success:
+            cache.put(source, args.architecture, default_include_pathes, session.dependencies,
+                      buildcache.CacheEntry(image.data, image.regions, labels, line_count, listing), session.shadows)
+
     if not success:
         sys.exit(1)
 
-    print(f"[Info] Assembled {len(processed_lines)} lines into {len(assembler.adrlist2bitstream(machine_code, 255))} bytes.")
+    if entry is not None:
+        print(f"[Info] {line_count} lines, {len(image)} bytes from the build cache.")
+    else:
+        print(f"[Info] Assembled {line_count} lines into {len(image)} bytes.")
     if args.verbose:
         print(f"[Info] Architecture: {args.architecture}")
-        print(f"[Info] Output format: {args.format}")
+        print(f"[Info] Output format: {','.join(args.format)}")
         print(f"[Info] Defined labels: ")
-        for label, address in ls.labels.items():
+        for label, address in labels.items():
             print(f"       {label}: {address:04X}")
-    print(f"[OK] Done. Output written to '{output_filename}'.")
+    if profile is not None:
+        write_profile(args.profile, profile, input=args.input_file, arch=args.architecture, lines=line_count, size=len(image))
+    written = "', '".join(output_filenames.values())
+    print(f"[OK] Done. Output written to '{written}'.")
+
+def run(args):
+    if args.serve:
+        serve(args)
+    else:
+        inputs = expand_inputs(args.input_files)
+        if len(inputs) == 1 and inputs == args.input_files:
+            main(args)
+        else:
+            batch_main(args, inputs)
 
 if __name__ == "__main__":
     args = parse_arguments()
-    main(args)
\ No newline at end of file
+    if args.pstats:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run, args)
+        finally:
+            profiler.dump_stats(args.pstats)
+    else:
+        run(args)
\ No newline at end of file
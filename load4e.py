@@ -1,67 +1,556 @@
 import serial
+import os
 import sys
 import argparse
 import time
 import json
 import threading
-import queue
+import socketserver
+import contextlib
+import asyncio
+import re
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'py'))
+import buildcache
+import hcxtrace
+import hexfile
+
+DEFAULT_BAUDRATE = 115200
+# tried from the fastest down by --baudrate auto
+AUTO_BAUDRATES = (921600, 460800, 230400)
+# old firmware sends nothing after 'l', so do not wait longer than this for its prompt
+READY_TIMEOUT = 0.5
+# time allowed for each reply: an acknowledgement, the final [OK], a baudrate change
+REPLY_TIMEOUT = 5.0
+NEGOTIATE_TIMEOUT = 0.3
+# bytes per record of a differential upload; an image is compared in blocks of this size
+DIFF_RECORD_LENGTH = hexfile.RECORD_LENGTH
+
+def baudrate_arg(value:str):
+    if value.lower() == "auto":
+        return "auto"
+    return int(value)
 
 def arg_parse():
     parser = argparse.ArgumentParser(description="Load binary data to HC4e via serial port.")
-    parser.add_argument("command", help="Command to execute ('load', 'register' | 'reg', 'trace').")
+    parser.add_argument("command", help="Command to execute ('load', 'verify', 'register' | 'reg', 'trace', 'capture', 'serve').")
     parser.add_argument("--file", help="Path to the intelhex file to load.")
-    parser.add_argument("--port", required=True, help="Serial port to use (e.g., COM3 or /dev/ttyUSB0).")
-    parser.add_argument("--baudrate", type=int, default=115200, help="Baud rate for serial communication.")
+    parser.add_argument("--port", action="append", default=[], help="Serial port to use (e.g., COM3 or /dev/ttyUSB0). load takes it repeated, and loads the ports at once.")
+    parser.add_argument("--all", action="store_true", help="load: load every detected serial port at once.")
+    parser.add_argument("--baudrate", type=baudrate_arg, default=DEFAULT_BAUDRATE, help="Baud rate for serial communication, or 'auto' to negotiate the fastest rate the firmware accepts.")
+    parser.add_argument("--chunk", type=int, default=256, help="Bytes written before waiting for the port to drain while loading.")
+    parser.add_argument("--window", type=int, default=0, help="Records sent ahead of the device's per-record acknowledgement (0: firmware without acknowledgements).")
+    parser.add_argument("--full", action="store_true", help="load: send the whole file even if the device holds the image last loaded through this port.")
+    parser.add_argument("--verify", action="store_true", help="load: compare the device memory with the file by CRC afterwards and send the records that differ again.")
+    parser.add_argument("--state-dir", default=None, help="load, verify: directory of the images last loaded per port (default: devices in the hcxasm cache directory).")
     parser.add_argument("-j", "--json", action="store_true", help="Output in JSON format where applicable.")
-    return parser.parse_args()
+    parser.add_argument("--output", default="trace.hxt", help="capture: trace file to write (read it with py/hcxtrace.py).")
+    parser.add_argument("--frames", type=int, default=0, help="capture: stop after this many frames (0: until Ctrl-C or --seconds).")
+    parser.add_argument("--seconds", type=float, default=0, help="capture: stop after this many seconds (0: until Ctrl-C or --frames).")
+    parser.add_argument("--ring", type=int, default=1 << 16, help="capture: frames buffered between the serial reader and the file.")
+    parser.add_argument("--summary", type=float, default=1.0, help="capture: seconds between the printed summaries.")
+    parser.add_argument("--listen", help="serve: accept JSON line requests on HOST:PORT instead of stdin/stdout.")
+    args = parser.parse_args()
+    if args.all and args.command != "load":
+        parser.error("--all is only accepted by load")
+    if not args.port and not args.all:
+        parser.error("the following arguments are required: --port")
+    if len(args.port) > 1 and args.command != "load":
+        parser.error(f"{args.command} takes one --port")
+    return args
 
 def main():
     args = arg_parse()
+    if args.command == "load" and (args.all or len(args.port) > 1):
+        load_many(args, list(dict.fromkeys(args.port + (detected_ports() if args.all else []))))
+        return
+    args.port = args.port[0]
     if args.command == "load":
         load(args)
+    elif args.command == "verify":
+        verify(args)
     elif args.command == "register" or args.command == "reg":
         register(args)
     elif args.command == "trace":
         trace(args)
+    elif args.command == "capture":
+        capture(args)
+    elif args.command == "serve":
+        serve(args)
     else:
         print(f"Unknown command: {args.command}")
         sys.exit(1)
 
-def load(args):
+def open_serial(port:str, baudrate) -> serial.Serial:
+    """Open port at baudrate, or negotiate the rate first if baudrate is "auto"."""
+    if baudrate != "auto":
+        return serial.Serial(port, baudrate, timeout=1)
+    ser = serial.Serial(port, DEFAULT_BAUDRATE, timeout=1)
+    negotiate_baudrate(ser, AUTO_BAUDRATES)
+    return ser
+
+def open_port(args) -> serial.Serial:
+    """Open --port at --baudrate; args.baudrate becomes the negotiated rate for --baudrate auto."""
+    ser = open_serial(args.port, args.baudrate)
+    args.baudrate = ser.baudrate
+    return ser
+
+def detected_ports() -> list[str]:
+    """Every serial port pyserial lists, as the editor offers them."""
+    from serial.tools import list_ports
+    return sorted(port.device for port in list_ports.comports())
+
+def read_reply(ser:serial.Serial, markers:tuple[bytes, ...], timeout:float) -> bytes:
+    """Read until one of markers has arrived or timeout seconds have passed."""
+    deadline = time.monotonic() + timeout
+    result = bytearray()
+    saved = ser.timeout
+    try:
+        while not any(marker in result for marker in markers):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            ser.timeout = remaining
+            # blocks until at least one byte arrives or the deadline passes
+            result += ser.read(max(1, ser.in_waiting))
+    finally:
+        ser.timeout = saved
+    return bytes(result)
+
+def read_registers(ser:serial.Serial) -> list[int]:
+    ser.write(b'rc\n')  # Command to read registers
+    ser.readline()  # Discard the first line (header)
+    res = ser.readline()
+    regs = list(map(int, res.decode().strip().split(',')))
+    if len(regs) != 18:
+        raise ValueError(f"[Error] Expected R0..R15, PC and INST from the device, got {len(regs)} values")
+    return regs
+
+def negotiate_baudrate(ser:serial.Serial, rates:tuple[int, ...]) -> int:
+    """
+    Ask the firmware for the fastest of rates with 'b<rate>'. The firmware answers
+    [OK] and switches, or refuses; a register read at the new rate confirms it.
+    Firmware without the command does not answer, and the port stays as it is.
+    """
+    base = ser.baudrate
+    for rate in sorted(rates, reverse=True):
+        if rate <= base:
+            break
+        ser.reset_input_buffer()
+        ser.write(f'b{rate}\n'.encode())
+        ser.flush()
+        reply = read_reply(ser, (b'\n',), NEGOTIATE_TIMEOUT)
+        if not reply:
+            break
+        if b'[OK]' not in reply:
+            continue
+        ser.baudrate = rate
+        try:
+            if len(read_registers(ser)) >= 18:
+                return rate
+        except (ValueError, UnicodeDecodeError):
+            pass
+        # the firmware goes back to the base rate when the first command after the change fails
+        ser.baudrate = base
+        ser.reset_input_buffer()
+    return base
+
+def hex_records(hex_data:bytes) -> list[bytes]:
+    return [line.strip() + b'\n' for line in hex_data.splitlines() if line.strip()]
+
+def stream_hex(ser:serial.Serial, hex_data:bytes, chunk:int=256, window:int=0, command:bytes=b'l',
+               progress:Optional[Callable[[int, int], None]]=None) -> tuple[bool, bytes]:
+    """
+    Send an Intel HEX image after the 'l' command, or after 'p' to write the
+    records over the image the device holds. Returns (success, device response).\n
+    Without a window the records go out in chunks of about chunk bytes, each
+    drained before the next one. With a window the firmware acknowledges every
+    record with one line and at most window records are in flight.
+    progress is called with (records sent, records) as they go out.
+    """
+    ser.reset_input_buffer()
+    ser.write(command + b'\n')  # Command to initiate loading
+    ser.flush()
+    response = bytearray(read_reply(ser, (b'\n',), READY_TIMEOUT))  # ready prompt
+    records = hex_records(hex_data)
+    if window > 0:
+        saved = ser.timeout
+        ser.timeout = REPLY_TIMEOUT
+        try:
+            acked = 0
+            for sent, record in enumerate(records, 1):
+                ser.write(record)
+                if progress:
+                    progress(sent, len(records))
+                while sent - acked >= window or (sent == len(records) and acked < sent):
+                    line = ser.readline()
+                    if not line:
+                        return False, bytes(response)
+                    response += line
+                    acked += 1
+                    if b'ERR' in line:
+                        return False, bytes(response)
+        finally:
+            ser.timeout = saved
+        return b'[OK]' in response, bytes(response)
+    pending = bytearray()
+    for sent, record in enumerate(records, 1):
+        pending += record
+        if len(pending) >= chunk:
+            ser.write(pending)
+            ser.flush()
+            pending.clear()
+            if progress:
+                progress(sent, len(records))
+            if ser.in_waiting:
+                response += ser.read(ser.in_waiting)
+                if b'ERR' in response:
+                    return False, bytes(response)
+    if pending:
+        ser.write(pending)
+        ser.flush()
+        if progress:
+            progress(len(records), len(records))
+    response += read_reply(ser, (b'[OK]', b'ERR'), REPLY_TIMEOUT)
+    return b'[OK]' in response, bytes(response)
+
+def state_directory() -> str:
+    """devices in the hcxasm build cache directory."""
+    return os.path.join(buildcache.default_directory(), "devices")
+
+class DeviceImage:
+    """
+    The image last loaded through a port, kept as <directory>/<port>.json with
+    the transfer rate of the last full upload, which estimates the time a
+    differential upload saved. It is forgotten while a load runs and when one fails.
+    """
+    def __init__(self, directory:str, port:str):
+        self.filename = os.path.join(directory, re.sub(r"[^0-9A-Za-z_.-]", "_", port.strip("/\\")) + ".json")
+
+    def read(self) -> Optional[tuple[bytes, float]]:
+        """(image, bytes/s of the last full upload), or None if nothing is recorded."""
+        try:
+            with open(self.filename, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            return bytes.fromhex(state["image"]), float(state["bytes_per_s"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def write(self, image:bytes, bytes_per_s:float):
+        directory = os.path.dirname(self.filename)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"image": bytes(image).hex(), "bytes_per_s": bytes_per_s}, f)
+            os.replace(tmp, self.filename)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def verified(self, image:bytes, ok:bool, baudrate:int):
+        """Record image after a verification found it on the device, forget the state if it did not."""
+        if not ok:
+            self.forget()
+            return
+        previous = self.read()
+        # without a full upload to time, the rate is estimated from 10 bits per byte
+        self.write(image, previous[1] if previous else baudrate / 10)
+
+    def forget(self):
+        try:
+            os.unlink(self.filename)
+        except FileNotFoundError:
+            pass
+
+def device_crcs(ser:serial.Serial, ranges:list[tuple[int, int]], timeout:float=REPLY_TIMEOUT) -> list[Optional[int]]:
+    """
+    CRC-32 of the device memory in each (start, end) range, asked with
+    'c<start>,<end>'. All the queries are written before the first reply is
+    read, so a list of ranges costs one round trip. None for a range the
+    firmware did not answer with [CRC].
+    """
+    ser.reset_input_buffer()
+    ser.write(b''.join(f'c{start},{end}\n'.encode() for start, end in ranges))
+    ser.flush()
+    crcs: list[Optional[int]] = []
+    reply = b''
+    deadline = time.monotonic() + timeout
+    while len(crcs) < len(ranges) and time.monotonic() < deadline:
+        reply += read_reply(ser, (b'\n',), deadline - time.monotonic())
+        lines = reply.split(b'\n')
+        reply = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                crcs.append(int(line[5:], 16) if line.startswith(b'[CRC]') else None)
+            except ValueError:
+                crcs.append(None)
+    return (crcs + [None] * len(ranges))[:len(ranges)]
+
+def device_crc(ser:serial.Serial, start:int, end:int) -> Optional[int]:
+    """CRC-32 of the device memory from start to end-1, None if the firmware does not answer it in NEGOTIATE_TIMEOUT."""
+    return device_crcs(ser, [(start, end)], NEGOTIATE_TIMEOUT)[0]
+
+def differing_records(ser:serial.Serial, image:bytes, record_length:int=DIFF_RECORD_LENGTH) -> tuple[list[tuple[int, int]], int]:
+    """
+    (regions, round trips): the record_length aligned blocks in which the
+    device memory differs from image, merged where they touch. Every range
+    whose CRC differs is split in two at a record boundary and both halves are
+    asked in the next round trip, so k bad records out of n take about
+    log2(n) + 1 round trips and 2k log2(n) checksums. Raises ValueError if
+    the firmware does not report checksums.
+    """
+    pending = [(0, len(image))] if image else []
+    regions: list[tuple[int, int]] = []
+    trips = 0
+    while pending:
+        crcs = device_crcs(ser, pending)
+        trips += 1
+        split = []
+        for (start, end), crc in zip(pending, crcs):
+            if crc is None:
+                raise ValueError(f"[Error] The device did not report the checksum of {start:04X}-{end - 1:04X}")
+            if crc == zlib.crc32(image[start:end]):
+                continue
+            if end - start <= record_length:
+                if regions and regions[-1][1] == start:
+                    regions[-1] = (regions[-1][0], end)
+                else:
+                    regions.append((start, end))
+                continue
+            middle = start + (end - start + record_length - 1) // record_length // 2 * record_length
+            split += [(start, middle), (middle, end)]
+        pending = split
+    return regions, trips
+
+def verify_image(ser:serial.Serial, image:bytes, chunk:int=256, window:int=0, repair:bool=True) -> dict:
+    """
+    Compare the device memory with image by CRC and, with repair, send the
+    records that differ with 'p' and check the whole CRC again.\n
+    Returns ok, bytes, crc, round_trips, differing (the [start, end] ranges
+    that differed), resent (bytes of records sent) and response.
+    """
+    regions, trips = differing_records(ser, image)
+    report: dict = {"bytes": len(image), "crc": f"{zlib.crc32(image):08x}", "round_trips": trips,
+                    "differing": [list(region) for region in regions], "resent": 0, "response": ""}
+    if regions and repair:
+        records = hexfile.format_intel_hex(image, regions, DIFF_RECORD_LENGTH).encode('ascii')
+        success, response = stream_hex(ser, records, chunk, window, b'p')
+        report.update(resent=len(records), response=response.decode(errors='ignore'))
+        if success:
+            crc = device_crcs(ser, [(0, len(image))])[0]
+            report["round_trips"] += 1
+            regions = [] if crc == zlib.crc32(image) else regions
+    report["ok"] = not regions
+    return report
+
+def upload(ser:serial.Serial, port:str, hex_data:bytes, chunk:int=256, window:int=0,
+           directory:Optional[str]=None, full:bool=False, image:Optional[bytes]=None,
+           progress:Optional[Callable[[int, int], None]]=None) -> dict:
+    """
+    Load a checked Intel HEX file. If the image last loaded through port is
+    recorded and the device reports its CRC, only the DIFF_RECORD_LENGTH byte
+    records that differ from it are sent with 'p', then the end of file record;
+    otherwise the whole file is sent with 'l'.\n
+    Returns ok, mode ("differential" / "full"), reason (why it was a full
+    upload), bytes (of the file), sent, records and changed (of a differential
+    upload), seconds, bytes_per_s, saved_s (estimated time saved) and response.
+    image is the file parsed by hexfile.read_intel_hex, if the caller has it;
+    progress is passed to stream_hex.
+    """
+    if image is None:
+        image = bytes(hexfile.read_intel_hex(hex_data)[0])
+    state = DeviceImage(directory or state_directory(), port)
+    previous = None if full else state.read()
+    reason = "--full" if full else "no image recorded for this port"
+    report: dict = {"bytes": len(hex_data)}
+    t0 = time.perf_counter()
+    if previous is not None:
+        old, rate = previous
+        crc = device_crc(ser, 0, len(old))
+        # addresses beyond the shorter image are unused, 0xFF on the device
+        size = max(len(old), len(image))
+        new = image + b'\xff' * (size - len(image))
+        regions = hexfile.changed_regions(old + b'\xff' * (size - len(old)), new, DIFF_RECORD_LENGTH)
+        records = hexfile.format_intel_hex(new, regions, DIFF_RECORD_LENGTH).encode('ascii')
+        if crc is None:
+            reason = "the device does not report a checksum"
+        elif crc != zlib.crc32(old):
+            reason = "checksum mismatch, the device holds another image"
+        elif len(records) >= len(hex_data):
+            reason = "the changed records are larger than the file"
+        else:
+            state.forget()
+            success, response = stream_hex(ser, records, chunk, window, b'p', progress)
+            elapsed = time.perf_counter() - t0
+            report.update(mode="differential", sent=len(records), records=(size + DIFF_RECORD_LENGTH - 1) // DIFF_RECORD_LENGTH,
+                          changed=sum((end - start + DIFF_RECORD_LENGTH - 1) // DIFF_RECORD_LENGTH for start, end in regions),
+                          saved_s=max(0.0, len(hex_data) / rate - elapsed))
+            written = new
+    if "mode" not in report:
+        state.forget()
+        t0 = time.perf_counter()
+        success, response = stream_hex(ser, hex_data, chunk, window, progress=progress)
+        elapsed = time.perf_counter() - t0
+        report.update(mode="full", reason=reason, sent=len(hex_data), saved_s=0.0)
+        rate = len(hex_data) / elapsed
+        written = image
+    if success:
+        state.write(written, rate)
+    report.update(ok=success, seconds=elapsed, bytes_per_s=report["sent"] / elapsed if elapsed > 0 else 0.0,
+                  response=response.decode(errors='ignore'))
+    return report
+
+def read_hex_file(filename:str) -> bytes:
+    """The checked contents of an Intel HEX file; exits with a message if it is missing or malformed."""
     try:
-        with open(args.file, "rb") as f:
+        with open(filename, "rb") as f:
             hex_data = f.read()
     except FileNotFoundError:
-        print(f"Error: File '{args.file}' not found.")
+        print(f"Error: File '{filename}' not found.")
         sys.exit(1)
-    
+    # check the whole file before the board sees any of it
     try:
-        with serial.Serial(args.port, args.baudrate, timeout=1) as ser:
+        hexfile.read_intel_hex(hex_data)
+    except ValueError as e:
+        print(f"{e} in '{filename}'")
+        sys.exit(1)
+    return hex_data
+
+def print_verified(result:dict):
+    ranges = ", ".join(f"{start:04X}-{end - 1:04X}" for start, end in result["differing"])
+    if not result["differing"]:
+        print(f"[OK] The device holds the {result['bytes']} bytes (CRC-32 {result['crc']}).")
+    elif result["ok"]:
+        print(f"[OK] {ranges} differed ({result['round_trips'] - 1} round trips to find), {result['resent']} bytes sent again, the device now holds the {result['bytes']} bytes.")
+    else:
+        print(f"[Error] The device differs at {ranges} ({result['round_trips']} round trips).")
+        if result["response"]:
+            print(f"Device response: {result['response']}")
+
+def load(args):
+    hex_data = read_hex_file(args.file)
+    try:
+        with open_port(args) as ser:
             print(f"Loading data to HC4e via {args.port} at {args.baudrate} baud...")
-            ser.write(b'l\n')  # Command to initiate loading
-            time.sleep(0.5)  # Wait for device to be ready
-            ser.write(hex_data)
-            result = b""
-            while ser.in_waiting:
-                result += ser.read(ser.in_waiting)
-                time.sleep(0.1)
-            if b'[OK]' in result:
-                print("Data loaded successfully.")
-            else:
+            result = upload(ser, args.port, hex_data, args.chunk, args.window, args.state_dir, args.full)
+            if not result["ok"]:
                 print("Error: Failed to load data.")
-                print(f"Device response: {result.decode(errors='ignore')}")
+                print(f"Device response: {result['response']}")
                 sys.exit(1)
+            if result["mode"] == "differential":
+                print(f"Data loaded successfully. Differential upload: {result['changed']} of {result['records']} records changed, "
+                      f"{result['sent']} of {result['bytes']} bytes sent in {result['seconds']:.2f} s "
+                      f"({result['bytes_per_s']:.0f} bytes/s), about {result['saved_s']:.2f} s saved.")
+            else:
+                print(f"Data loaded successfully. {result['bytes']} bytes in {result['seconds']:.2f} s ({result['bytes_per_s']:.0f} bytes/s), "
+                      f"full upload: {result['reason']}.")
+            if args.verify:
+                checked = verify_image(ser, bytes(hexfile.read_intel_hex(hex_data)[0]), args.chunk, args.window)
+                print_verified(checked)
+                if not checked["ok"]:
+                    DeviceImage(args.state_dir or state_directory(), args.port).forget()
+                    sys.exit(1)
     except serial.SerialException as e:
         print(f"Serial communication error: {e}")
         sys.exit(1)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+def load_many(args, ports:list[str]):
+    """
+    Load --file into every port at once, one thread per port. The file is read
+    and parsed once and the buffers are shared; every thread opens its own port
+    and catches its own errors, so a slow or failing board holds up nobody but
+    itself. Progress lines go to stderr, the JSON summary of every port to stdout.
+    """
+    if not ports:
+        print("Error: No serial port detected.")
+        sys.exit(1)
+    hex_data = read_hex_file(args.file)
+    image = bytes(hexfile.read_intel_hex(hex_data)[0])
+    output_lock = threading.Lock()
+
+    def note(port:str, message:str):
+        with output_lock:
+            print(f"[{port}] {message}", file=sys.stderr, flush=True)
+
+    def flash(port:str) -> dict:
+        t0 = time.perf_counter()
+        result: dict = {"port": port, "ok": False}
+        shown = [0]
+
+        def progress(sent:int, total:int):
+            # a line per quarter of the records
+            if sent * 4 // total > shown[0]:
+                shown[0] = sent * 4 // total
+                note(port, f"{sent * 100 // total}% ({sent}/{total} records, {time.perf_counter() - t0:.2f} s)")
+
+        try:
+            with open_serial(port, args.baudrate) as ser:
+                result["baudrate"] = ser.baudrate
+                result.update(upload(ser, port, hex_data, args.chunk, args.window, args.state_dir, args.full, image, progress))
+                if result["ok"] and args.verify:
+                    checked = verify_image(ser, image, args.chunk, args.window)
+                    result["verify"] = {key: checked[key] for key in ("ok", "round_trips", "differing", "resent")}
+                    result["ok"] = checked["ok"]
+                    if not checked["ok"]:
+                        DeviceImage(args.state_dir or state_directory(), port).forget()
+        except (serial.SerialException, OSError, ValueError) as e:
+            result["error"] = str(e)
+        result["total_s"] = time.perf_counter() - t0
+        if result["ok"]:
+            note(port, f"passed: {result['mode']} upload, {result['sent']} bytes sent in {result['total_s']:.2f} s")
+        else:
+            note(port, f"failed after {result['total_s']:.2f} s: {result.get('error') or result.get('response', '').strip()}")
+        return result
+
+    t0 = time.perf_counter()
+    note(", ".join(ports), f"loading {args.file} ({len(hex_data)} bytes) at {args.baudrate} baud")
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        results = list(pool.map(flash, ports))
+    passed = sum(result["ok"] for result in results)
+    print(json.dumps({"ok": passed == len(results), "file": args.file, "bytes": len(hex_data), "passed": passed,
+                      "failed": len(results) - passed, "seconds": time.perf_counter() - t0, "ports": results}))
+    if passed < len(results):
+        sys.exit(1)
+
+def verify(args):
+    """Compare the device memory with --file by CRC and send the records that differ again."""
+    hex_data = read_hex_file(args.file)
+    image = bytes(hexfile.read_intel_hex(hex_data)[0])
+    try:
+        with open_port(args) as ser:
+            if not args.json:
+                print(f"Verifying {args.file} on HC4e via {args.port} at {args.baudrate} baud...")
+            result = verify_image(ser, image, args.chunk, args.window)
+    except serial.SerialException as e:
+        print(f"Serial communication error: {e}")
+        sys.exit(1)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    # a verified device holds the image, so the next load can be differential
+    DeviceImage(args.state_dir or state_directory(), args.port).verified(image, result["ok"], args.baudrate)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print_verified(result)
+    if not result["ok"]:
+        sys.exit(1)
 
 def register(args):
     try:
-        with serial.Serial(args.port, args.baudrate, timeout=1) as ser:
-            ser.write(b'rc\n')  # Command to read registers
-            ser.readline()  # Discard the first line (header)
-            res = ser.readline()
-            regs = list(map(int, res.decode().strip().split(',')))
+        with open_port(args) as ser:
+            regs = read_registers(ser)
             if args.json:
                 print(json.dumps({"regs": regs[0:16], "pc": regs[16], "inst": regs[17]}))
             else:
@@ -76,54 +565,442 @@ def register(args):
 
 def trace(args):
     try:
-        with serial.Serial(args.port, args.baudrate, timeout=1) as ser:
+        with open_port(args) as ser:
             if not args.json:
                 print(f"Tracing execution on HC4e via {args.port} at {args.baudrate} baud...")
             ser.write(b't\n')  # Command to trace execution
             ser.readline()  # Discard the first line (header)
             ser.readline()  # Discard the second line (header)
-            # 士郎、僕はね、ノンブロッキングな標準入力が欲しかったんだよ
-            q = queue.Queue()
-            worker = threading.Thread(target=tracewk, args=(args.json, ser, q))
-            worker.start()
             try:
-                while worker.is_alive():
-                    com = input()
-                    if com:
-                        q.put(com)
-                    if com.strip().lower() == 'q':
-                        break
+                stats = asyncio.run(trace_loop(ser, args.json))
             except KeyboardInterrupt:
                 print("Trace interrupted by user.")
-                q.put('q')
-            worker.join()
+                ser.write(b'q\n')
+                ser.write(b'\x03\n')  # Send Ctrl-C to stop tracing
+                return
+            print(stats.summary(), file=sys.stderr)
     except serial.SerialException as e:
         print(f"Serial communication error: {e}")
         sys.exit(1)
 
-def tracewk(jso:bool, ser:serial.Serial, q:queue.Queue):
+class LatencyStats:
+    """Keypress -> device and device -> display latency of `trace`."""
+    def __init__(self):
+        self.command = []
+        self.frame = []
+
+    @staticmethod
+    def _line(name:str, samples:list[float]) -> str:
+        if not samples:
+            return f"{name}: no samples"
+        return f"{name}: {len(samples)} samples, mean {sum(samples) / len(samples) * 1000:.3f} ms, max {max(samples) * 1000:.3f} ms"
+
+    def summary(self) -> str:
+        return "[Info] " + self._line("keypress -> device", self.command) + "; " + self._line("device -> display", self.frame)
+
+def _stream(loop:asyncio.AbstractEventLoop, fileno:Optional[int], read, cancel=None) -> tuple[asyncio.Queue, object]:
+    """
+    (arrival time, bytes) chunks of a file as an asyncio queue, b"" at end of file,
+    and a function that stops reading. On POSIX the event loop watches the
+    descriptor; elsewhere, or for a regular file the loop can not watch
+    (stdin redirected from a file), a thread blocks in read and hands each
+    chunk to the loop, and cancel wakes it up when the trace ends.
+    """
+    chunks: asyncio.Queue = asyncio.Queue()
+    if fileno is not None:
+        def ready():
+            data = read()
+            if data is None:  # woken up without data
+                return
+            if not data:
+                loop.remove_reader(fileno)
+            chunks.put_nowait((time.perf_counter(), data))
+        try:
+            loop.add_reader(fileno, ready)
+            return chunks, lambda: loop.remove_reader(fileno)
+        except OSError:  # EPERM from epoll for a regular file
+            pass
+
+    def worker():
+        while True:
+            try:
+                data = read()
+            except (OSError, serial.SerialException):
+                data = b""
+            if data is None:
+                continue
+            try:
+                loop.call_soon_threadsafe(chunks.put_nowait, (time.perf_counter(), data))
+            except RuntimeError:  # the loop has finished
+                return
+            if not data:
+                return
+    threading.Thread(target=worker, daemon=True).start()
+    return chunks, cancel or (lambda: None)
+
+async def trace_loop(ser:serial.Serial, jso:bool) -> LatencyStats:
+    """Print frames as they arrive and send typed commands at once, until 'q' or the end of stdin."""
+    loop = asyncio.get_running_loop()
+    stats = LatencyStats()
+    if os.name == 'posix':
+        ser.timeout = 0
+        device, stop_device = _stream(loop, ser.fileno(), lambda: ser.read(ser.in_waiting or 1) or None)
+        stdin_fd = sys.stdin.fileno()
+        keyboard, stop_keyboard = _stream(loop, stdin_fd, lambda: os.read(stdin_fd, 1024))
+    else:
+        ser.timeout = None
+        device, stop_device = _stream(loop, None, lambda: ser.read(max(1, ser.in_waiting)) or None, ser.cancel_read)
+        keyboard, stop_keyboard = _stream(loop, None, sys.stdin.buffer.readline)
+
+    async def frames():
+        rest = b""
+        while True:
+            arrived, data = await device.get()
+            if not data:
+                return
+            lines = (rest + data).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    regs = list(map(int, line.decode().strip().split(',')))
+                except ValueError:
+                    continue
+                if jso:
+                    print(json.dumps({"regs": regs[0:16], "pc": regs[16], "inst": regs[17]}))
+                else:
+                    for i in range(16):
+                        print(f"R{i}: {regs[i]}", end='  ')
+                    print()
+                    print(f"PC: {regs[16]}, INST: {regs[17]}")
+            sys.stdout.flush()
+            stats.frame.append(time.perf_counter() - arrived)
+
+    printer = asyncio.create_task(frames())
     try:
+        rest = b""
         while True:
-            res = ser.readline()
-            if not q.empty():
-                com = q.get()
+            typed, data = await keyboard.get()
+            # end of stdin quits, as 'q' does
+            lines = (rest + data).split(b"\n") if data else [rest, b"q", b""]
+            rest = lines.pop()
+            for line in lines:
+                com = line.decode(errors='ignore').strip()
+                if not com:
+                    continue
                 ser.write(com.encode() + b'\n')
-                if com.strip().lower() == 'q':
-                    break
-            
-            if not res:
+                stats.command.append(time.perf_counter() - typed)
+                if com.lower() == 'q':
+                    ser.write(b'\x03\n')  # Send Ctrl-C to stop tracing
+                    return stats
+    finally:
+        printer.cancel()
+        stop_device()
+        stop_keyboard()
+
+def capture(args):
+    """
+    Record the trace into a file. A reader thread parses the raw bytes in bulk into
+    a ring buffer; the main thread writes it out and prints one frame per --summary.
+    """
+    try:
+        with open_port(args) as ser:
+            ser.write(b't\n')  # Command to trace execution
+            ser.readline()  # Discard the first line (header)
+            ser.readline()  # Discard the second line (header)
+            ring = hcxtrace.TraceRing(args.ring)
+            parser = hcxtrace.FrameParser()
+            stop = threading.Event()
+
+            def reader():
+                ser.timeout = 0.05
+                while not stop.is_set():
+                    data = ser.read(max(1, ser.in_waiting))
+                    if data:
+                        ring.push(parser.feed(data))
+
+            worker = threading.Thread(target=reader, daemon=True)
+            worker.start()
+            print(f"Capturing trace from {args.port} at {args.baudrate} baud into {args.output}...", flush=True)
+            t0 = time.perf_counter()
+            next_summary = t0 + args.summary
+            with hcxtrace.TraceWriter(args.output) as writer:
+
+                def flush():
+                    values = ring.drain()
+                    if args.frames:
+                        values = values[:(args.frames - writer.frames) * hcxtrace.FIELDS]
+                    writer.write(values)
+                    return values
+
+                try:
+                    while not (args.frames and writer.frames >= args.frames) and not (args.seconds and time.perf_counter() - t0 >= args.seconds):
+                        time.sleep(0.02)
+                        values = flush()
+                        now = time.perf_counter()
+                        if now >= next_summary and values:
+                            next_summary = now + args.summary
+                            regs = values[-hcxtrace.FIELDS:]
+                            print(f"[{now - t0:7.1f} s] {writer.frames} frames ({writer.frames / (now - t0):.0f}/s), {ring.dropped} dropped  "
+                                  f"PC: {regs[16]} INST: {regs[17]}  " + " ".join(str(r) for r in regs[:16]), flush=True)
+                except KeyboardInterrupt:
+                    print("Capture interrupted by user.")
+                finally:
+                    stop.set()
+                    worker.join()
+                    ser.write(b'q\n')
+                    ser.write(b'\x03\n')  # Send Ctrl-C to stop tracing
+                    flush()
+            elapsed = time.perf_counter() - t0
+            print(f"[Info] {writer.frames} frames in {elapsed:.2f} s ({writer.frames / elapsed:.0f} frames/s), "
+                  f"{ring.dropped} dropped, {parser.skipped} lines skipped, written to {args.output}.")
+    except serial.SerialException as e:
+        print(f"Serial communication error: {e}")
+        sys.exit(1)
+
+def parse_frame(line:bytes) -> dict:
+    regs = list(map(int, line.decode().strip().split(',')))
+    return {"regs": regs[0:16], "pc": regs[16], "inst": regs[17]}
+
+class Client:
+    """One connection of `serve`. Responses and trace frames are written from different threads."""
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+
+    def send(self, message:dict) -> bool:
+        with self.lock:
+            try:
+                self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except (OSError, ValueError):
+                return False
+        return True
+
+class DeviceSession:
+    """
+    The open port of `serve`. One lock serializes every exchange with the device;
+    a running trace is stopped for a load or register read and started again
+    afterwards, and its frames go to every subscribed client. The subscriber
+    list has a lock of its own: the trace thread drops clients that went away
+    while the device lock is held by _end_trace waiting for it.
+    """
+    def __init__(self, ser:serial.Serial, chunk:int=256, window:int=0, state_dir:Optional[str]=None):
+        self.ser = ser
+        self.chunk = chunk
+        self.window = window
+        self.state_dir = state_dir
+        self.lock = threading.Lock()
+        self.subscribers: list[Client] = []
+        self._subscribers_lock = threading.Lock()
+        self._trace_thread: Optional[threading.Thread] = None
+        self._trace_stop = threading.Event()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self.lock:
+            tracing = self._trace_thread is not None
+            if tracing:
+                self._end_trace()
+            try:
+                yield self.ser
+            finally:
+                if tracing and self.subscribers:
+                    self._begin_trace()
+
+    def load(self, hex_data:bytes, chunk:Optional[int]=None, window:Optional[int]=None, full:bool=False) -> dict:
+        hexfile.read_intel_hex(hex_data)
+        with self.exclusive() as ser:
+            return upload(ser, ser.port, hex_data, chunk or self.chunk, self.window if window is None else window,
+                          self.state_dir, full)
+
+    def verify(self, hex_data:bytes, chunk:Optional[int]=None, window:Optional[int]=None) -> dict:
+        image = bytes(hexfile.read_intel_hex(hex_data)[0])
+        with self.exclusive() as ser:
+            result = verify_image(ser, image, chunk or self.chunk, self.window if window is None else window)
+            DeviceImage(self.state_dir or state_directory(), ser.port).verified(image, result["ok"], ser.baudrate)
+        return result
+
+    def registers(self) -> dict:
+        with self.exclusive() as ser:
+            regs = read_registers(ser)
+        return {"regs": regs[0:16], "pc": regs[16], "inst": regs[17]}
+
+    def subscribe(self, client:Client):
+        with self.lock:
+            with self._subscribers_lock:
+                if client not in self.subscribers:
+                    self.subscribers.append(client)
+            if self._trace_thread is None:
+                self._begin_trace()
+
+    def unsubscribe(self, client:Client):
+        with self.lock:
+            with self._subscribers_lock:
+                if client in self.subscribers:
+                    self.subscribers.remove(client)
+            if not self.subscribers and self._trace_thread is not None:
+                self._end_trace()
+
+    def trace_command(self, command:str):
+        """Forward a command line to the firmware while tracing, as typed into `trace`."""
+        with self.lock:
+            self.ser.write(command.encode() + b'\n')
+
+    def _begin_trace(self):
+        self.ser.write(b't\n')  # Command to trace execution
+        self.ser.readline()  # Discard the first line (header)
+        self.ser.readline()  # Discard the second line (header)
+        self._trace_stop.clear()
+        self._trace_thread = threading.Thread(target=self._trace_worker, daemon=True)
+        self._trace_thread.start()
+
+    def _end_trace(self):
+        assert self._trace_thread is not None
+        self._trace_stop.set()
+        self._trace_thread.join()
+        self._trace_thread = None
+        self.ser.write(b'q\n')
+        self.ser.write(b'\x03\n')  # Send Ctrl-C to stop tracing
+        # drop the frames that were on their way
+        saved = self.ser.timeout
+        self.ser.timeout = 0.05
+        while self.ser.read(4096):
+            pass
+        self.ser.timeout = saved
+
+    def _trace_worker(self):
+        saved = self.ser.timeout
+        self.ser.timeout = 0.05
+        try:
+            while not self._trace_stop.is_set():
+                line = self.ser.readline()
+                if not line.strip():
+                    continue
+                try:
+                    message = {"op": "trace", "frame": parse_frame(line)}
+                except (ValueError, IndexError, UnicodeDecodeError):
+                    continue
+                with self._subscribers_lock:
+                    clients = list(self.subscribers)
+                for client in clients:
+                    if not client.send(message):
+                        with self._subscribers_lock:
+                            if client in self.subscribers:
+                                self.subscribers.remove(client)
+        except serial.SerialException as e:
+            with self._subscribers_lock:
+                clients = list(self.subscribers)
+            for client in clients:
+                client.send({"op": "trace", "error": f"[Error] Serial communication error during tracing: {e}"})
+        finally:
+            self.ser.timeout = saved
+
+def handle_request(request:dict, session:DeviceSession, client:Client) -> dict:
+    """
+    Handle a single `serve` request.
+    Request fields:
+        op (str): "ping", "load", "verify", "register", "trace" or "shutdown".
+        id: Echoed back unchanged so that clients can pipeline requests.
+        file (str) / hex (str): load, verify: Intel HEX file to load or compare, or its contents.
+        chunk (int), window (int), full (bool): load: as --chunk / --window / --full.
+        action (str): trace: "start" subscribes this client to {"op": "trace", "frame": ...}
+            messages, "stop" unsubscribes, "send" forwards command to the firmware.
+    """
+    op = request.get('op')
+    response: dict = {'id': request.get('id'), 'op': op}
+    start = time.perf_counter()
+    try:
+        if op in ('ping', 'shutdown'):
+            response['ok'] = True
+        elif op in ('load', 'verify'):
+            if 'hex' in request:
+                if not isinstance(request['hex'], str):
+                    raise ValueError("[Error] hex must be the Intel HEX text as a string")
+                hex_data = request['hex'].encode('ascii')
+            else:
+                if not isinstance(request.get('file'), str):
+                    raise ValueError("[Error] load and verify need hex or file as a string")
+                with open(request['file'], 'rb') as f:
+                    hex_data = f.read()
+            if op == 'load':
+                response.update(session.load(hex_data, request.get('chunk'), request.get('window'), bool(request.get('full'))))
+            else:
+                response.update(session.verify(hex_data, request.get('chunk'), request.get('window')))
+        elif op in ('register', 'reg'):
+            response['ok'] = True
+            response['registers'] = session.registers()
+        elif op == 'trace':
+            action = request.get('action', 'start')
+            if action == 'start':
+                session.subscribe(client)
+            elif action == 'stop':
+                session.unsubscribe(client)
+            elif action == 'send':
+                session.trace_command(str(request.get('command', '')))
+            else:
+                raise ValueError(f"[Error] Unknown trace action: {action}")
+            response['ok'] = True
+        else:
+            raise ValueError(f"[Error] Unknown op: {op}")
+    except (OSError, KeyError, ValueError, TypeError, AttributeError, IndexError, serial.SerialException) as e:
+        response['ok'] = False
+        response['error'] = str(e.args[0] if isinstance(e, KeyError) and e.args else e)
+    response['timing'] = {'total_ms': (time.perf_counter() - start) * 1000}
+    return response
+
+def serve_stream(rfile, wfile, session:DeviceSession) -> bool:
+    """
+    Serve line-delimited JSON requests from a binary stream until EOF.
+    Returns True when a shutdown request was received.
+    """
+    client = Client(wfile)
+    try:
+        for raw in rfile:
+            if not raw.strip():
                 continue
-            regs = list(map(int, res.decode().strip().split(',')))
-            if jso:
-                print(json.dumps({"regs": regs[0:16], "pc": regs[16], "inst": regs[17]}))
+            try:
+                request = json.loads(raw)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be a JSON object")
+            except ValueError as e:
+                response = {'id': None, 'ok': False, 'error': f"[Error] Invalid request: {e}"}
             else:
-                for i in range(16):
-                    print(f"R{i}: {regs[i]}", end='  ')
-                print()
-                print(f"PC: {regs[16]}, INST: {regs[17]}")
-        ser.write(b'\x03\n')  # Send Ctrl-C to stop tracing
+                response = handle_request(request, session, client)
+            client.send(response)
+            if response.get('op') == 'shutdown':
+                return True
+        return False
+    finally:
+        session.unsubscribe(client)
+
+def serve(args):
+    """Keep the port open and take load / register / trace requests as JSON lines on stdin/stdout or a local TCP port."""
+    try:
+        ser = open_port(args)
     except serial.SerialException as e:
-        print(f"Serial communication error during tracing: {e}")
+        print(f"Serial communication error: {e}", file=sys.stderr)
+        sys.exit(1)
+    with ser:
+        session = DeviceSession(ser, args.chunk, args.window, args.state_dir)
+        if not args.listen:
+            print(f"[Info] load4e session on {args.port} at {args.baudrate} baud ready on stdin/stdout.", file=sys.stderr, flush=True)
+            serve_stream(sys.stdin.buffer, sys.stdout.buffer, session)
+            return
+
+        host, _, port = args.listen.rpartition(':')
+        host = host or '127.0.0.1'
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                if serve_stream(self.rfile, self.wfile, session):
+                    threading.Thread(target=server.shutdown, daemon=True).start()
+
+        with socketserver.ThreadingTCPServer((host, int(port)), Handler) as server:
+            server.daemon_threads = True
+            print(f"[Info] load4e session on {args.port} listening on {host}:{server.server_address[1]}.", file=sys.stderr, flush=True)
+            server.serve_forever()
 
 
 if __name__ == "__main__":
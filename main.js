@@ -9,8 +9,8 @@ const { spawn, spawnSync } = require('child_process');
 let availablePorts = [];
 let selectedComPort = null;
 
-// トレースプロセス管理
-let traceProcess = null;
+// トレース状態（フレームは load4e.py serve から届く）
+let traceActive = false;
 let traceTarget = null; // WebContents
 
 // 未保存状態の管理（webContents.id -> boolean）
@@ -26,6 +26,176 @@ let pythonEnvStatus = 'idle'; // idle | preparing | ready | failed
 let pythonEnvError = null;
 let pythonEnvPromise = null;
 
+// アセンブラ常駐プロセス（hcxasm.py --serve）
+let assemblerDaemon = null;
+
+function getAssemblerDaemon(pythonCmd, hcxasmPath) {
+  if (assemblerDaemon && assemblerDaemon.pythonCmd === pythonCmd && !assemblerDaemon.exited) {
+    return assemblerDaemon;
+  }
+  const proc = spawn(pythonCmd, [hcxasmPath, '--serve'], {
+    cwd: path.dirname(hcxasmPath),
+    windowsHide: true,
+    env: { ...process.env, PYTHONIOENCODING: 'utf-8' }
+  });
+  const daemon = { proc, pythonCmd, pending: new Map(), nextId: 1, buffer: '', stderr: '', exited: false };
+
+  proc.stdout.on('data', (data) => {
+    daemon.buffer += data.toString('utf8');
+    let idx;
+    while ((idx = daemon.buffer.indexOf('\n')) >= 0) {
+      const line = daemon.buffer.slice(0, idx);
+      daemon.buffer = daemon.buffer.slice(idx + 1);
+      if (!line.trim()) continue;
+      let response;
+      try {
+        response = JSON.parse(line);
+      } catch (e) {
+        continue;
+      }
+      const waiter = daemon.pending.get(response.id);
+      if (waiter) {
+        daemon.pending.delete(response.id);
+        waiter.resolve(response);
+      }
+    }
+  });
+  proc.stderr.on('data', (data) => {
+    // 直近の出力だけを保持（エラー報告用）
+    daemon.stderr = (daemon.stderr + data.toString('utf8')).slice(-4096);
+  });
+  const fail = (err) => {
+    daemon.exited = true;
+    for (const waiter of daemon.pending.values()) {
+      waiter.reject(err);
+    }
+    daemon.pending.clear();
+    if (assemblerDaemon === daemon) assemblerDaemon = null;
+  };
+  proc.on('error', fail);
+  proc.on('close', (code) => fail(new Error(`アセンブラプロセスが終了しました (code ${code})\n${daemon.stderr}`)));
+
+  assemblerDaemon = daemon;
+  return daemon;
+}
+
+// アセンブラのプロファイル結果（--serve の profile 応答）をアップロードログ用の行に整形
+function formatProfile(profile) {
+  const ms = v => `${v.toFixed(2)} ms`;
+  const lines = ['Assembler profile: ' + profile.stages.map(s => `${s.name} ${ms(s.ms)}`).join(', ')];
+  for (const inc of profile.includes) {
+    lines.push(`  include ${inc.file}: ${ms(inc.ms)} (${inc.calls} calls, ${inc.cache_hits} cached, ${inc.lines} lines)`);
+  }
+  if (profile.macros.length) {
+    lines.push('  macros: ' + profile.macros.map(m => `${m.name} x${m.calls} ${ms(m.ms)}`).join(', '));
+  }
+  if (profile.defines.length) {
+    lines.push('  defines: ' + profile.defines.map(d => `${d.name} x${d.uses} ${ms(d.ms)}`).join(', '));
+  }
+  return lines.join('\n');
+}
+
+function requestDaemon(daemon, request) {
+  return new Promise((resolve, reject) => {
+    const id = daemon.nextId++;
+    daemon.pending.set(id, { resolve, reject });
+    daemon.proc.stdin.write(JSON.stringify({ ...request, id }) + '\n');
+  });
+}
+
+function stopAssemblerDaemon() {
+  if (assemblerDaemon && !assemblerDaemon.exited) {
+    try { assemblerDaemon.proc.stdin.end(); } catch (_) {}
+  }
+  assemblerDaemon = null;
+}
+
+// デバイス常駐プロセス（load4e.py serve）：ポートを開いたまま load / register / trace を受け付ける
+let deviceDaemon = null;
+
+function getDeviceDaemon(pythonCmd, loaderPath, port) {
+  if (deviceDaemon && deviceDaemon.pythonCmd === pythonCmd && deviceDaemon.port === port && !deviceDaemon.exited) {
+    return deviceDaemon;
+  }
+  stopDeviceDaemon();
+  const proc = spawn(pythonCmd, [loaderPath, 'serve', '--port', port], {
+    cwd: path.dirname(loaderPath),
+    windowsHide: true,
+    env: { ...process.env, PYTHONIOENCODING: 'utf-8', PYTHONUNBUFFERED: '1' }
+  });
+  const daemon = { proc, pythonCmd, port, pending: new Map(), nextId: 1, buffer: '', stderr: '', exited: false };
+
+  proc.stdout.on('data', (data) => {
+    daemon.buffer += data.toString('utf8');
+    let idx;
+    while ((idx = daemon.buffer.indexOf('\n')) >= 0) {
+      const line = daemon.buffer.slice(0, idx);
+      daemon.buffer = daemon.buffer.slice(idx + 1);
+      if (!line.trim()) continue;
+      let message;
+      try {
+        message = JSON.parse(line);
+      } catch (e) {
+        continue;
+      }
+      // id のないトレースフレーム
+      if (message.op === 'trace' && message.id === undefined) {
+        if (traceTarget && !traceTarget.isDestroyed()) {
+          if (message.frame) {
+            traceTarget.send('trace-update', message.frame);
+          } else if (message.error) {
+            traceTarget.send('trace-error', message.error);
+          }
+        }
+        continue;
+      }
+      const waiter = daemon.pending.get(message.id);
+      if (waiter) {
+        daemon.pending.delete(message.id);
+        waiter.resolve(message);
+      }
+    }
+  });
+  proc.stderr.on('data', (data) => {
+    daemon.stderr = (daemon.stderr + data.toString('utf8')).slice(-4096);
+  });
+  const fail = (err) => {
+    daemon.exited = true;
+    for (const waiter of daemon.pending.values()) {
+      waiter.reject(err);
+    }
+    daemon.pending.clear();
+    if (deviceDaemon === daemon) {
+      deviceDaemon = null;
+      if (traceActive) {
+        traceActive = false;
+        if (traceTarget && !traceTarget.isDestroyed()) {
+          traceTarget.send('trace-stopped', { error: err.message });
+        }
+        traceTarget = null;
+      }
+    }
+  };
+  proc.on('error', fail);
+  proc.on('close', (code) => fail(new Error(`load4e.py が終了しました (code ${code})\n${daemon.stderr}`)));
+
+  deviceDaemon = daemon;
+  return daemon;
+}
+
+function stopDeviceDaemon() {
+  if (deviceDaemon && !deviceDaemon.exited) {
+    try { deviceDaemon.proc.stdin.end(); } catch (_) {}
+  }
+  deviceDaemon = null;
+}
+
+function getLoaderPath() {
+  return app.isPackaged
+    ? path.join(process.resourcesPath, 'app.asar.unpacked', 'load4e.py')
+    : path.join(__dirname, 'load4e.py');
+}
+
 // --- Python仮想環境の用意 ---
 function getVenvPaths() {
   const venvRoot = path.join(app.getPath('userData'), 'python-venv');
@@ -584,6 +754,8 @@ app.whenReady().then(async () => {
 
 // 全てのウィンドウが閉じられたとき
 app.on('window-all-closed', () => {
+  stopAssemblerDaemon();
+  stopDeviceDaemon();
   // macOS以外では、全ウィンドウが閉じられたらアプリを終了
   if (process.platform !== 'darwin') {
     app.quit();
@@ -616,74 +788,65 @@ ipcMain.handle('upload-to-device', async (event, assemblyCode, architecture) =>
       return { success: false, error: 'Pythonランタイムが見つかりません。Python 3.x をインストールしてください。' };
     }
 
-    const tmpDir = app.getPath('temp');
     const logs = [];
     const fmtCmd = (cmd, args) => {
       const quote = s => (typeof s === 'string' && s.includes(' ')) ? `"${s}"` : `${s}`;
       return [quote(cmd), ...args.map(quote)].join(' ');
     };
 
-    const asmPath = path.join(tmpDir, `va_${Date.now()}.asm`);
-    const hexPath = path.join(tmpDir, `va_${Date.now()}.hex`);
-    fs.writeFileSync(asmPath, assemblyCode, 'utf8');
-
-    // 1) アセンブル（ihex）
+    // 1) アセンブル（常駐プロセスに ihex を要求）
     const hcxasmPath = app.isPackaged
       ? path.join(process.resourcesPath, 'app.asar.unpacked', 'hcxasm.py')
       : path.join(__dirname, 'hcxasm.py');
     if (!fs.existsSync(hcxasmPath)) {
-      try { fs.unlinkSync(asmPath); } catch (_) {}
       return { success: false, error: 'hcxasm.py が見つかりません。' };
     }
 
     const archArg = (architecture === 'HC4E') ? 'HC4E' : 'HC4';
-    const assembleArgs = [hcxasmPath, asmPath, '-o', hexPath, '-f', 'ihex', '-a', archArg, '-v'];
-    logs.push('Assembler command: ' + fmtCmd(pythonCmd, assembleArgs));
-    const asmProc = spawnSync(pythonCmd, assembleArgs, {
-      cwd: path.dirname(hcxasmPath),
-      windowsHide: true,
-      encoding: 'utf8',
-      env: { ...process.env, PYTHONIOENCODING: 'utf-8' }
-    });
-    logs.push('Assembler exit code: ' + asmProc.status);
-    if (asmProc.stdout) logs.push('Assembler stdout:\n' + asmProc.stdout.trim());
-    if (asmProc.stderr) logs.push('Assembler stderr:\n' + asmProc.stderr.trim());
-    if (asmProc.status !== 0) {
-      try { fs.unlinkSync(asmPath); } catch (_) {}
-      return { success: false, error: `アセンブル失敗:\n${asmProc.stderr || asmProc.stdout || 'unknown error'}`, logs };
+    logs.push('Assembler daemon: ' + fmtCmd(pythonCmd, [hcxasmPath, '--serve']));
+    let asmResult;
+    try {
+      asmResult = await requestDaemon(getAssemblerDaemon(pythonCmd, hcxasmPath), {
+        source: assemblyCode,
+        arch: archArg,
+        formats: ['ihex'],
+        session: 'editor',
+        profile: true
+      });
+    } catch (e) {
+      return { success: false, error: `アセンブル失敗:\n${e.message}`, logs };
     }
+    if (!asmResult.ok) {
+      const messages = (asmResult.diagnostics || []).map(d => d.message).join('\n');
+      logs.push('Assembler diagnostics:\n' + messages);
+      return { success: false, error: `アセンブル失敗:\n${messages || 'unknown error'}`, logs };
+    }
+    logs.push(`Assembler: ${asmResult.lines} lines -> ${asmResult.size} bytes (${asmResult.timing.total_ms.toFixed(2)} ms${asmResult.cached ? ', build cache' : ''})`);
+    if (asmResult.profile) logs.push(formatProfile(asmResult.profile));
 
-    // 2) アップロード（load4e.py）
-    const loaderPath = app.isPackaged
-      ? path.join(process.resourcesPath, 'app.asar.unpacked', 'load4e.py')
-      : path.join(__dirname, 'load4e.py');
+    // 2) アップロード（ポートを開いたままの load4e.py serve に ihex を渡す）
+    const loaderPath = getLoaderPath();
     if (!fs.existsSync(loaderPath)) {
-      try { fs.unlinkSync(asmPath); } catch (_) {}
-      try { fs.unlinkSync(hexPath); } catch (_) {}
       return { success: false, error: 'load4e.py が見つかりません。' };
     }
     const port = selectedComPort.device;
-    const loadArgs = [loaderPath, 'load', '--file', hexPath, '--port', port];
-    logs.push('Loader command: ' + fmtCmd(pythonCmd, loadArgs));
-    const loadProc = spawnSync(pythonCmd, loadArgs, {
-      cwd: path.dirname(loaderPath),
-      windowsHide: true,
-      encoding: 'utf8',
-      env: { ...process.env, PYTHONIOENCODING: 'utf-8' }
-    });
-    logs.push('Loader exit code: ' + loadProc.status);
-    if (loadProc.stdout) logs.push('Loader stdout:\n' + loadProc.stdout.trim());
-    if (loadProc.stderr) logs.push('Loader stderr:\n' + loadProc.stderr.trim());
-
-    // 後始末
-    try { fs.unlinkSync(asmPath); } catch (_) {}
-    try { fs.unlinkSync(hexPath); } catch (_) {}
-
-    if (loadProc.status !== 0) {
-      return { success: false, error: `書き込み失敗:\n${loadProc.stderr || loadProc.stdout || 'unknown error'}`, logs };
+    logs.push('Loader daemon: ' + fmtCmd(pythonCmd, [loaderPath, 'serve', '--port', port]));
+    let loadResult;
+    try {
+      loadResult = await requestDaemon(getDeviceDaemon(pythonCmd, loaderPath, port), { op: 'load', hex: asmResult.outputs.ihex });
+    } catch (e) {
+      return { success: false, error: `書き込み失敗:\n${e.message}`, logs };
     }
-
-    return { success: true, output: loadProc.stdout || '', logs };
+    if (loadResult.response) logs.push('Device response:\n' + loadResult.response.trim());
+    if (!loadResult.ok) {
+      return { success: false, error: `書き込み失敗:\n${loadResult.error || loadResult.response || 'unknown error'}`, logs };
+    }
+    const transfer = loadResult.mode === 'differential'
+      ? `${loadResult.changed}/${loadResult.records} records changed, ${loadResult.sent} of ${loadResult.bytes} bytes sent, about ${loadResult.saved_s.toFixed(2)} s saved`
+      : `${loadResult.bytes} bytes, full upload: ${loadResult.reason}`;
+    const output = `Data loaded successfully. ${transfer} (${Math.round(loadResult.bytes_per_s)} bytes/s, ${loadResult.timing.total_ms.toFixed(1)} ms).`;
+    logs.push('Loader: ' + output);
+    return { success: true, output, logs };
   } catch (e) {
     return { success: false, error: e.message };
   }
@@ -728,31 +891,16 @@ ipcMain.handle('fetch-registers', async () => {
       return { success: false, error: 'Pythonランタイムが見つかりません。Python 3.x をインストールしてください。' };
     }
 
-    const loaderPath = app.isPackaged
-      ? path.join(process.resourcesPath, 'app.asar.unpacked', 'load4e.py')
-      : path.join(__dirname, 'load4e.py');
+    const loaderPath = getLoaderPath();
     if (!fs.existsSync(loaderPath)) {
       return { success: false, error: 'load4e.py が見つかりません。' };
     }
 
-    const args = [loaderPath, 'register', '--json', '--port', selectedComPort.device];
-    const r = spawnSync(pythonCmd, args, {
-      cwd: path.dirname(loaderPath),
-      windowsHide: true,
-      encoding: 'utf8',
-      env: { ...process.env, PYTHONIOENCODING: 'utf-8' }
-    });
-
-    if (r.status !== 0) {
-      return { success: false, error: (r.stderr || r.stdout || 'register 実行に失敗しました') };
+    const r = await requestDaemon(getDeviceDaemon(pythonCmd, loaderPath, selectedComPort.device), { op: 'register' });
+    if (!r.ok) {
+      return { success: false, error: r.error || 'register 実行に失敗しました' };
     }
-    let data = null;
-    try {
-      data = JSON.parse(r.stdout || '{}');
-    } catch (e) {
-      return { success: false, error: 'JSON解析に失敗しました: ' + e.message, raw: r.stdout };
-    }
-    return { success: true, data };
+    return { success: true, data: r.registers };
   } catch (e) {
     return { success: false, error: e.message };
   }
@@ -768,7 +916,7 @@ ipcMain.handle('start-trace', async (event) => {
       return { success: false, error: pythonEnvError || 'Python環境準備に失敗しました。' };
     }
 
-    if (traceProcess) {
+    if (traceActive) {
       return { success: true, alreadyRunning: true };
     }
     if (!selectedComPort || !selectedComPort.device) {
@@ -786,76 +934,25 @@ ipcMain.handle('start-trace', async (event) => {
       return { success: false, error: 'Pythonランタイムが見つかりません。Python 3.x をインストールしてください。' };
     }
 
-    const loaderPath = app.isPackaged
-      ? path.join(process.resourcesPath, 'app.asar.unpacked', 'load4e.py')
-      : path.join(__dirname, 'load4e.py');
+    const loaderPath = getLoaderPath();
     if (!fs.existsSync(loaderPath)) {
       return { success: false, error: 'load4e.py が見つかりません。' };
     }
 
-    // CLI 実行と同じ形: load4e.py trace --port COMxx -j
-    const args = [loaderPath, 'trace', '--port', selectedComPort.device, '-j'];
-    const proc = spawn(pythonCmd, args, {
-      cwd: path.dirname(loaderPath),
-      windowsHide: true,
-      env: { ...process.env, PYTHONIOENCODING: 'utf-8', PYTHONUNBUFFERED: '1' }
-    });
-
-    if (proc.stdout && proc.stdout.setEncoding) {
-      proc.stdout.setEncoding('utf8');
-    }
-    if (proc.stderr && proc.stderr.setEncoding) {
-      proc.stderr.setEncoding('utf8');
-    }
-
-    traceProcess = proc;
+    // 同じ load4e.py serve からフレームが届く（register 読み出し中は一時停止して再開される）
+    const daemon = getDeviceDaemon(pythonCmd, loaderPath, selectedComPort.device);
     traceTarget = event.sender;
-
-    let buffer = '';
-    proc.stdout.on('data', (data) => {
-      buffer += data.toString();
-      const lines = buffer.split(/\r?\n/);
-      buffer = lines.pop() || '';
-      for (const line of lines) {
-        if (!line.trim()) continue;
-        try {
-          const obj = JSON.parse(line);
-          if (traceTarget && !traceTarget.isDestroyed()) {
-            traceTarget.send('trace-update', obj);
-          }
-        } catch (e) {
-          if (traceTarget && !traceTarget.isDestroyed()) {
-            traceTarget.send('trace-error', 'JSON parse error: ' + e.message);
-          }
-        }
-      }
-    });
-
-    proc.stderr.on('data', (data) => {
-      const msg = data.toString();
-      if (traceTarget && !traceTarget.isDestroyed()) {
-        traceTarget.send('trace-error', msg);
-      }
-    });
-
-    const cleanup = (info) => {
-      traceProcess = null;
-      if (traceTarget && !traceTarget.isDestroyed()) {
-        traceTarget.send('trace-stopped', info);
-      }
+    traceActive = true;
+    const r = await requestDaemon(daemon, { op: 'trace', action: 'start' });
+    if (!r.ok) {
+      traceActive = false;
       traceTarget = null;
-    };
-
-    proc.on('close', (code, signal) => {
-      cleanup({ code, signal });
-    });
-
-    proc.on('error', (err) => {
-      cleanup({ error: err.message });
-    });
-
+      return { success: false, error: r.error || 'trace 開始に失敗しました' };
+    }
     return { success: true };
   } catch (e) {
+    traceActive = false;
+    traceTarget = null;
     return { success: false, error: e.message };
   }
 });
@@ -863,25 +960,17 @@ ipcMain.handle('start-trace', async (event) => {
 // トレース停止
 ipcMain.handle('stop-trace', async () => {
   try {
-    if (!traceProcess) {
+    if (!traceActive) {
       return { success: true, alreadyStopped: true };
     }
-    try {
-      // 終了要求として標準入力に "q\n" を送る
-      if (traceProcess.stdin && !traceProcess.stdin.destroyed) {
-        traceProcess.stdin.write('q\n', 'utf8', () => {
-          try {
-            traceProcess.stdin.end();
-          } catch (e) {
-            // ignore
-          }
-        });
-      } else {
-        // stdin が使えない場合のフォールバック
-        traceProcess.kill();
-      }
-    } catch (e) {
-      // ignore
+    traceActive = false;
+    const target = traceTarget;
+    traceTarget = null;
+    if (deviceDaemon && !deviceDaemon.exited) {
+      await requestDaemon(deviceDaemon, { op: 'trace', action: 'stop' });
+    }
+    if (target && !target.isDestroyed()) {
+      target.send('trace-stopped', { code: 0 });
     }
     return { success: true };
   } catch (e) {
@@ -1,6 +1,17 @@
 import re
+import os
+import hashlib
+import itertools
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from array import array
+from typing import Iterator
 from typing import Optional
 from typing import Sequence
+from typing import Iterable
 import testfuncs
 from enum import Enum, auto
 from pathlib import Path
@@ -68,17 +79,255 @@ class LinkState:
             return (addr >> (int(sliced[1]) * 4)) & 0x0F
         return None
 
+class ProcessedLines:
+    """
+    Preprocessed program, one row per line, stored as parallel columns.\n
+    Reads like the list of (line:str, lineno:int, unprocessed_line:str, address:int)
+    tuples it replaces, but line numbers and addresses live in arrays and the
+    strings are references to the source lines (the line text is the source
+    string itself when preprocessing did not change it), so a row costs 24
+    bytes plus whatever text is new instead of a tuple and two int objects.
+    Slices are ProcessedLines again; every stage reads the columns directly.
+    """
+    __slots__ = ("texts", "linenos", "sources", "addresses")
+
+    def __init__(self, rows:Iterable[tuple[str, int, str, int]]=()):
+        self.texts: list[str] = []
+        self.linenos = array('I')
+        self.sources: list[str] = []
+        self.addresses = array('I')
+        self.extend(rows)
+
+    def add(self, text:str, lineno:int, source:str, address:int):
+        self.texts.append(text)
+        self.linenos.append(lineno)
+        self.sources.append(source)
+        self.addresses.append(address)
+
+    def append(self, row:tuple[str, int, str, int]):
+        self.add(*row)
+
+    def extend(self, rows:Iterable[tuple[str, int, str, int]]):
+        if isinstance(rows, ProcessedLines):
+            self.texts += rows.texts
+            self.linenos += rows.linenos
+            self.sources += rows.sources
+            self.addresses += rows.addresses
+            return
+        for row in rows:
+            self.add(*row)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __iter__(self) -> Iterator[tuple[str, int, str, int]]:
+        return zip(self.texts, self.linenos, self.sources, self.addresses)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            part = ProcessedLines.__new__(ProcessedLines)
+            part.texts = self.texts[index]
+            part.linenos = self.linenos[index]
+            part.sources = self.sources[index]
+            part.addresses = self.addresses[index]
+            return part
+        return (self.texts[index], self.linenos[index], self.sources[index], self.addresses[index])
+
+    def __setitem__(self, index, value):
+        if not isinstance(index, slice):
+            index = slice(index, index + 1 if index != -1 else None)
+            value = (value,)
+        if not isinstance(value, ProcessedLines):
+            value = ProcessedLines(value)
+        self.texts[index] = value.texts
+        self.linenos[index] = value.linenos
+        self.sources[index] = value.sources
+        self.addresses[index] = value.addresses
+
+    def __delitem__(self, index):
+        del self.texts[index]
+        del self.linenos[index]
+        del self.sources[index]
+        del self.addresses[index]
+
+    def __add__(self, other:Iterable[tuple[str, int, str, int]]) -> "ProcessedLines":
+        joined = self[:]
+        joined.extend(other)
+        return joined
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, ProcessedLines):
+            return (self.linenos == other.linenos and self.addresses == other.addresses
+                    and self.texts == other.texts and self.sources == other.sources)
+        if isinstance(other, (list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        return f"ProcessedLines({list(self)!r})"
+
+class MachineCode:
+    """
+    Machine code of a program as parallel columns: code (array of bytes) and
+    source line number (array of uint32) per address.\n
+    The assembler places instructions at consecutive addresses from start, so
+    the address column is implicit. Reads like the dict[int, tuple[int, int]]
+    (address -> (code, lineno)) it replaces; new code is appended at the end.
+    """
+    __slots__ = ("start", "codes", "linenos")
+
+    def __init__(self, start:int=0, codes:Optional[array]=None, linenos:Optional[array]=None):
+        self.start = start
+        self.codes = codes if codes is not None else array('B')
+        self.linenos = linenos if linenos is not None else array('I')
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.codes)
+
+    def append(self, code:int, lineno:int):
+        self.codes.append(code)
+        self.linenos.append(lineno)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __contains__(self, address) -> bool:
+        return isinstance(address, int) and self.start <= address < self.start + len(self.codes)
+
+    def __getitem__(self, address:int) -> tuple[int, int]:
+        n = address - self.start
+        if not 0 <= n < len(self.codes):
+            raise KeyError(address)
+        return (self.codes[n], self.linenos[n])
+
+    def get(self, address:int, default=None):
+        return self[address] if address in self else default
+
+    def __setitem__(self, address:int, value:tuple[int, int]):
+        n = address - self.start
+        if not self.codes:
+            self.start = address
+            n = 0
+        if n == len(self.codes):
+            self.append(*value)
+        elif 0 <= n < len(self.codes):
+            self.codes[n], self.linenos[n] = value
+        else:
+            raise KeyError(f"[Error] Address {address:04X} is not next to the machine code at {self.start:04X}-{self.end:04X}")
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self.start, self.end))
+
+    def keys(self) -> range:
+        return range(self.start, self.end)
+
+    def values(self) -> list[tuple[int, int]]:
+        return list(zip(self.codes, self.linenos))
+
+    def items(self) -> list[tuple[int, tuple[int, int]]]:
+        return list(zip(range(self.start, self.end), zip(self.codes, self.linenos)))
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, MachineCode):
+            return (self.start == other.start or not self.codes) and self.codes == other.codes and self.linenos == other.linenos
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        return f"MachineCode({dict(self.items())!r})"
+
+    def bitstream(self, filler:int=255) -> list[int]:
+        return [filler] * self.start + self.codes.tolist()
+
+class Image:
+    """
+    Program image handed to the output writers: one bytearray from address 0
+    with unused addresses filled, and the (start, end) address ranges that
+    actually hold code. Writers read memoryview slices of data, so the image
+    is built once per assembly and never copied.
+    """
+    __slots__ = ("data", "regions")
+
+    def __init__(self, data:bytearray, regions:list[tuple[int, int]]):
+        self.data = data
+        self.regions = regions
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        return f"Image(bytes={len(self.data)}, regions={self.regions})"
+
+    def view(self) -> memoryview:
+        return memoryview(self.data)
+
+def build_image(adrlist:"dict[int, tuple[int, int]] | MachineCode", filler:int=255) -> Image:
+    """Image of machine code, unused addresses filled with filler."""
+    if isinstance(adrlist, MachineCode):
+        data = bytearray([filler]) * adrlist.end
+        data[adrlist.start:] = adrlist.codes
+        return Image(data, [(adrlist.start, adrlist.end)] if adrlist.codes else [])
+    if not adrlist:
+        return Image(bytearray(), [])
+    data = bytearray([filler]) * (max(adrlist) + 1)
+    regions: list[tuple[int, int]] = []
+    for addr in sorted(adrlist):
+        data[addr] = adrlist[addr][0]
+        if regions and regions[-1][1] == addr:
+            regions[-1] = (regions[-1][0], addr + 1)
+        else:
+            regions.append((addr, addr + 1))
+    return Image(data, regions)
+
+# identifiers as seen by the \b...\b boundaries of the define substitution
+IDENT_RE = re.compile(r"\w+")
+
 class Defines:
+    """
+    Scoped define table.\n
+    Substitution follows the order of items(): every define is applied once, in
+    order, so a replacement text is only rewritten again by defines that come
+    after it. Instead of one regex pass per define, each identifier is looked
+    up in a memoized table of fully expanded replacement texts that is kept in
+    step with add_def/new_scope/end_scope.
+    """
     def __init__(self, initial_defs:Optional[dict[str, str]]=None):
         self.defines: list[dict[str, str]] = [{}]
         if initial_defs is not None:
             self.defines[0] = initial_defs
         self.level = 0
+        # per level: key -> position of the key within its level
+        self._seq: list[dict[str, int]] = [{key: n for n, key in enumerate(self.defines[0])}]
+        # per level: key -> fully expanded replacement text
+        self._expanded: list[dict[str, str]] = [{}]
+        # per level: True if a key of this level also exists in a lower level
+        self._shadows: list[bool] = [False]
+        # per level: number of defines the token based substitution cannot reproduce
+        self._irregular: list[int] = [sum(1 for k, v in self.defines[0].items() if not self._is_regular(k, v))]
+        # key -> number of levels defining it, to skip undefined identifiers quickly
+        self._counts: dict[str, int] = dict.fromkeys(self.defines[0], 1)
     
     def add_def(self, key:str, value:str):
         if key in self.defines[self.level]:
             raise ValueError(f"[Error] Duplicate define: {key}")
         self.defines[self.level][key] = value
+        self._seq[self.level][key] = len(self._seq[self.level])
+        self._counts[key] = self._counts.get(key, 0) + 1
+        if not self._is_regular(key, value):
+            self._irregular[self.level] += 1
+        if self._counts[key] > 1:
+            # the key moves ahead of lower levels in items() order
+            self._shadows[self.level] = True
+            for memo in self._expanded:
+                memo.clear()
+        else:
+            self._expanded[self.level].clear()
     
     def get_def(self, key:str) -> Optional[str]:
         for level in reversed(range(self.level + 1)):
@@ -90,11 +339,26 @@ class Defines:
         self.level += 1
         if len(self.defines) <= self.level:
             self.defines.append({})
+        self._seq.append({})
+        self._expanded.append({})
+        self._shadows.append(False)
+        self._irregular.append(0)
     
     def end_scope(self):
         if self.level == 0:
             raise ValueError("[Error] No scope to end.")
-        self.defines.pop()
+        popped = self.defines.pop()
+        self._irregular.pop()
+        for key in popped:
+            if self._counts[key] == 1:
+                del self._counts[key]
+            else:
+                self._counts[key] -= 1
+        self._seq.pop()
+        self._expanded.pop()
+        if self._shadows.pop():
+            for memo in self._expanded:
+                memo.clear()
         self.level -= 1
 
     def items(self):
@@ -103,218 +367,1613 @@ class Defines:
             result.update(self.defines[level])
         return result.items()
 
+    @property
+    def irregular(self) -> bool:
+        """True while a define needs the re.sub based substitution."""
+        return any(self._irregular)
+
+    def expanded(self, key:str) -> Optional[str]:
+        """The text substitute() replaces the identifier key with, or None if key is not defined."""
+        rank = self._rank(key)
+        if rank is None:
+            return None
+        return self._expand(key, rank[0], rank[1])
+
+    def substitute(self, line:str) -> str:
+        """Replace every define in line, equivalent to applying re.sub for each of items() in order."""
+        if any(self._irregular):
+            for def_key, def_value in self.items():
+                line = re.sub(rf"\b{re.escape(def_key)}\b", def_value, line)
+            return line
+        if not self._counts:
+            return line
+        return IDENT_RE.sub(self._replace_match, line)
+
+    @staticmethod
+    def _is_regular(key:str, value:str) -> bool:
+        # keys made of non-word characters change what \b matches and
+        # backslashes are interpreted by re.sub in the replacement text
+        return "\\" not in value and IDENT_RE.fullmatch(key) is not None
+
+    def _rank(self, key:str) -> Optional[tuple[int, int]]:
+        # items() lists higher levels first, each level in insertion order
+        if key not in self._counts:
+            return None
+        for level in range(self.level, -1, -1):
+            if key in self.defines[level]:
+                return level, self._seq[level][key]
+        return None
+
+    def _expand(self, key:str, level:int, seq:int) -> str:
+        memo = self._expanded[level]
+        expanded = memo.get(key)
+        if expanded is None:
+            # items() keeps the value of the lowest level
+            if self._counts[key] == 1:
+                value = self.defines[level][key]
+            else:
+                value = next(self.defines[lv][key] for lv in range(level + 1) if key in self.defines[lv])
+            if not any(token in self._counts for token in IDENT_RE.findall(value)):
+                expanded = value
+            else:
+                def replace_later(m:re.Match) -> str:
+                    token = m.group()
+                    rank = self._rank(token)
+                    if rank is None or rank[0] > level or (rank[0] == level and rank[1] <= seq):
+                        return token
+                    return self._expand(token, rank[0], rank[1])
+                expanded = IDENT_RE.sub(replace_later, value)
+            memo[key] = expanded
+        return expanded
+
+    def _replace_match(self, m:re.Match) -> str:
+        token = m.group()
+        rank = self._rank(token)
+        if rank is None:
+            return token
+        return self._expand(token, rank[0], rank[1])
+
+class MacroTemplate:
+    """
+    Macro body compiled once when the macro is defined.\n
+    Comments are stripped, directives are classified and every line is split
+    into literal text and identifiers, with parameters mapped to their
+    argument positions. An expansion fills the identifier slots from the
+    define table and emits exactly what preprocessing the body again would.
+    """
+    def __init__(self, lines:list[str], params:list[str]):
+        self.params = params
+        # ("line", parts, slots, unprocessed_line, is_instruction) or ("def", tok, unprocessed_line)
+        # or ("error", message); None if the body must go through preprocess() again
+        self.steps: Optional[list[tuple]] = []
+        self.has_defs = False
+        slot_of = {p: n for n, p in enumerate(params)}
+        for raw_line in lines:
+            line = raw_line.strip()
+            unprocessed_line = line
+            line = re.sub(r";.*$", "", line)
+            tok = line.strip().split(" ")
+            directive = DIRECTIVES.get(tok[0].upper(), None)
+            if directive == 1:  # .DEF or .DEFINE
+                self.steps.append(("def", tok, unprocessed_line))
+                self.has_defs = True
+                continue
+            elif directive == 2:  # .MACRO
+                self.steps.append(("error", "[Error] Nested macros are not supported (line {lineno})"))
+                return
+            elif directive == 3:  # .ENDMACRO or .ENDM
+                return
+            elif directive == 4:  # .INCLUDE or .INC
+                self.steps = None
+                return
+            line = line.replace("\t", " ").strip()
+            parts = IDENT_RE.split(line)
+            idents = IDENT_RE.findall(line)
+            # interleave literal text and identifiers: parts[odd] are identifiers
+            merged: list[str] = [parts[0]]
+            for ident, literal in zip(idents, parts[1:]):
+                merged.append(ident)
+                merged.append(literal)
+            slots = [(n, slot_of.get(merged[n], -1)) for n in range(1, len(merged), 2)]
+            self.steps.append(("line", merged, slots, unprocessed_line, tok[0].upper() in INST_TYPES))
+
+    def expand(self, processed:"ProcessedLines", defines:Defines, lineno:int, address:int) -> int:
+        """
+        Append the expanded body to processed. The macro scope with the
+        parameters must already be active in defines. Returns the next address.
+        """
+        assert self.steps is not None
+        values = [defines.expanded(p) for p in self.params]
+        defined = defines._counts
+        for step in self.steps:
+            kind = step[0]
+            if kind == "line":
+                _, merged, slots, unprocessed_line, is_instruction = step
+                if defines.irregular:
+                    line = defines.substitute("".join(merged))
+                elif slots:
+                    out = merged.copy()
+                    for n, slot in slots:
+                        if slot >= 0 and not self.has_defs:
+                            out[n] = values[slot]
+                        elif out[n] in defined:
+                            # a .DEF in the body may also rewrite parameter values
+                            out[n] = defines.expanded(out[n])
+                    line = "".join(out)
+                else:
+                    line = merged[0]
+                processed.add(line, lineno, unprocessed_line, address)
+                if is_instruction:
+                    address += 1
+            elif kind == "def":
+                _, tok, unprocessed_line = step
+                if len(tok) < 3:
+                    raise ValueError(f"[Error] Invalid .DEF or .DEFINE directive at line {lineno}")
+                defines.add_def(tok[1], " ".join(tok[2:]))
+                processed.add("", lineno, unprocessed_line, address)
+            else:
+                raise ValueError(step[1].format(lineno=lineno))
+        return address
+
 class Macros:
     def __init__(self, initial_macros:Optional[dict[str, tuple[list[str], list[str]]]]=None):
         self.macros: dict[str, tuple[list[str], list[str]]] = initial_macros if initial_macros is not None else {}
+        self.templates: dict[str, MacroTemplate] = {}
     
     def add_macro(self, name:str, lines:list[str], params:list[str]):
         if name in self.macros:
             raise ValueError(f"[Error] Duplicate macro definition: {name}")
         self.macros[name] = (lines, params)
+        self.templates[name] = MacroTemplate(lines, params)
     
     def get_macro(self, name:str) -> Optional[tuple[list[str], list[str]]]:
         return self.macros.get(name, None)
 
-def assemble(code:Sequence[tuple[str, int]], ls:LinkState, arch:str) -> dict[int, tuple[int, int]]:
+    def get_template(self, name:str) -> Optional[MacroTemplate]:
+        """Compiled body of the macro, or None if it has to be preprocessed on every call."""
+        template = self.templates.get(name)
+        if template is None:
+            macro_def = self.macros.get(name)
+            if macro_def is None:
+                return None
+            template = self.templates[name] = MacroTemplate(*macro_def)
+        return template if template.steps is not None else None
+
+# preprocessed lines the include cache keeps, over all its entries
+INCLUDE_CACHE_LINES = 100_000
+# a directory changed this recently may still change without its mtime moving (FAT: 2 s)
+RACY_MTIME_NS = 2_000_000_000
+
+class IncludeCache:
     """
-    Assemble HC4 assembly code into machine code.\n
-    Input: list of tuples (line:str, lineno:int)\n
-    Output: list of tuples (machine_code:int, lineno:int)
+    Cache of preprocessed .INCLUDE files, safe to share between sessions and threads.\n
+    An entry holds the lines an include produced (addresses relative to the
+    include directive) together with the defines and macros it added, and is
+    keyed by the resolved path, the content hash of the file and the define /
+    macro state the include was processed in. Every file read while the entry
+    was built is checked against its mtime, size and hash before the entry is
+    spliced in again. Resolved include paths are remembered as well, with the
+    candidates in the include paths in front of the one that was found: a
+    remembered path is used while the directories of the candidates up to it
+    keep their mtime (adding or removing a file changes it), and an entry
+    only while none of the files that would shadow its own includes exists.\n
+    The entries are dropped least recently used first once they hold more
+    than max_lines preprocessed lines, and with them the files only they
+    depended on, so that a long running daemon seeing ever new defines in
+    front of an include does not keep a copy for each.
     """
-    global INST_DICT_M
-    global INST_TYPES
-    JMP_FLAGS = {"C" : 0x02, "NC" : 0x03, "Z" : 0x04, "NZ" : 0x05, }
+    def __init__(self, max_lines:int=INCLUDE_CACHE_LINES):
+        self.hits = 0
+        self.misses = 0
+        self.max_lines = max_lines
+        # (include_pathes, filename) -> (resolved path, paths in front of it, ((directory, mtime_ns), ...))
+        self._resolved: dict[tuple[tuple[str, ...], str], tuple[str, tuple[str, ...], tuple]] = {}
+        # path -> (mtime_ns, size, digest, lines)
+        self._files: dict[str, tuple[int, int, str, list[str]]] = {}
+        # key -> (processed with relative addresses, address delta, added defines, added macros, dependencies),
+        # least recently used first; a dependency with digest None is a shadowing path that must not exist
+        self._entries: OrderedDict[tuple, tuple] = OrderedDict()
+        # preprocessed lines held by _entries
+        self._lines = 0
+        self._lock = threading.Lock()
 
-    INST_DICT = INST_DICT_M.get(arch)
-    if INST_DICT is None:
-        raise KeyError(f"[Error] Unsupported architecture: {arch}")
-    
-    # (address : (code, linenum))
-    machine_code: dict[int, tuple[int, int]] = {}
-    
-    address = 0
-    for line, lineno in code:
-        if line.strip() == "":
-            continue
-        tok = line.strip().split(" ")
+    def __repr__(self) -> str:
+        return f"IncludeCache(hits={self.hits}, misses={self.misses}, entries={len(self._entries)}, lines={self._lines})"
 
-        if tok[0].upper().endswith(":"):
-            label = tok[0].upper()[:-1]
-            tok.pop(0)
-            ls.add_label(label, len(machine_code))
-            if len(tok) == 0:
+    def clear(self):
+        with self._lock:
+            self._resolved.clear()
+            self._files.clear()
+            self._entries.clear()
+            self._lines = 0
+
+    @staticmethod
+    def _mtime(directory:str) -> Optional[int]:
+        try:
+            return os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+
+    def resolve(self, include_filename:str, include_pathes:Sequence[str]) -> tuple[str, tuple[str, ...]]:
+        """
+        (path, shadows): the first include path holding include_filename, or
+        include_filename itself if none does, and the candidates in the include
+        paths in front of it, which would be found instead if they appeared.
+        """
+        key = (tuple(include_pathes), include_filename)
+        cached = self._resolved.get(key)
+        if cached is not None and all(self._mtime(directory) == mtime for directory, mtime in cached[2]):
+            return cached[0], cached[1]
+        candidates = [str(Path(path) / include_filename) for path in include_pathes]
+        for n, candidate in enumerate(candidates):
+            if os.path.exists(candidate):
+                shadows = tuple(candidates[:n])
+                directories = tuple((directory, self._mtime(directory))
+                                    for directory in dict.fromkeys(os.path.dirname(c) for c in candidates[:n + 1]))
+                # a file added within the timestamp granularity of the last change may leave the mtime as it is
+                racy = time.time_ns() - RACY_MTIME_NS
+                if all(mtime is None or mtime < racy for _, mtime in directories):
+                    self._resolved[key] = (candidate, shadows, directories)
+                return candidate, shadows
+        return include_filename, tuple(candidates)
+
+    def read(self, filename:str) -> tuple[int, int, str, list[str]]:
+        """Return (mtime_ns, size, content hash, lines) of filename, reading it only if mtime or size changed."""
+        st = os.stat(filename)
+        cached = self._files.get(filename)
+        if cached is None or cached[0] != st.st_mtime_ns or cached[1] != st.st_size:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            # same lines as readlines() in text mode with universal newlines
+            text = data.decode('utf-8').replace("\r\n", "\n").replace("\r", "\n")
+            lines = text.split("\n")
+            if lines[-1] == "":
+                lines.pop()
+            cached = (st.st_mtime_ns, st.st_size, hashlib.sha1(data).hexdigest(), lines)
+            self._files[filename] = cached
+        return cached
+
+    def _valid(self, deps:list[tuple]) -> bool:
+        for filename, mtime_ns, size, digest in deps:
+            if digest is None:
+                if os.path.exists(filename):
+                    return False
                 continue
+            try:
+                current = self.read(filename)[2]
+            except OSError:
+                return False
+            if current != digest:
+                return False
+        return True
 
-        opcode = INST_DICT.get(tok[0].upper())
-        if opcode is None:
-            raise KeyError(f"[Error] Invalid instruction: {tok[0]} in line {lineno}")
+    @staticmethod
+    def state_key(defines:"Defines", macros:"Macros") -> tuple:
+        return (tuple(tuple(level.items()) for level in defines.defines),
+                tuple((name, tuple(lines), tuple(params)) for name, (lines, params) in macros.macros.items()))
 
-        # assemble lines
-        match INST_TYPES.get(tok[0].upper()):
-            case None:
-                raise KeyError(f"[Error] Oops! : {tok[0]} is found in INST_DICT but not in INST_TYPES")
-            case insttype.INHERENT:
-                machine_code[address] = ((opcode, lineno))
-                address += 1
-            case insttype.REGISTER:
-                oprand = int(re.findall(r"[rR]([0-9]*)", tok[1])[0])
+    def include(self, filename:str, child:bool, session:"Assembler", processed:ProcessedLines):
+        """Append the preprocessed lines of filename to processed, from the cache if possible."""
+        mtime_ns, size, digest, lines = self.read(filename)
+        session.record_dependency((filename, mtime_ns, size, digest))
+        key = (filename, digest, child, tuple(session.include_pathes), self.state_key(session.defines, session.macros))
+        entry = self._entries.get(key)
+        if entry is not None and self._valid(entry[4]):
+            with self._lock:
+                self.hits += 1
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+            rel_processed, delta, added_defs, added_macros, deps = entry
+            for dep in deps:
+                session.record_dependency(dep)
+            address = session.address
+            processed.extend((line, lineno, unprocessed_line, address + rel) for line, lineno, unprocessed_line, rel in rel_processed)
+            for key_, value in added_defs:
+                session.defines.add_def(key_, value)
+            for name, macro_lines, params in added_macros:
+                session.macros.add_macro(name, macro_lines, params)
+            session.address = address + delta
+            return
+
+        with self._lock:
+            self.misses += 1
+        defines, macros, address = session.defines, session.macros, session.address
+        defs_before = len(defines.defines[defines.level])
+        macros_before = len(macros.macros)
+        deps = [(filename, mtime_ns, size, digest)]
+        res = session.preprocess(lines, child, 0, record=deps)
+        processed.extend(res)
+        added_defs = list(defines.defines[defines.level].items())[defs_before:]
+        added_macros = [(name, macro_lines, params) for name, (macro_lines, params) in list(macros.macros.items())[macros_before:]]
+        rel_processed = [(line, lineno, unprocessed_line, adr - address) for line, lineno, unprocessed_line, adr in res]
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._lines -= len(old[0])
+            self._entries[key] = (rel_processed, session.address - address, added_defs, added_macros, deps)
+            self._lines += len(rel_processed)
+            if self._lines > self.max_lines:
+                self._evict()
+
+    def _evict(self):
+        """Drop the least recently used entries down to max_lines (keeping the newest), and the files none of the rest uses."""
+        while self._lines > self.max_lines and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self._lines -= len(entry[0])
+        used = {dep[0] for entry in self._entries.values() for dep in entry[4]}
+        for filename in list(self._files):
+            if filename not in used:
+                self._files.pop(filename, None)
+
+INCLUDE_CACHE = IncludeCache()
+
+class Profile:
+    """
+    Wall time and call counts of an assembly, filled in by an Assembler created
+    with profile=Profile().\n
+    Stages are timed by whoever runs them (stage()); the Assembler times the
+    preprocess and assemble stages, every .INCLUDE (including the files it
+    includes in turn), every macro call and the define substitution of every
+    line that changed, which is split evenly between the defines it used.
+    """
+    def __init__(self):
+        # name -> [calls, seconds]
+        self.stages: dict[str, list] = {}
+        # resolved path -> [calls, seconds, cache hits, preprocessed lines]
+        self.includes: dict[str, list] = {}
+        # macro name -> [calls, seconds, preprocessed lines]
+        self.macros: dict[str, list] = {}
+        # define name -> [substitutions, seconds]
+        self.defines: dict[str, list] = {}
+        self._start = time.perf_counter()
+
+    def __repr__(self) -> str:
+        return f"Profile(stages={len(self.stages)}, includes={len(self.includes)}, macros={len(self.macros)}, defines={len(self.defines)})"
+
+    @contextmanager
+    def stage(self, name:str):
+        """Time the body of a with block as one call of stage name."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - t0)
+
+    def add_stage(self, name:str, seconds:float):
+        entry = self.stages.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def add_include(self, filename:str, seconds:float, hit:bool, lines:int):
+        entry = self.includes.setdefault(filename, [0, 0.0, 0, 0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += hit
+        entry[3] += lines
+
+    def add_macro(self, name:str, seconds:float, lines:int):
+        entry = self.macros.setdefault(name, [0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += lines
+
+    def add_substitution(self, defines:Defines, line:str, seconds:float):
+        """Charge the substitution of line to the defines among its identifiers."""
+        used = [token for token in IDENT_RE.findall(line) if defines.expanded(token) is not None]
+        for token in used:
+            entry = self.defines.setdefault(token, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds / len(used)
+
+    def report(self, top:int=10) -> dict:
+        """
+        JSON-ready summary: total_ms since the profile was created, every stage
+        and include file, and the top macros and defines, each sorted by time.
+        """
+        def ms(seconds:float) -> float:
+            return round(seconds * 1000, 3)
+        by_time = lambda table: sorted(table.items(), key=lambda item: item[1][1], reverse=True)
+        return {
+            'total_ms': ms(time.perf_counter() - self._start),
+            'stages': [{'name': name, 'calls': calls, 'ms': ms(seconds)} for name, (calls, seconds) in self.stages.items()],
+            'includes': [{'file': name, 'calls': calls, 'cache_hits': hits, 'lines': lines, 'ms': ms(seconds)}
+                         for name, (calls, seconds, hits, lines) in by_time(self.includes)],
+            'macros': [{'name': name, 'calls': calls, 'lines': lines, 'ms': ms(seconds)}
+                       for name, (calls, seconds, lines) in by_time(self.macros)[:top]],
+            'defines': [{'name': name, 'uses': uses, 'ms': ms(seconds)} for name, (uses, seconds) in by_time(self.defines)[:top]],
+        }
+
+JMP_FLAGS = {"C" : 0x02, "NC" : 0x03, "Z" : 0x04, "NZ" : 0x05, }
+
+_DIGITS = frozenset("0123456789")
+_HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+_LABEL_START = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_")
+_LABEL_CHARS = _LABEL_START | _DIGITS
+
+# operand text -> parsed value, the same few operands repeat throughout a program
+_REGISTER_CACHE: dict[str, int] = {}
+_IMMEDIATE_CACHE: dict[str, int] = {}
+_LABEL_REF_CACHE: dict[str, Optional[str]] = {}
+_OPERAND_CACHE_LIMIT = 4096
+
+def _parse_register(oprand:str, lineno:int) -> int:
+    """Register number of the first r<digits> in oprand (same as re.findall(r"[rR]([0-9]*)")[0])."""
+    value = _REGISTER_CACHE.get(oprand)
+    if value is None:
+        if len(_REGISTER_CACHE) >= _OPERAND_CACHE_LIMIT:
+            _REGISTER_CACHE.clear()
+        value = _REGISTER_CACHE[oprand] = _scan_register(oprand, lineno)
+    return value
+
+def _scan_register(oprand:str, lineno:int) -> int:
+    positions = [p for p in (oprand.find("r"), oprand.find("R")) if p >= 0]
+    if not positions:
+        raise ValueError(f"Invalid register designator : {oprand} in line {lineno}")
+    start = min(positions) + 1
+    end = start
+    while end < len(oprand) and oprand[end] in _DIGITS:
+        end += 1
+    if end == start:
+        raise ValueError(f"Invalid register designator : {oprand} in line {lineno}")
+    return int(oprand[start:end])
+
+def _parse_label_ref(oprand:str) -> Optional[str]:
+    """First #NAME:n in oprand as "NAME:n" (same as re.findall(r"#([A-Za-z_][A-Za-z0-9_]*:[0-3])")[0])."""
+    if oprand in _LABEL_REF_CACHE:
+        return _LABEL_REF_CACHE[oprand]
+    if len(_LABEL_REF_CACHE) >= _OPERAND_CACHE_LIMIT:
+        _LABEL_REF_CACHE.clear()
+    label = _LABEL_REF_CACHE[oprand] = _scan_label_ref(oprand)
+    return label
+
+def _scan_label_ref(oprand:str) -> Optional[str]:
+    n = len(oprand)
+    pos = oprand.find("#")
+    while pos >= 0:
+        start = pos + 1
+        if start < n and oprand[start] in _LABEL_START:
+            end = start + 1
+            while end < n and oprand[end] in _LABEL_CHARS:
+                end += 1
+            if end + 1 < n and oprand[end] == ":" and oprand[end + 1] in "0123":
+                return oprand[start:end + 2]
+        pos = oprand.find("#", pos + 1)
+    return None
+
+def _parse_immediate(oprand:str, lineno:int) -> int:
+    """Value of the first #imm in oprand (same as re.findall(r"#((0x|0b)?[0-9a-fA-F]+)")[0][0])."""
+    value = _IMMEDIATE_CACHE.get(oprand)
+    if value is None:
+        if len(_IMMEDIATE_CACHE) >= _OPERAND_CACHE_LIMIT:
+            _IMMEDIATE_CACHE.clear()
+        value = _IMMEDIATE_CACHE[oprand] = _scan_immediate(oprand, lineno)
+    return value
+
+def _scan_immediate(oprand:str, lineno:int) -> int:
+    n = len(oprand)
+    pos = oprand.find("#")
+    while pos >= 0:
+        start = pos + 1
+        if oprand.startswith(("0x", "0b"), start) and start + 2 < n and oprand[start + 2] in _HEX_DIGITS:
+            end = start + 2
+        elif start < n and oprand[start] in _HEX_DIGITS:
+            end = start
+        else:
+            pos = oprand.find("#", pos + 1)
+            continue
+        while end < n and oprand[end] in _HEX_DIGITS:
+            end += 1
+        try:
+            return int(oprand[start:end], 0)
+        except ValueError:
+            raise ValueError(f"Invalid immediate value : {oprand} in line {lineno}")
+    raise ValueError(f"Invalid immediate value : {oprand} in line {lineno}")
+
+def _make_encoder(opcode:int, kind:insttype):
+    """Encoding closure for one mnemonic: (tok, lineno, ls, address) -> machine code."""
+    def missing(tok:list[str], lineno:int):
+        raise ValueError(f"Missing operand for {tok[0]} in line {lineno}")
+
+    match kind:
+        case insttype.INHERENT:
+            def encode(tok:list[str], lineno:int, ls:LinkState, address:int) -> int:
+                return opcode
+        case insttype.REGISTER:
+            def encode(tok:list[str], lineno:int, ls:LinkState, address:int) -> int:
+                if len(tok) < 2:
+                    missing(tok, lineno)
+                oprand = _parse_register(tok[1], lineno)
                 if oprand > 15:
                     raise ValueError(f"Too big register designator : {oprand} in line {lineno}")
-                machine_code[address] = ((opcode + oprand, lineno))
-                address += 1
-            case insttype.IMMEDIATE:
-                label = re.findall(r"#([A-Za-z_][A-Za-z0-9_]*:[0-3])", tok[1])
-                if label:
-                    ls.add_unresolved(label[0], len(machine_code))
-                    machine_code[address] = ((opcode, lineno))
-                    address += 1
-                    continue
-                try:
-                    # print(tok[1])
-                    # print(re.findall(r"#((0x|0b)?[0-9a-fA-F]+)", tok[1])[0][0])
-                    oprand = int(re.findall(r"#((0x|0b)?[0-9a-fA-F]+)", tok[1])[0][0], 0)
-                except ValueError:
-                    raise ValueError(f"Invalid immediate value : {tok[1]} in line {lineno}")
+                return opcode + oprand
+        case insttype.IMMEDIATE:
+            def encode(tok:list[str], lineno:int, ls:LinkState, address:int) -> int:
+                if len(tok) < 2:
+                    missing(tok, lineno)
+                label = _parse_label_ref(tok[1])
+                if label is not None:
+                    ls.add_unresolved(label, address)
+                    return opcode
+                oprand = _parse_immediate(tok[1], lineno)
                 if oprand > 15:
                     raise ValueError(f"Too big immediate value : {oprand} in line {lineno}")
-                if oprand < 0:
-                    raise ValueError(f"Negative immediate value : {oprand} in line {lineno}")
-                machine_code[address] = ((opcode + oprand, lineno))
-                address += 1
-            case insttype.JUMP:
+                return opcode + oprand
+        case insttype.JUMP:
+            def encode(tok:list[str], lineno:int, ls:LinkState, address:int) -> int:
                 if len(tok) == 1:
-                    machine_code[address] = ((opcode, lineno))
-                    address += 1
-                else:
-                    flag = tok[1].upper()
-                    if flag not in JMP_FLAGS:
-                        raise ValueError(f"Invalid jump flag : {flag} in line {lineno}")
-                    machine_code[address] = ((opcode + JMP_FLAGS[flag], lineno))
-                    address += 1
+                    return opcode
+                flag = tok[1].upper()
+                if flag not in JMP_FLAGS:
+                    raise ValueError(f"Invalid jump flag : {flag} in line {lineno}")
+                return opcode + JMP_FLAGS[flag]
+    return encode
+
+def build_encoders(arch:str) -> dict:
+    """Mnemonic -> encoding closure for arch, built from INST_DICT_M and INST_TYPES."""
+    inst_dict = INST_DICT_M.get(arch)
+    if inst_dict is None:
+        raise KeyError(f"[Error] Unsupported architecture: {arch}")
+    encoders = {}
+    for mnemonic, opcode in inst_dict.items():
+        kind = INST_TYPES.get(mnemonic)
+        if kind is None:
+            raise KeyError(f"[Error] Oops! : {mnemonic} is found in INST_DICT but not in INST_TYPES")
+        encoders[mnemonic] = _make_encoder(opcode, kind)
+    return encoders
 
-    # print(ls)
+# arch -> mnemonic -> encoding closure
+ENCODERS = {arch: build_encoders(arch) for arch in INST_DICT_M}
 
+def assemble(code:Iterable[tuple[str, int]], ls:LinkState, arch:str) -> MachineCode:
+    """
+    Assemble HC4 assembly code into machine code.\n
+    Input: (line:str, lineno:int) tuples or ProcessedLines\n
+    Output: MachineCode, address -> (machine_code:int, lineno:int)
+    """
+    encoders = ENCODERS.get(arch)
+    if encoders is None:
+        raise KeyError(f"[Error] Unsupported architecture: {arch}")
+    
+    # (address : (code, linenum))
+    machine_code = MachineCode()
+    _encode_lines(code, encoders, ls, machine_code, 0)
+
+    codes = machine_code.codes
     for addr, label in ls.unresolved.items():
         value = ls.parse_label(label)
         if value is None:
             raise KeyError(f"[Error] Undefined label: {label}")
-        machine_code[addr] = (machine_code[addr][0] + value, machine_code[addr][1])
+        codes[addr] += value
     return machine_code
 
-address = 0
+def _encode_lines(code:Iterable[tuple[str, int]], encoders:dict, ls:LinkState, machine_code:MachineCode, address:int) -> int:
+    """Append the code of lines to machine_code, which ends at address, without resolving labels. Returns the next address."""
+    if isinstance(code, ProcessedLines):
+        code = zip(code.texts, code.linenos)
+    codes = machine_code.codes
+    linenos = machine_code.linenos
+    if not codes:
+        machine_code.start = address
+    for entry in code:
+        # (line, lineno) or a preprocessed (line, lineno, unprocessed_line, address)
+        line = entry[0].strip()
+        lineno = entry[1]
+        if line == "":
+            continue
+        tok = line.split(" ")
+        mnemonic = tok[0].upper()
 
-def preprocess(lines:Sequence[str], child:bool, lineno_start:int, include_pathes:list[str], defines:Defines=Defines(), macros:Macros=Macros()) -> list[tuple[str, int, str, int]]:
+        if mnemonic.endswith(":"):
+            ls.add_label(mnemonic[:-1], address)
+            tok.pop(0)
+            if len(tok) == 0:
+                continue
+            mnemonic = tok[0].upper()
+
+        encode = encoders.get(mnemonic)
+        if encode is None:
+            raise KeyError(f"[Error] Invalid instruction: {tok[0]} in line {lineno}")
+        codes.append(encode(tok, lineno, ls, address))
+        linenos.append(lineno)
+        address += 1
+    return address
+
+class AssembleResult:
+    """Everything one assembly produced."""
+    def __init__(self, lines:ProcessedLines, machine_code:MachineCode, ls:LinkState, arch:str, dependencies:dict[str, str],
+                 shadows:Iterable[str]=()):
+        # (line:str, lineno:int, unprocessed_line:str, address:int)
+        self.lines = lines
+        # address -> (code, lineno)
+        self.machine_code = machine_code
+        self.ls = ls
+        self.arch = arch
+        # included file -> content hash
+        self.dependencies = dependencies
+        # files that would be included instead if they appeared
+        self.shadows = set(shadows)
+
+    def __repr__(self) -> str:
+        return f"AssembleResult(arch={self.arch}, lines={len(self.lines)}, bytes={len(self.machine_code)})"
+
+    @property
+    def bitstream(self) -> list[int]:
+        return adrlist2bitstream(self.machine_code, 255)
+
+    @property
+    def image(self) -> Image:
+        return build_image(self.machine_code, 255)
+
+class Assembler:
+    """
+    One assembly session.\n
+    The session owns its define table, macros, link state and address counter,
+    so independent sessions can run side by side in threads or worker
+    processes. Only the IncludeCache is shared, and it validates its entries
+    against file contents.
+    """
+    def __init__(self, arch:str="HC4", include_pathes:Optional[Sequence[str]]=None, defines:Optional[Defines]=None,
+                 macros:Optional[Macros]=None, include_cache:Optional[IncludeCache]=None, profile:Optional[Profile]=None):
+        if arch not in INST_DICT_M:
+            raise KeyError(f"[Error] Unsupported architecture: {arch}")
+        self.arch = arch
+        self.profile = profile
+        self.include_pathes: list[str] = list(include_pathes) if include_pathes is not None else []
+        self.defines = defines if defines is not None else Defines()
+        self.macros = macros if macros is not None else Macros()
+        self.include_cache = include_cache if include_cache is not None else INCLUDE_CACHE
+        self.ls = LinkState()
+        self.address = 0
+        # included file -> content hash, for every file read by this session
+        self.dependencies: dict[str, str] = {}
+        # files in include paths in front of a resolved include, which would change the build if they appeared
+        self.shadows: set[str] = set()
+        # dependency lists of the include cache entries being built
+        self._recording: list[list[tuple]] = []
+
+    def __repr__(self) -> str:
+        return f"Assembler(arch={self.arch}, address={self.address}, {self.ls})"
+
+    def record_dependency(self, dep:tuple):
+        """Note that the file dep = (path, mtime_ns, size, digest) was read, or that path must not exist if digest is None."""
+        if dep[3] is None:
+            self.shadows.add(dep[0])
+        else:
+            self.dependencies[dep[0]] = dep[3]
+        for deps in self._recording:
+            deps.append(dep)
+
+    def preprocess(self, lines:Sequence[str], child:bool=False, lineno_start:int=0,
+                   record:Optional[list[tuple]]=None) -> ProcessedLines:
+        """
+        preprocessor for assembly code: remove comments and empty lines
+        Input: list of lines (str)
+        Output: ProcessedLines, rows of (line:str, lineno:int, unprocessed_line:str, address:int)
+        """
+        if record is None:
+            if self.profile is not None and not child and not self._recording:
+                with self.profile.stage('preprocess'):
+                    return self._preprocess(lines, child, lineno_start)
+            return self._preprocess(lines, child, lineno_start)
+        self._recording.append(record)
+        try:
+            return self._preprocess(lines, child, lineno_start)
+        finally:
+            self._recording.pop()
+
+    def _preprocess(self, lines:Sequence[str], child:bool, lineno_start:int,
+                    starts:Optional[list[tuple[int, int, int, int]]]=None) -> ProcessedLines:
+        """
+        Body of preprocess(). Non-child lines are numbered from lineno_start + 1.
+        If starts is given, (line index, len(processed), number of level 0 defines, number of macros)
+        is appended to it whenever a top-level line is started; lines inside a .MACRO block are skipped.
+        """
+        defines = self.defines
+        macros = self.macros
+        # (line:str, lineno:int, unprocessed_line:str, address:int)
+        processed = ProcessedLines()
+        i = 0
+        lineno = lineno_start
+        while i < len(lines):
+            if starts is not None:
+                starts.append((i, len(processed), len(defines.defines[0]), len(macros.macros)))
+            i += 1
+            line = lines[i - 1].strip()
+            if not child:
+                lineno = lineno_start + i
+            # remove comments
+            unprocessed_line = line
+            line = re.sub(r";.*$", "", line)
+            tok = line.strip().split(" ")
+            directive = DIRECTIVES.get(tok[0].upper(), None)
+            if directive == 1:  # .DEF or .DEFINE
+                if len(tok) < 3:
+                    raise ValueError(f"[Error] Invalid .DEF or .DEFINE directive at line {lineno}")
+                defines.add_def(tok[1], " ".join(tok[2:]))
+                processed.add("", lineno, unprocessed_line, self.address)
+                continue
+            elif directive == 2:  # .MACRO
+                if child:
+                    raise ValueError(f"[Error] Nested macros are not supported (line {lineno})")
+                if len(tok) < 2:
+                    raise ValueError(f"[Error] Invalid .MACRO directive at line {lineno}")
+                macro_name = tok[1].upper()
+                params = tok[2:] if len(tok) > 2 else []
+                macro_lines: list[str] = []
+                processed.add("", lineno, unprocessed_line, self.address)
+                for offset, macro_line in enumerate(lines[i:], start=1):
+                    macro_lineno = lineno + offset
+                    macro_line_clean = re.sub(r";.*$", "", macro_line)
+                    macro_line = macro_line.strip()
+                    macro_lines.append(macro_line)
+                    processed.add("", macro_lineno, macro_line, self.address)
+                    if macro_line_clean.strip().upper().startswith((".ENDMACRO", ".ENDM")):
+                        break
+                else:
+                    raise ValueError(f"[Error] Missing .ENDMACRO directive for macro {macro_name}")
+                macros.add_macro(macro_name, macro_lines, params)
+                i += offset
+                continue
+            elif directive == 3 and child:  # .ENDMACRO or .ENDM
+                return processed
+            elif directive == 4:  # .INCLUDE or .INC
+                processed.add("", lineno, line, self.address)
+                if len(tok) < 2:
+                    raise ValueError(f"[Error] Invalid .INCLUDE or .INC directive at line {lineno}")
+                include_filename, shadows = self.include_cache.resolve(tok[1].strip('"'), self.include_pathes)
+                for shadow in shadows:
+                    self.record_dependency((shadow, None, None, None))
+                t0, hits, start = time.perf_counter(), self.include_cache.hits, len(processed)
+                try:
+                    self.include_cache.include(include_filename, child, self, processed)
+                except FileNotFoundError:
+                    raise FileNotFoundError(f"[Error] Included file not found: {include_filename} (line {lineno})")
+                if self.profile is not None:
+                    self.profile.add_include(include_filename, time.perf_counter() - t0, self.include_cache.hits > hits, len(processed) - start)
+                continue
+            
+            macro_def = macros.get_macro(tok[0].upper()) if not child else None
+            if macro_def is not None:
+                macro_name = tok[0].upper()
+                macro_args = tok[1:] if len(tok) > 1 else []
+                macro_lines, params = macro_def
+                processed.add("", lineno, "; " + unprocessed_line + " [MACRO]", self.address)
+                t0, start = time.perf_counter(), len(processed)
+                if len(macro_args) != len(params):
+                    raise ValueError(f"[Error] Macro {macro_name} expects {len(params)} arguments, got {len(macro_args)} (line {lineno})")
+                defines.new_scope()
+                for p, a in zip(params, macro_args):
+                    defines.add_def(p, a)
+                template = macros.get_template(macro_name)
+                if template is not None:
+                    self.address = template.expand(processed, defines, lineno, self.address)
+                else:
+                    processed.extend(self._preprocess(macro_lines, True, lineno))
+                defines.end_scope()
+                if self.profile is not None:
+                    self.profile.add_macro(macro_name, time.perf_counter() - t0, len(processed) - start)
+                continue
+
+            line = line.replace("\t", " ").strip()
+            # replace defines
+            if self.profile is None:
+                line = defines.substitute(line)
+            else:
+                t0, before = time.perf_counter(), line
+                line = defines.substitute(line)
+                if line != before:
+                    self.profile.add_substitution(defines, before, time.perf_counter() - t0)
+            if line == unprocessed_line:
+                # share the source string
+                line = unprocessed_line
+
+            processed.add(line, lineno, unprocessed_line, self.address)
+            if tok[0].upper() in INST_TYPES:
+                self.address += 1
+
+        return processed
+
+    def assemble(self, processed:Sequence[tuple[str, int, str, int]]) -> MachineCode:
+        """Encode preprocessed lines with this session's link state."""
+        if self.profile is not None:
+            with self.profile.stage('assemble'):
+                return assemble(processed, self.ls, self.arch)
+        return assemble(processed, self.ls, self.arch)
+
+    def run(self, lines:Sequence[str]) -> AssembleResult:
+        """Preprocess and assemble a whole program."""
+        processed = self.preprocess(lines)
+        machine_code = self.assemble(processed)
+        return AssembleResult(processed, machine_code, self.ls, self.arch, dict(self.dependencies), self.shadows)
+
+def preprocess(lines:Sequence[str], child:bool, lineno_start:int, include_pathes:list[str], defines:Optional[Defines]=None, macros:Optional[Macros]=None, include_cache:Optional[IncludeCache]=None) -> ProcessedLines:
     """
     preprocessor for assembly code: remove comments and empty lines
     Input: list of lines (str)
-    Output: list of tuples (line:str, lineno:int, unprocessed_line:str, address:int)
+    Output: ProcessedLines, rows of (line:str, lineno:int, unprocessed_line:str, address:int)\n
+    Runs in a new Assembler session; pass defines and macros to share them between calls.
     """
-    global DIRECTIVES
-    global INST_TYPES
-    global address
-    # (line:str, lineno:int, unprocessed_line:str, address:int)
-    processed: list[tuple[str, int, str, int]] = []
-    i = 0
-    lineno = lineno_start
-    # print(address)
-    while i < len(lines):
-        i += 1
-        line = lines[i - 1].strip()
-        if not child:
-            lineno = i
-        # remove comments
-        unprocessed_line = line
-        line = re.sub(r";.*$", "", line)
-        tok = line.strip().split(" ")
-        directive = DIRECTIVES.get(tok[0].upper(), None)
-        if directive == 1:  # .DEF or .DEFINE
-            if len(tok) < 3:
-                raise ValueError(f"[Error] Invalid .DEF or .DEFINE directive at line {lineno}")
-            defines.add_def(tok[1], " ".join(tok[2:]))
-            processed.append(("", lineno, unprocessed_line, address))
-            continue
-        elif directive == 2:  # .MACRO
-            if child:
-                raise ValueError(f"[Error] Nested macros are not supported (line {lineno})")
-            if len(tok) < 2:
-                raise ValueError(f"[Error] Invalid .MACRO directive at line {lineno}")
-            macro_name = tok[1].upper()
-            params = tok[2:] if len(tok) > 2 else []
-            macro_lines: list[str] = []
-            processed.append(("", lineno, unprocessed_line, address))
-            for macro_lineno, macro_line in enumerate(lines[i:], start=i + 1):
-                macro_line_clean = re.sub(r";.*$", "", macro_line)
-                macro_line = macro_line.strip()
-                macro_lines.append(macro_line)
-                processed.append(("", macro_lineno, macro_line, address))
-                if macro_line_clean.strip().upper().startswith((".ENDMACRO", ".ENDM")):
-                    break
-            else:
-                raise ValueError(f"[Error] Missing .ENDMACRO directive for macro {macro_name}")
-            macros.add_macro(macro_name, macro_lines, params)
-            i = macro_lineno
-            continue
-        elif directive == 3 and child:  # .ENDMACRO or .ENDM
-            return processed
-        elif directive == 4:  # .INCLUDE or .INC
-            processed.append(("", lineno, line, address))
-            if len(tok) < 2:
-                raise ValueError(f"[Error] Invalid .INCLUDE or .INC directive at line {lineno}")
-            include_filename = tok[1].strip('"')
-            for path in include_pathes:
-                potential_path = Path(path) / include_filename
-                if potential_path.exists():
-                    include_filename = str(potential_path)
-                    break
+    session = Assembler(include_pathes=include_pathes, defines=defines, macros=macros, include_cache=include_cache)
+    return session.preprocess(lines, child, lineno_start)
+
+def assemble_source(text:str, arch:str="HC4", include_paths:Optional[Sequence[str]]=None) -> AssembleResult:
+    """Assemble program text in a fresh session. Safe to call concurrently from threads or processes."""
+    return Assembler(arch, include_paths).run(text.splitlines())
+
+def _directive_of(line:str) -> Optional[int]:
+    """DIRECTIVES code of the first token of a source line, as preprocess() sees it."""
+    return DIRECTIVES.get(re.sub(r";.*$", "", line.strip()).strip().split(" ")[0].upper())
+
+def _common_affixes(old:Sequence[str], new:Sequence[str]) -> tuple[int, int]:
+    """Lengths of the common prefix and the common suffix of two line lists. They do not overlap."""
+    n = min(len(old), len(new))
+    step = 64
+    prefix = 0
+    while prefix + step <= n and old[prefix:prefix + step] == new[prefix:prefix + step]:
+        prefix += step
+    while prefix < n and old[prefix] == new[prefix]:
+        prefix += 1
+    limit = n - prefix
+    suffix = 0
+    while suffix + step <= limit and old[len(old) - suffix - step:len(old) - suffix] == new[len(new) - suffix - step:len(new) - suffix]:
+        suffix += step
+    while suffix < limit and old[len(old) - suffix - 1] == new[len(new) - suffix - 1]:
+        suffix += 1
+    return prefix, suffix
+
+class _Settled:
+    """
+    Column of a table an IncrementalAssembler shares with its results: reading
+    it first applies the moves the assembler deferred, see IncrementalAssembler._settle.
+    """
+    def __init__(self, column):
+        # slot of the base class that holds the column
+        self.column = column
+
+    def __get__(self, table, owner=None):
+        if table is None:
+            return self
+        table._settle()
+        return self.column.__get__(table, owner)
+
+    def __set__(self, table, value):
+        self.column.__set__(table, value)
+
+class _IncrementalLines(ProcessedLines):
+    """ProcessedLines of an IncrementalAssembler, the line numbers and addresses are settled when read."""
+    __slots__ = ("_settle",)
+    linenos = _Settled(ProcessedLines.linenos)
+    addresses = _Settled(ProcessedLines.addresses)
+
+    def __init__(self, lines:ProcessedLines, settle):
+        self._settle = settle
+        self.texts, self.linenos, self.sources, self.addresses = lines.texts, lines.linenos, lines.sources, lines.addresses
+
+class _IncrementalCode(MachineCode):
+    """MachineCode of an IncrementalAssembler, the line numbers are settled when read."""
+    __slots__ = ("_settle",)
+    linenos = _Settled(MachineCode.linenos)
+
+    def __init__(self, machine_code:MachineCode, settle):
+        super().__init__(machine_code.start, machine_code.codes, machine_code.linenos)
+        self._settle = settle
+
+class _IncrementalLinkState(LinkState):
+    """LinkState of an IncrementalAssembler, the unresolved table is rebuilt from its label references when read."""
+    def __init__(self, labels:dict[str, int], settle):
+        self.labels = labels
+        self._unresolved: dict[int, str] = {}
+        self._settle = settle
+
+    @property
+    def unresolved(self) -> dict[int, str]:
+        self._settle()
+        return self._unresolved
+
+    @unresolved.setter
+    def unresolved(self, value:dict[int, str]):
+        self._unresolved = value
+
+class _Region:
+    """Preprocessed and encoded replacement for a range of source lines, see IncrementalAssembler._process."""
+    __slots__ = ("tuples", "ntuples", "ncode", "labels", "codes", "linenos", "refs", "state", "address_delta", "rows", "span")
+
+    def __init__(self, tuples:ProcessedLines, ntuples:list[int], ncode:list[int], labels:list[Optional[list[tuple[str, int]]]],
+                 machine_code:MachineCode, refs:dict[int, str], state:tuple[int, int], address_delta:int,
+                 rows:tuple[int, int], span:tuple[int, int]):
+        self.tuples = tuples
+        self.ntuples = ntuples
+        self.ncode = ncode
+        self.labels = labels
+        self.codes = machine_code.codes
+        self.linenos = machine_code.linenos
+        self.refs = refs
+        self.state = state
+        self.address_delta = address_delta
+        # preprocessed lines and code addresses of the old lines it replaces
+        self.rows = rows
+        self.span = span
+
+class _FullRebuild(Exception):
+    """Raised while checking an edit that only a full rebuild can assemble faithfully."""
+
+class IncrementalAssembler:
+    """
+    Assembler that keeps its results between runs, for the editor.\n
+    update() takes the whole buffer every time, but only the lines that differ
+    from the previous run are preprocessed and encoded again. For every source
+    line the number of preprocessed lines and instructions it produced and the
+    labels it defines are kept, next to the program wide preprocessed lines,
+    machine code and label references. Lines after the edit are only moved,
+    and a label reference is re-resolved only if it is new or its label moved.
+    Moving the line numbers and addresses of the preprocessed lines and the
+    code is deferred: each edit adds an entry to a table of moves by source
+    line, which is applied when a result reads those columns (or once the
+    table grows long), so an edit does not rewrite every row after it.
+    Edits of directive lines (.DEF, .MACRO, .INCLUDE, ...) and changed include
+    files fall back to a full rebuild, because they change the state all
+    following lines are preprocessed in.\n
+    The returned AssembleResult shares its tables with the assembler and is
+    only valid until the next update().
+    """
+    # kinds of source lines
+    _PLAIN = 0
+    _DIRECTIVE = 1
+    _INCLUDE = 2
+    _BLOCK = 3
+    # deferred moves kept before they are applied anyway
+    _MAX_MOVES = 128
+
+    def __init__(self, arch:str="HC4", include_pathes:Optional[Sequence[str]]=None, include_cache:Optional[IncludeCache]=None):
+        if arch not in ENCODERS:
+            raise KeyError(f"[Error] Unsupported architecture: {arch}")
+        self.arch = arch
+        self.include_pathes: list[str] = list(include_pathes) if include_pathes is not None else []
+        self.include_cache = include_cache if include_cache is not None else INCLUDE_CACHE
+        # set to a Profile to record the includes, macros and defines of the next updates
+        self.profile: Optional[Profile] = None
+        self.full_builds = 0
+        self.incremental_builds = 0
+        self._reset()
+
+    def __repr__(self) -> str:
+        return f"IncrementalAssembler(arch={self.arch}, lines={len(self.lines)}, full_builds={self.full_builds}, incremental_builds={self.incremental_builds})"
+
+    def _reset(self):
+        self.lines: list[str] = []
+        self.dependencies: dict[str, str] = {}
+        self.shadows: set[str] = set()
+        self._built = False
+        # per source line: preprocessed lines and instructions it produced, its kind,
+        # the .MACRO block it belongs to (-1 if none), the (level 0 defines, macros)
+        # count before it and its labels with their offset from its first instruction
+        self._ntuples: list[int] = []
+        self._ncode: list[int] = []
+        self._kind: list[int] = []
+        self._block: list[int] = []
+        self._state: list[tuple[int, int]] = []
+        self._labels: list[Optional[list[tuple[str, int]]]] = []
+        self._adopt(ProcessedLines(), MachineCode(), LinkState())
+        # define and macro tables at the end of the last full build
+        self._def_items: list[tuple[str, str]] = []
+        self._macros = Macros()
+        self._states: dict[tuple[int, int], tuple[Defines, Macros]] = {}
+        self._end_address = 0
+
+    def _adopt(self, processed:ProcessedLines, machine_code:MachineCode, ls:LinkState):
+        """Take over the tables of a full build, wrapped so that reading them from a result settles the deferred moves."""
+        self.processed = _IncrementalLines(processed, self._settle)
+        self.machine_code = _IncrementalCode(machine_code, self._settle)
+        self.ls = _IncrementalLinkState(ls.labels, self._settle)
+        self.ls.unresolved = ls.unresolved
+        # per preprocessed line: line number and address, per address: code (with
+        # the label value once resolved) and line number; the columns of processed
+        # and machine_code the assembler works on
+        self._row_linenos = processed.linenos
+        self._row_addresses = processed.addresses
+        self._codes = machine_code.codes
+        self._linenos = machine_code.linenos
+        # (first source line, line number delta, address delta): the line numbers and
+        # addresses of the source lines from first to the next entry are behind by the deltas
+        self._moves: list[tuple[int, int, int]] = []
+        # label references in address order: address, label as written, label name,
+        # (code without the label value, shift of the nibble); ls.unresolved is rebuilt
+        # from them when stale
+        self._ref_addresses, self._ref_labels, self._ref_names, self._ref_codes = self._ref_columns(ls.unresolved, machine_code.codes, machine_code.start)
+        self._stale_refs = False
+        # names of undefined labels that are referenced
+        self._undefined: set[str] = set()
+
+    def result(self) -> AssembleResult:
+        return AssembleResult(self.processed, self.machine_code, self.ls, self.arch, dict(self.dependencies), self.shadows)
+
+    def update(self, lines:Sequence[str]) -> AssembleResult:
+        """Assemble the new buffer contents, reusing what did not change."""
+        lines = list(lines)
+        if not self._built or not self._dependencies_current():
+            return self.rebuild(lines)
+        prefix, suffix = _common_affixes(self.lines, lines)
+        old_end = len(self.lines) - suffix
+        new_end = len(lines) - suffix
+        if prefix == old_end and prefix == new_end:
+            self._resolve(())
+            return self.result()
+        if any(kind != self._PLAIN for kind in self._kind[prefix:old_end]) or any(_directive_of(line) is not None for line in lines[prefix:new_end]):
+            return self.rebuild(lines)
+        if 0 < prefix < len(self.lines) and self._block[prefix - 1] >= 0 and self._block[prefix - 1] == self._block[prefix]:
+            # lines inserted into a .MACRO block
+            return self.rebuild(lines)
+        try:
+            region = self._process(lines, prefix, new_end, old_end)
+        except _FullRebuild:
+            return self.rebuild(lines)
+        self.incremental_builds += 1
+        self._splice(prefix, old_end, region, lines)
+        return self.result()
+
+    def rebuild(self, lines:Sequence[str]) -> AssembleResult:
+        """Assemble lines from scratch and keep the per-line results."""
+        lines = list(lines)
+        self._reset()
+        self.full_builds += 1
+        try:
+            session = Assembler(self.arch, self.include_pathes, include_cache=self.include_cache, profile=self.profile)
+            starts: list[tuple[int, int, int, int]] = []
+            processed = session._preprocess(lines, False, 0, starts)
+            for n, (index, pos, ndefs, nmacros) in enumerate(starts):
+                next_index, end = starts[n + 1][:2] if n + 1 < len(starts) else (len(lines), len(processed))
+                count = next_index - index
+                if count > 1:
+                    # .MACRO block, one preprocessed line per source line
+                    self._ntuples += [1] * count
+                    self._kind += [self._BLOCK] * count
+                    self._block += [index] * count
+                else:
+                    directive = _directive_of(lines[index])
+                    self._ntuples.append(end - pos)
+                    self._kind.append(self._PLAIN if directive is None else self._INCLUDE if directive == 4 else self._DIRECTIVE)
+                    self._block.append(-1)
+                self._state += [(ndefs, nmacros)] * count
+            machine_code = MachineCode()
+            ls = LinkState()
+            self._ncode, self._labels = self._encode(processed, self._ntuples, ls, machine_code, 0)
+        except Exception:
+            self._reset()
+            raise
+        self.lines = lines
+        self._adopt(processed, machine_code, ls)
+        self.dependencies = dict(session.dependencies)
+        self.shadows = set(session.shadows)
+        self._def_items = list(session.defines.defines[0].items())
+        self._macros = session.macros
+        self._end_address = session.address
+        self._built = True
+        self._resolve(range(len(self._ref_addresses)))
+        return self.result()
+
+    def _dependencies_current(self) -> bool:
+        for filename, digest in self.dependencies.items():
             try:
-                with open(include_filename, 'r', encoding='utf-8') as f:
-                    include_lines = f.readlines()
-                res = preprocess(include_lines, child, 0, include_pathes, defines, macros)
-                processed.extend(res)
-            except FileNotFoundError:
-                raise FileNotFoundError(f"[Error] Included file not found: {include_filename} (line {lineno})")
-            continue
-        
-        line = line.replace("\t", " ").strip()
-        for def_key, def_value in defines.items():
-            line = re.sub(rf"\b{re.escape(def_key)}\b", def_value, line)
-        # replace defines
-
-        if tok and macros.get_macro(tok[0].upper()) is not None and not child:
-            macro_name = tok[0].upper()
-            macro_args = tok[1:] if len(tok) > 1 else []
-            macro_def = macros.get_macro(macro_name)
-            if macro_def is None:
-                raise KeyError(f"[Error] Macro {macro_name} not found (line {lineno})")
-            macro_lines, params = macro_def
-            processed.append(("", lineno, "; " + unprocessed_line + " [MACRO]", address))
-            if len(macro_args) != len(params):
-                raise ValueError(f"[Error] Macro {macro_name} expects {len(params)} arguments, got {len(macro_args)} (line {lineno})")
-            defines.new_scope()
-            for p, a in zip(params, macro_args):
-                defines.add_def(p, a)
-            res = preprocess(macro_lines, True, i, include_pathes, defines, macros)
-            processed.extend(res)
-            defines.end_scope()
-            continue
+                if self.include_cache.read(filename)[2] != digest:
+                    return False
+            except OSError:
+                return False
+        return not any(os.path.exists(shadow) for shadow in self.shadows)
 
+    def _state_tables(self, state:tuple[int, int]) -> tuple[Defines, Macros]:
+        """Define table and macros as they were before a line with the given state."""
+        cached = self._states.get(state)
+        if cached is None or cached[0].level != 0:
+            ndefs, nmacros = state
+            macros = Macros(dict(list(self._macros.macros.items())[:nmacros]))
+            macros.templates = {name: template for name, template in self._macros.templates.items() if name in macros.macros}
+            cached = self._states[state] = (Defines(dict(self._def_items[:ndefs])), macros)
+        return cached
 
-        processed.append((line, lineno, unprocessed_line, address))
-        if tok[0].upper() in INST_TYPES:
-            address += 1
+    def _encode(self, processed:ProcessedLines, ntuples:list[int], ls:LinkState, machine_code:MachineCode,
+                address:int, check=None) -> tuple[list[int], list[Optional[list[tuple[str, int]]]]]:
+        """
+        Encode preprocessed lines source line by source line from address on.
+        Returns the number of instructions and the labels of every source line.
+        check is called with the new labels of a line as soon as it is encoded.
+        """
+        encoders = ENCODERS[self.arch]
+        ncode: list[int] = []
+        labels: list[Optional[list[tuple[str, int]]]] = []
+        pos = 0
+        for count in ntuples:
+            nlabels = len(ls.labels)
+            end = _encode_lines(processed[pos:pos + count], encoders, ls, machine_code, address)
+            if len(ls.labels) != nlabels:
+                added = list(itertools.islice(reversed(ls.labels.items()), len(ls.labels) - nlabels))[::-1]
+                if check is not None:
+                    check(added)
+                labels.append([(label, label_address - address) for label, label_address in added])
+            else:
+                labels.append(None)
+            ncode.append(end - address)
+            pos += count
+            address = end
+        return ncode, labels
 
-    return processed
+    def _process(self, lines:list[str], start:int, end:int, old_end:int) -> _Region:
+        """Preprocess and encode lines[start:end], which replace the old lines start to old_end, in the state line start was in."""
+        n_old = len(self.lines)
+        pos = sum(self._ntuples[:start])
+        old_pos_end = pos + sum(self._ntuples[start:old_end])
+        if start < n_old:
+            state = self._state[start]
+            address = self._row_addresses[pos] + self._deferred(start)[1]
+        else:
+            state = (len(self._def_items), len(self._macros.macros))
+            address = self._end_address
+        old_address = self._row_addresses[old_pos_end] + self._deferred(old_end)[1] if old_end < n_old else self._end_address
+        defines, macros = self._state_tables(state)
+        session = Assembler(self.arch, self.include_pathes, defines, macros, self.include_cache, self.profile)
+        session.address = address
+        starts: list[tuple[int, int, int, int]] = []
+        processed = session._preprocess(lines[start:end], False, start, starts)
+        if session.dependencies or session.shadows:
+            raise _FullRebuild()
+        bounds = [entry[1] for entry in starts] + [len(processed)]
+        ntuples = [bounds[n + 1] - bounds[n] for n in range(len(starts))]
 
-def adrlist2bitstream(adrlist:dict[int, tuple[int, int]], filler:int=255) -> list[int]:
-    t1 = [code for addr, (code, lineno) in adrlist.items()]
-    if len(t1) == 0:
+        # Duplicate labels are reported where a full build would: a label defined
+        # before the region at once, one defined after it once the region is encoded.
+        astart = sum(self._ncode[:start])
+        old_count = sum(self._ncode[start:old_end])
+        owned = {label for entry in self._labels[start:old_end] if entry for label, _ in entry}
+        later: list[tuple[int, str]] = []
+        def check(added:list[tuple[str, int]]):
+            for label, _ in added:
+                existing = self.ls.labels.get(label) if label not in owned else None
+                if existing is None:
+                    continue
+                if existing < astart or (existing == astart and old_count > 0):
+                    raise ValueError(f"[Error] Duplicate label definition: {label}")
+                if existing == astart:
+                    # right at the region, before or after it
+                    raise _FullRebuild()
+                later.append((existing, label))
+        ls = LinkState()
+        machine_code = MachineCode(astart)
+        ncode, labels = self._encode(processed, ntuples, ls, machine_code, astart, check)
+        if later:
+            raise ValueError(f"[Error] Duplicate label definition: {min(later)[1]}")
+        return _Region(processed, ntuples, ncode, labels, machine_code, ls.unresolved, state, session.address - old_address,
+                       (pos, old_pos_end), (astart, astart + old_count))
+
+    @staticmethod
+    def _ref_columns(refs:dict[int, str], codes:array, start:int) -> tuple[array, list[str], list[str], list[tuple[int, int]]]:
+        """Columns of the label references refs (address -> label) to the code from start."""
+        addresses = array('I', sorted(refs))
+        labels = [refs[address] for address in addresses]
+        names: list[str] = []
+        bases: list[tuple[int, int]] = []
+        for address, label in zip(addresses, labels):
+            # same reading of the reference as LinkState.parse_label
+            sliced = label.split(":")[:2]
+            names.append(sliced[0].upper())
+            bases.append((codes[address - start], int(sliced[1]) * 4))
+        return addresses, labels, names, bases
+
+    def _splice(self, start:int, old_end:int, region:_Region, lines:list[str]):
+        """Put region in place of the old lines start to old_end, move what follows and re-resolve what the edit affects."""
+        ls = self.ls
+        pos, old_pos_end = region.rows
+        astart, aend = region.span
+        line_delta = len(region.ntuples) - (old_end - start)
+        address_delta = region.address_delta
+        code_delta = len(region.codes) - (aend - astart)
+
+        # labels
+        owned = {label: ls.labels.pop(label) for entry in self._labels[start:old_end] if entry for label, _ in entry}
+        moved: set[str] = set()
+        if code_delta:
+            moved.update(label for entry in filter(None, self._labels[old_end:]) for label, _ in entry)
+            for label in moved:
+                ls.labels[label] += code_delta
+        address = astart
+        added: dict[str, int] = {}
+        for ncode, entry in zip(region.ncode, region.labels):
+            if entry:
+                for label, offset in entry:
+                    added[label] = address + offset
+            address += ncode
+        ls.labels.update(added)
+        moved |= {label for label in owned.keys() | added.keys() if owned.get(label) != added.get(label)}
+
+        # machine code and preprocessed lines, the rows after them are moved by _settle
+        self._codes[astart:aend] = region.codes
+        self._linenos[astart:aend] = region.linenos
+        processed = self.processed
+        processed.texts[pos:old_pos_end] = region.tuples.texts
+        processed.sources[pos:old_pos_end] = region.tuples.sources
+        self._row_linenos[pos:old_pos_end] = region.tuples.linenos
+        self._row_addresses[pos:old_pos_end] = region.tuples.addresses
+        if line_delta or address_delta or self._moves:
+            self._defer(start, old_end, line_delta, address_delta)
+
+        # label references
+        first = bisect_left(self._ref_addresses, astart)
+        last = bisect_left(self._ref_addresses, aend, first)
+        addresses, labels, names, bases = self._ref_columns(region.refs, region.codes, astart)
+        addresses_after = self._ref_addresses[last:]
+        if code_delta:
+            addresses_after = array('I', map(code_delta.__add__, addresses_after))
+        self._ref_addresses[first:] = addresses + addresses_after
+        self._ref_labels[first:last] = labels
+        self._ref_names[first:last] = names
+        self._ref_codes[first:last] = bases
+        self._stale_refs = True
+
+        # per-line tables
+        count = len(region.ntuples)
+        self._ntuples[start:old_end] = region.ntuples
+        self._ncode[start:old_end] = region.ncode
+        self._kind[start:old_end] = [self._PLAIN] * count
+        self._block[start:old_end] = [-1] * count
+        self._state[start:old_end] = [region.state] * count
+        self._labels[start:old_end] = region.labels
+        self._end_address += address_delta
+        self.lines = lines
+        if len(self._moves) > self._MAX_MOVES:
+            self._settle()
+
+        to_resolve = list(range(first, first + len(addresses)))
+        if moved:
+            to_resolve += itertools.compress(itertools.count(), map(moved.__contains__, self._ref_names))
+        self._resolve(to_resolve)
+
+    def _deferred(self, line:int) -> tuple[int, int]:
+        """Line number and address delta the rows of a source line are behind by."""
+        n = bisect_right(self._moves, line, key=lambda move: move[0])
+        return self._moves[n - 1][1:] if n else (0, 0)
+
+    def _defer(self, start:int, old_end:int, line_delta:int, address_delta:int):
+        """Record that the source lines from old_end on move by the deltas, and that the new lines start to old_end + line_delta are up to date."""
+        moves = self._moves
+        behind = self._deferred(old_end)
+        after = [(first + line_delta, lines + line_delta, addresses + address_delta)
+                 for first, lines, addresses in moves[bisect_right(moves, old_end, key=lambda move: move[0]):]]
+        self._moves = []
+        for move in moves[:bisect_left(moves, start, key=lambda move: move[0])] + [
+                (start, 0, 0), (old_end + line_delta, behind[0] + line_delta, behind[1] + address_delta)] + after:
+            if move[1:] != (self._moves[-1][1:] if self._moves else (0, 0)):
+                self._moves.append(move)
+
+    def _settle(self):
+        """Apply the deferred moves to the line numbers and addresses, and rebuild ls.unresolved if stale."""
+        moves, self._moves = self._moves, []
+        line = pos = address = 0
+        for n, (first, line_delta, address_delta) in enumerate(moves):
+            pos += sum(self._ntuples[line:first])
+            address += sum(self._ncode[line:first])
+            end = moves[n + 1][0] if n + 1 < len(moves) else len(self._ntuples)
+            self._shift(first, end, pos, address, line_delta, address_delta)
+            line = first
+        if self._stale_refs:
+            self._stale_refs = False
+            self.ls.unresolved = dict(zip(self._ref_addresses, self._ref_labels))
+
+    def _shift(self, first:int, end:int, pos:int, address:int, line_delta:int, address_delta:int):
+        """Move the preprocessed lines from pos and the code from address of the source lines first to end; included lines keep their line numbers."""
+        count = sum(self._ntuples[first:end])
+        linenos, addresses = self._row_linenos, self._row_addresses
+        if address_delta:
+            addresses[pos:pos + count] = array('I', map(address_delta.__add__, addresses[pos:pos + count]))
+        if not line_delta:
+            return
+        if self._INCLUDE not in self._kind[first:end]:
+            ncode = sum(self._ncode[first:end])
+            linenos[pos:pos + count] = array('I', map(line_delta.__add__, linenos[pos:pos + count]))
+            self._linenos[address:address + ncode] = array('I', map(line_delta.__add__, self._linenos[address:address + ncode]))
+            return
+        for kind, count, ncode in zip(self._kind[first:end], self._ntuples[first:end], self._ncode[first:end]):
+            if kind == self._INCLUDE:
+                # the directive moves, the included lines and their code do not
+                linenos[pos] += line_delta
+            else:
+                linenos[pos:pos + count] = array('I', map(line_delta.__add__, linenos[pos:pos + count]))
+                self._linenos[address:address + ncode] = array('I', map(line_delta.__add__, self._linenos[address:address + ncode]))
+            pos += count
+            address += ncode
+
+    def _resolve(self, refs:Iterable[int]):
+        """Add the label values to the label references with the given indices; raise for the first undefined label in the program."""
+        labels = self.ls.labels
+        codes = self._codes
+        addresses, names, bases = self._ref_addresses, self._ref_names, self._ref_codes
+        for n in refs:
+            label_address = labels.get(names[n])
+            if label_address is None:
+                self._undefined.add(names[n])
+                continue
+            base, shift = bases[n]
+            codes[addresses[n]] = base + ((label_address >> shift) & 0x0F)
+        if self._undefined:
+            self._undefined = {name for name in self._undefined if name not in labels}
+            first = next((n for n, name in enumerate(names) if name in self._undefined), None)
+            if first is None:
+                # the references went away with the lines they were in
+                self._undefined.clear()
+            else:
+                raise KeyError(f"[Error] Undefined label: {self._ref_labels[first]}")
+
+def adrlist2bitstream(adrlist:"dict[int, tuple[int, int]] | MachineCode", filler:int=255) -> list[int]:
+    if isinstance(adrlist, MachineCode):
+        return adrlist.bitstream(filler)
+    if not adrlist:
         return []
-    max_addr = max(adrlist.keys())
-    bitstream = [filler] * (max_addr + 1)
+    bitstream = [filler] * (max(adrlist) + 1)
     for addr, (code, lineno) in adrlist.items():
         bitstream[addr] = code
     return bitstream
 
+def _fuzz_defines(rounds:int=300):
+    """Compare Defines.substitute against one re.sub per define, in items() order."""
+    import random
+    rng = random.Random(1234)
+    names = ["A", "B", "C", "R1", "x", "dst", "src", "L_1", "_", "9"]
+    for _ in range(rounds):
+        defs = Defines()
+        for _ in range(rng.randint(0, 3)):
+            for _ in range(rng.randint(0, 5)):
+                key = rng.choice(names)
+                if key not in defs.defines[defs.level]:
+                    defs.add_def(key, " ".join(rng.choice(names + ["r2", "#3", "+"]) for _ in range(rng.randint(0, 3))))
+            line = " ".join(rng.choice(names + ["LD", "#A:1", "r3", "A,B"]) for _ in range(rng.randint(0, 6)))
+            expected = line
+            for def_key, def_value in defs.items():
+                expected = re.sub(rf"\b{re.escape(def_key)}\b", def_value, expected)
+            result = defs.substitute(line)
+            if result != expected:
+                raise AssertionError(f"[FAIL] Defines.substitute({line!r}) == {result!r}, expected {expected!r} with {list(defs.items())}")
+            if defs.level > 0 and rng.random() < 0.3:
+                defs.end_scope()
+            else:
+                defs.new_scope()
+    print(f"[OK] Defines.substitute matches sequential re.sub over {rounds} random define tables")
+
+def _compare_macro_templates():
+    """Expanding compiled macro templates must give the same result as preprocessing the body again."""
+    class UncompiledMacros(Macros):
+        def get_template(self, name:str) -> Optional[MacroTemplate]:
+            return None
+
+    source = """.DEFINE OUT r14
+    .DEF SRC r3
+    .MACRO MOV dst src ; copy
+    LD src
+    \tSA dst   ; store
+    .ENDM
+    .MACRO LOCAL a
+    .DEF TMP a
+    LD TMP
+    ; comment only
+    AD a
+    .ENDMACRO
+    .MACRO GOTO label
+    LI #label:1
+    LI #label:0
+    JP
+    .ENDM
+    START: MOV OUT SRC
+    MOV r1 OUT
+    LOCAL SRC
+    GOTO START
+    .DEF LATE r9
+    MOV LATE r2
+    """.splitlines()
+    compiled = preprocess(source, False, 0, [], Defines(), Macros())
+    uncompiled = preprocess(source, False, 0, [], Defines(), UncompiledMacros())
+    testfuncs.expect(uncompiled, lambda: compiled)
+
+def _check_ir():
+    """ProcessedLines and MachineCode behave like the list and dict they replace."""
+    rows = [("LD r1", 1, "LD r1", 0), ("", 2, "; x", 1), ("JP", 3, "JP ; go", 1)]
+    processed = ProcessedLines(rows)
+    testfuncs.expect(True, lambda: processed == rows and processed[1:] == rows[1:] and processed[-1] == rows[-1])
+    processed[1:2] = [("NP", 5, "NP", 1), ("NP", 6, "NP", 2)]
+    del processed[0]
+    testfuncs.expect([("NP", 5, "NP", 1), ("NP", 6, "NP", 2), ("JP", 3, "JP ; go", 1)], list, processed + [])
+    machine_code = MachineCode(2)
+    machine_code[2] = (0x91, 1)
+    machine_code[3] = (0xE0, 2)
+    machine_code[2] = (0x92, 1)
+    testfuncs.expect({2: (0x92, 1), 3: (0xE0, 2)}, lambda: machine_code)
+    testfuncs.expect([0xFF, 0xFF, 0x92, 0xE0], adrlist2bitstream, machine_code)
+    testfuncs.expect([False, True, None], lambda: [1 in machine_code, 3 in machine_code, machine_code.get(4)])
+    testfuncs.expect_raises(KeyError, machine_code.__setitem__, 7, (0, 0))
+    image = build_image(machine_code)
+    testfuncs.expect([b"\xff\xff\x92\xe0", [(2, 4)]], lambda: [bytes(image.view()), image.regions])
+    image = build_image({0: (0x90, 1), 1: (0x91, 2), 4: (0xE0, 3)}, 0)
+    testfuncs.expect([b"\x90\x91\x00\x00\xe0", [(0, 2), (4, 5)]], lambda: [bytes(image.data), image.regions])
+
+def _check_include_cache():
+    """A cached include must splice in exactly what preprocessing the file gives, and notice edits."""
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        inc = Path(tmp) / "lib.inc"
+        inc.write_text(".DEF OUT r14\n.MACRO PUT v\nLI v\nSA OUT\n.ENDM\nNP\n", encoding="utf-8")
+        source = ["NP", ".INC \"lib.inc\"", "PUT #3"]
+        cache = IncludeCache()
+        results = []
+        for _ in range(2):
+            results.append(preprocess(source, False, 0, [tmp], Defines(), Macros(), cache))
+        testfuncs.expect(results[0], lambda: results[1])
+        testfuncs.expect((1, 1), lambda: (cache.hits, cache.misses))
+        inc.write_text(".DEF OUT r15\n.MACRO PUT v\nLI v\nSA OUT\n.ENDM\n", encoding="utf-8")
+        os.utime(inc, ns=(0, 0))
+        edited = preprocess(source, False, 0, [tmp], Defines(), Macros(), cache)
+        testfuncs.expect(("SA r15", 2), lambda: (edited[-1][0], edited[-1][3]))
+        testfuncs.expect((1, 2), lambda: (cache.hits, cache.misses))
+        # a file added to an earlier include path shadows the one found before, also when included by an include
+        src, lib = Path(tmp) / "src", Path(tmp) / "lib"
+        src.mkdir()
+        lib.mkdir()
+        (lib / "x.inc").write_text("LI #1\n", encoding="utf-8")
+        (lib / "outer.inc").write_text('.INC "x.inc"\n', encoding="utf-8")
+        for name in ("x.inc", "outer.inc"):
+            lines = [f'.INC "{name}"']
+            testfuncs.expect(["LI #1"], lambda: [row[0] for row in preprocess(lines, False, 0, [str(src), str(lib)], Defines(), Macros(), cache) if row[0]])
+        (src / "x.inc").write_text("LI #7\n", encoding="utf-8")
+        for name in ("x.inc", "outer.inc"):
+            lines = [f'.INC "{name}"']
+            testfuncs.expect(["LI #7"], lambda: [row[0] for row in preprocess(lines, False, 0, [str(src), str(lib)], Defines(), Macros(), cache) if row[0]])
+        # a resolution is remembered once its directories are older than RACY_MTIME_NS, and forgotten when a file is added
+        first, second = Path(tmp) / "first", Path(tmp) / "second"
+        first.mkdir()
+        second.mkdir()
+        (second / "y.inc").write_text("LI #2\n", encoding="utf-8")
+        for directory in (first, second):
+            os.utime(directory, ns=(0, 0))
+        pathes = [str(first), str(second)]
+        testfuncs.expect((str(second / "y.inc"), (str(first / "y.inc"),)), cache.resolve, "y.inc", pathes)
+        testfuncs.expect(True, lambda: (tuple(pathes), "y.inc") in cache._resolved)
+        (first / "y.inc").write_text("LI #3\n", encoding="utf-8")
+        testfuncs.expect((str(first / "y.inc"), ()), cache.resolve, "y.inc", pathes)
+        # at most max_lines preprocessed lines are kept, least recently used first, and the files only they used go
+        (Path(tmp) / "a.inc").write_text("LD K\nSA K\n", encoding="utf-8")
+        (Path(tmp) / "b.inc").write_text("NP\n", encoding="utf-8")
+        small = IncludeCache(max_lines=6)
+        preprocess(['.INC "b.inc"'], False, 0, [tmp], Defines(), Macros(), small)
+        for n in range(5):
+            preprocess([f".DEF K r{n}", '.INC "a.inc"'], False, 0, [tmp], Defines(), Macros(), small)
+            preprocess([".DEF K r0", '.INC "a.inc"'], False, 0, [tmp], Defines(), Macros(), small)
+        testfuncs.expect([3, 6], lambda: [len(small._entries), small._lines])
+        testfuncs.expect([True, False], lambda: [str(Path(tmp) / "a.inc") in small._files, str(Path(tmp) / "b.inc") in small._files])
+        # r0 was used last, r4 before it: both still hit
+        hits = small.hits
+        for n in (0, 4):
+            preprocess([f".DEF K r{n}", '.INC "a.inc"'], False, 0, [tmp], Defines(), Macros(), small)
+        testfuncs.expect(2, lambda: small.hits - hits)
+
+def _check_profile():
+    """A profiled session must give the same result and count every include, macro call and define use."""
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        inc = Path(tmp) / "lib.inc"
+        inc.write_text(".DEF OUT r14\n.MACRO PUT v\nLI v\nSA OUT\n.ENDM\n", encoding="utf-8")
+        source = [".INC \"lib.inc\"", ".DEF X r3", "LD X", "AD X", "PUT #3", "PUT #4", "SA OUT"]
+        plain = Assembler("HC4", [tmp], include_cache=IncludeCache()).run(source)
+        profile = Profile()
+        profiled = Assembler("HC4", [tmp], include_cache=IncludeCache(), profile=profile).run(source)
+        testfuncs.expect(plain.machine_code, lambda: profiled.machine_code)
+        report = profile.report()
+        testfuncs.expect([["preprocess", 1], ["assemble", 1]], lambda: [[s["name"], s["calls"]] for s in report["stages"]])
+        testfuncs.expect([str(inc), 1, 0, 5], lambda: [report["includes"][0][k] for k in ("file", "calls", "cache_hits", "lines")])
+        testfuncs.expect([["PUT", 2, 4]], lambda: [[m["name"], m["calls"], m["lines"]] for m in report["macros"]])
+        testfuncs.expect({"X": 2, "OUT": 1}, lambda: {d["name"]: d["uses"] for d in report["defines"]})
+
+def _fuzz_operands(rounds:int=3000):
+    """The hand written operand parsers must agree with the regular expressions they replace."""
+    import random
+    rng = random.Random(5678)
+    alphabet = "#rR0123456789abfxXLOP_:-, "
+    for _ in range(rounds):
+        oprand = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 8)))
+        found = re.findall(r"[rR]([0-9]*)", oprand)
+        try:
+            register: Optional[int] = _parse_register(oprand, 0)
+        except ValueError:
+            register = None
+        if register != (int(found[0]) if found and found[0] else None):
+            raise AssertionError(f"[FAIL] _parse_register({oprand!r}) == {register}, expected {found}")
+        found = re.findall(r"#([A-Za-z_][A-Za-z0-9_]*:[0-3])", oprand)
+        if _parse_label_ref(oprand) != (found[0] if found else None):
+            raise AssertionError(f"[FAIL] _parse_label_ref({oprand!r}) == {_parse_label_ref(oprand)}, expected {found}")
+        found = re.findall(r"#((0x|0b)?[0-9a-fA-F]+)", oprand)
+        try:
+            expected: Optional[int] = int(found[0][0], 0) if found else None
+        except ValueError:
+            expected = None
+        try:
+            immediate: Optional[int] = _parse_immediate(oprand, 0)
+        except ValueError:
+            immediate = None
+        if immediate != expected:
+            raise AssertionError(f"[FAIL] _parse_immediate({oprand!r}) == {immediate}, expected {expected}")
+    print(f"[OK] operand parsers match the regular expressions over {rounds} random operands")
+
+def _check_sessions(workers:int=8, rounds:int=40):
+    """Sessions must not share defines, macros or addresses, also when run from several threads at once."""
+    from concurrent.futures import ThreadPoolExecutor
+    # state left behind by one call must not reach the next
+    preprocess([".DEF LEAK r9", "LD r1", "LD r2"], False, 0, [])
+    testfuncs.expect([("LD LEAK", 1, "LD LEAK", 0)], preprocess, ["LD LEAK"], False, 0, [])
+    programs = []
+    for n in range(workers):
+        programs.append("\n".join([
+            f".DEF REG r{n}",
+            ".MACRO TWICE X",
+            "LD X",
+            "LD X",
+            ".ENDM",
+            *(["TWICE REG", "NP"] * (n + 1)),
+            "LOOP:",
+            "LI #LOOP:0",
+            "JP",
+        ]))
+    expected = [assemble_source(program, "HC4").machine_code for program in programs]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in range(rounds // workers):
+            results = list(pool.map(lambda program: assemble_source(program, "HC4").machine_code, programs))
+            if results != expected:
+                raise AssertionError("[Error] Concurrent assembler sessions disagree with sequential runs")
+    testfuncs.expect(3 * workers + 2, len, assemble_source(programs[workers - 1]).bitstream)
+
+def _fuzz_incremental(rounds:int=60, edits:int=40):
+    """
+    IncrementalAssembler.update must always give the same result as assembling the buffer from scratch,
+    also when the line numbers and addresses are only read every few edits.
+    """
+    import random
+    import tempfile
+    rng = random.Random(4321)
+    header = [".DEF OUT r14", ".MACRO PUT X", "LD X", "SA OUT", ".ENDM", ".MACRO GO L", "LI #L:0", "LI #L:1", "JP", ".ENDM"]
+    def random_line() -> str:
+        n = rng.randrange(6)
+        return rng.choice([
+            f"LD r{n}", f"AD r{n}", "SM", "LM", "NP", f"LI #{n}", "JP NC", "JP Z",
+            f"LI #L{n}:0", f"LI #L{n}:1", f"L{n}:", f"L{n}: SA r1", f"PUT r{n}", f"GO L{n}",
+            "SA OUT", "", "; comment", f"LD r{n}  ; load", f".DEF V{rng.randrange(1000)} r2", "LD V", '.INC "lib.inc"',
+        ])
+    def outcome(func, read:bool):
+        try:
+            result = func()
+        except (KeyError, ValueError) as e:
+            return ("error", type(e), str(e))
+        if not read:
+            return (bytes(result.machine_code.codes), result.ls.labels)
+        return (result.lines, result.machine_code, result.ls.labels, result.ls.unresolved)
+    checked = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        (Path(tmp) / "lib.inc").write_text("NP\nLD r1  ; included\nPUT r2\n", encoding="utf-8")
+        for round in range(rounds):
+            lines = header + [random_line() for _ in range(rng.randint(0, 40))]
+            inc = IncrementalAssembler("HC4", [tmp])
+            for edit in range(edits):
+                read = round % 2 == 0 or edit % 4 == 3
+                expected = outcome(lambda: Assembler("HC4", [tmp]).run(lines), read)
+                got = outcome(lambda: inc.update(lines), read)
+                if expected[0] == "error":
+                    got = got if got[0] == "error" else ("no error",)
+                if got != expected:
+                    raise AssertionError(f"[FAIL] IncrementalAssembler.update differs from a full build for {lines}:\n{got}\n{expected}")
+                checked += 1
+                at = rng.randint(len(header), len(lines))
+                match rng.randrange(4):
+                    case 0 if at < len(lines):
+                        lines = lines[:at] + [random_line()] + lines[at + 1:]
+                    case 1:
+                        lines = lines[:at] + [random_line() for _ in range(rng.randint(1, 3))] + lines[at:]
+                    case 2:
+                        lines = lines[:at] + lines[at + rng.randint(1, 3):]
+                    case _:
+                        lines = list(lines)
+    print(f"[OK] IncrementalAssembler.update matches a full build after {checked} random edits")
+
 def self_test():
     testfuncs.expect({0:(0x00, 1), 1:(0x1A, 2), 2:(0x2F, 3), 3:(0xA5, 4), 4:(0xE3, 5), 5:(0xE0, 6)}, assemble, [
         ("SM", 1), ("SC r10", 2), ("SU r15", 3), ("LI #5", 4), ("JP NC", 5), ("JP", 6)], LinkState(), "HC4"
@@ -352,6 +2011,17 @@ def self_test():
     testfuncs.expect({0:(0x91, 6), 1:(0x92, 6), 2:(0x31, 6), 3:(0xE0, 7)}, assemble, processed, LinkState(), "HC4")
     testfuncs.expect_raises(KeyError, assemble, [("XX r1", 1)], LinkState(), "HC4")
     testfuncs.expect_raises(ValueError, assemble, [("SC r16", 1)], LinkState(), "HC4")
+    testfuncs.expect("LD r2", Defines({"A": "B", "B": "r2"}).substitute, "LD A")
+    testfuncs.expect("LD B", Defines({"B": "r2", "A": "B"}).substitute, "LD A")
+    testfuncs.expect("LI #5 ; r1", Defines({"R": "r1", "IMM": "5"}).substitute, "LI #IMM ; R")
+    _fuzz_defines()
+    _compare_macro_templates()
+    _check_include_cache()
+    _check_profile()
+    _fuzz_operands()
+    _check_ir()
+    _check_sessions()
+    _fuzz_incremental()
     testfuncs.expect_raises(ValueError, assemble, [("LI #16", 1)], LinkState(), "HC4")
 
     print("[OK] assembler.py : All tests passed.")
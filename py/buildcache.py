@@ -0,0 +1,220 @@
+"""
+On-disk build cache
+
+Assembled images, label tables and listings keyed by the SHA-256 of the source
+text, the architecture, the include paths, a version string of the assembler
+code and the content hash of every file the assembly read through .INCLUDE,
+directly or not. Two kinds of files live in the cache directory:
+    <source key>.deps   the files the last assembly of that source included, and
+                        the files in earlier include paths that would shadow them
+    <key>.hcxc          one JSON header line (labels, regions, lines, listing),
+                        then the raw image bytes
+A lookup hashes the source, reads the .deps file, hashes the files it names
+(IncludeCache.read, which skips unchanged files by mtime and size) and opens
+the entry under the resulting key, so editing an include and undoing the edit
+finds the earlier entry again. A lookup misses as soon as one of the shadowing
+files exists, since the assembly would include it instead.
+Entries are written atomically; when the directory grows over max_bytes the
+least recently used files (by mtime, which a hit refreshes) are removed.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from typing import Iterable, Optional, Sequence
+
+import assembler
+import testfuncs
+
+DEFAULT_MAX_BYTES = 64 << 20
+
+def default_directory() -> str:
+    """$HCXASM_CACHE_DIR, else hcxasm under $XDG_CACHE_HOME or ~/.cache."""
+    if os.environ.get("HCXASM_CACHE_DIR"):
+        return os.environ["HCXASM_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "hcxasm")
+
+def code_version(*filenames:str) -> str:
+    """Version string of the assembler code: a hash of the given source files."""
+    digest = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+class CacheEntry:
+    """One cached build: the image with its regions, the label table, the preprocessed line count and the listing if it was made."""
+    __slots__ = ("data", "regions", "labels", "lines", "listing")
+
+    def __init__(self, data:bytes, regions:Sequence[tuple[int, int]], labels:dict[str, int], lines:int, listing:Optional[str]=None):
+        self.data = data
+        self.regions = [tuple(region) for region in regions]
+        self.labels = labels
+        self.lines = lines
+        self.listing = listing
+
+    def __repr__(self) -> str:
+        return f"CacheEntry(bytes={len(self.data)}, lines={self.lines}, labels={len(self.labels)}, listing={self.listing is not None})"
+
+    @property
+    def image(self) -> assembler.Image:
+        return assembler.Image(bytearray(self.data), self.regions)
+
+class BuildCache:
+    """Cache directory of assembled builds, bounded to max_bytes; entries from another version are never found."""
+    def __init__(self, directory:str, max_bytes:int=DEFAULT_MAX_BYTES, version:str=""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self) -> str:
+        return f"BuildCache({self.directory!r}, hits={self.hits}, misses={self.misses})"
+
+    def source_key(self, source:str, arch:str, include_pathes:Sequence[str]) -> str:
+        material = json.dumps([self.version, arch, [os.path.abspath(p) for p in include_pathes], source])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def key(source_key:str, dependencies:dict[str, str]) -> str:
+        """Entry key of a source key and the (path -> content hash) of the files it included."""
+        digest = hashlib.sha256(source_key.encode("ascii"))
+        for path in sorted(dependencies):
+            digest.update(f"\0{path}\0{dependencies[path]}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, name:str) -> str:
+        return os.path.join(self.directory, name)
+
+    def get(self, source:str, arch:str, include_pathes:Sequence[str], listing:bool=False) -> Optional[CacheEntry]:
+        """The cached build of source, or None. With listing=True an entry without a listing does not count."""
+        entry = self._load(self.source_key(source, arch, include_pathes), listing)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def _load(self, source_key:str, listing:bool) -> Optional[CacheEntry]:
+        deps_file = self._path(source_key + ".deps")
+        try:
+            with open(deps_file, "r", encoding="utf-8") as f:
+                deps = json.load(f)
+            if any(os.path.exists(path) for path in deps["shadows"]):
+                return None
+            dependencies = {path: assembler.INCLUDE_CACHE.read(path)[2] for path in deps["files"]}
+            filename = self._path(self.key(source_key, dependencies) + ".hcxc")
+            with open(filename, "rb") as f:
+                header, _, data = f.read().partition(b"\n")
+            fields = json.loads(header)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if listing and fields.get("listing") is None:
+            return None
+        # a hit makes both files the most recently used
+        for path in (deps_file, filename):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return CacheEntry(data, fields["regions"], fields["labels"], fields["lines"], fields.get("listing"))
+
+    def put(self, source:str, arch:str, include_pathes:Sequence[str], dependencies:dict[str, str], entry:CacheEntry,
+            shadows:Iterable[str]=()):
+        """
+        Store entry for source, built from the files in dependencies (path ->
+        content hash); shadows are the files whose appearance would change the build.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        source_key = self.source_key(source, arch, include_pathes)
+        header = {"regions": entry.regions, "labels": entry.labels, "lines": entry.lines, "listing": entry.listing}
+        self._write(self.key(source_key, dependencies) + ".hcxc", json.dumps(header).encode("utf-8") + b"\n" + bytes(entry.data))
+        self._write(source_key + ".deps", json.dumps({"files": sorted(dependencies), "shadows": sorted(shadows)}).encode("utf-8"))
+        self.evict()
+
+    def _write(self, name:str, data:bytes):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(name))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def evict(self):
+        """Remove the least recently used files until the cache fits in max_bytes."""
+        files = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for item in it:
+                if item.name.endswith((".hcxc", ".deps")):
+                    st = item.stat()
+                    files.append((st.st_mtime_ns, st.st_size, item.path))
+                    total += st.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+
+def self_test():
+    with tempfile.TemporaryDirectory() as tmp:
+        inc = os.path.join(tmp, "lib.inc")
+        with open(inc, "w", encoding="utf-8") as f:
+            f.write(".DEF OUT r14\n")
+        source = '.INC "lib.inc"\nLD OUT\nSA r1\n'
+        cache = BuildCache(os.path.join(tmp, "cache"), version="1")
+
+        def build() -> CacheEntry:
+            result = assembler.Assembler("HC4", [tmp]).run(source.splitlines())
+            entry = CacheEntry(bytes(result.image.data), result.image.regions, dict(result.ls.labels), len(result.lines))
+            cache.put(source, "HC4", [tmp], result.dependencies, entry, result.shadows)
+            return entry
+
+        testfuncs.expect(None, cache.get, source, "HC4", [tmp])
+        built = build()
+        hit = cache.get(source, "HC4", [tmp])
+        testfuncs.expect([built.data, built.regions, 1, 1], lambda: [hit.data, hit.regions, cache.hits, cache.misses])
+        # a listing was not stored, another architecture or version is a different key
+        testfuncs.expect(None, cache.get, source, "HC4", [tmp], True)
+        testfuncs.expect(None, cache.get, source, "HC4E", [tmp])
+        testfuncs.expect(None, BuildCache(cache.directory, version="2").get, source, "HC4", [tmp])
+        # editing the include misses, undoing the edit hits the first entry again
+        for n, (text, expected) in enumerate(((".DEF OUT r13\n", None), (".DEF OUT r14\n", built.data))):
+            with open(inc, "w", encoding="utf-8") as f:
+                f.write(text)
+            # same size as before: a new mtime makes IncludeCache.read hash the file again
+            os.utime(inc, ns=(n, n))
+            found = cache.get(source, "HC4", [tmp])
+            testfuncs.expect(expected, lambda: found.data if found is not None else None)
+            if found is None:
+                build()
+        # a file that would shadow lib.inc misses, removing it hits again
+        other = BuildCache(os.path.join(tmp, "other"), version="1")
+        lib = os.path.join(tmp, "lib")
+        os.makedirs(lib)
+        shadowed = assembler.Assembler("HC4", [lib, tmp]).run(source.splitlines())
+        other.put(source, "HC4", [lib, tmp], shadowed.dependencies,
+                  CacheEntry(bytes(shadowed.image.data), shadowed.image.regions, {}, len(shadowed.lines)), shadowed.shadows)
+        testfuncs.expect(True, lambda: other.get(source, "HC4", [lib, tmp]) is not None)
+        with open(os.path.join(lib, "lib.inc"), "w", encoding="utf-8") as f:
+            f.write(".DEF OUT r13\n")
+        testfuncs.expect(None, other.get, source, "HC4", [lib, tmp])
+        os.unlink(os.path.join(lib, "lib.inc"))
+        testfuncs.expect(True, lambda: other.get(source, "HC4", [lib, tmp]) is not None)
+        # only the most recently used files are kept
+        small = BuildCache(cache.directory, max_bytes=1, version="1")
+        small.evict()
+        testfuncs.expect([], os.listdir, cache.directory)
+    print("[OK] buildcache.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
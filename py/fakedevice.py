@@ -0,0 +1,165 @@
+"""
+Fake HC4E board on a pty pair, for testing load4e.py without hardware.
+
+The firmware side answers the serial commands load4e.py uses and runs the
+loaded program on hcxsim.Machine:
+    l          ready prompt, then Intel HEX records until the EOF record, [OK] / [ERR] ...
+    p          as l, but the records are written over the loaded image instead of an empty one
+    c<s>,<e>   [CRC] and the CRC-32 (zlib.crc32) of addresses s to e-1 in hex, unused ones as 0xFF
+    rc         header line and R0..R15,PC,INST as CSV
+    t          two header lines, then one CSV line per instruction until q
+               (trace_burst lines every trace_interval seconds)
+    b<rate>    [OK] and switch to rate, or [NG] above max_baudrate
+
+Usage:
+    with FakeDevice(ack=True) as device:
+        subprocess.run([sys.executable, 'load4e.py', 'load', '--file', 'x.hex', '--port', device.port, '--window', '4'])
+        device.rom
+    FakeDevice(flaky=[0x10, 0x42]) corrupts the first write of those addresses.
+"""
+
+import os
+import select
+import threading
+import time
+import tty
+import zlib
+from typing import Iterable, Optional
+
+import hcxsim
+
+class FakeDevice:
+    def __init__(self, arch:str="HC4E", ack:bool=False, max_baudrate:int=115200, ready:bytes=b"Ready\r\n",
+                 trace_interval:float=0.01, trace_burst:int=1, flaky:Iterable[int]=(),
+                 record_delay:float=0.0):
+        self.arch = arch
+        # acknowledge every record with one line, for load4e.py --window
+        self.ack = ack
+        self.max_baudrate = max_baudrate
+        self.baudrate = 115200
+        self.ready = ready
+        self.trace_interval = trace_interval
+        # frames sent per trace_interval
+        self.trace_burst = trace_burst
+        self.rom: list[int] = []
+        # addresses whose next write stores the byte with bit 0 flipped, for load4e.py verify
+        self.flaky = set(flaky)
+        # seconds spent on every loaded record, a slow board
+        self.record_delay = record_delay
+        self.machine = hcxsim.Machine([], arch)
+        # every command line received, in order, and when it arrived (time.perf_counter)
+        self.commands: list[str] = []
+        self.command_times: list[float] = []
+        # when each trace line was sent
+        self.trace_times: list[float] = []
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        tty.setraw(self._master)
+        self.port = os.ttyname(self._slave)
+        self._loading: Optional[dict[int, int]] = None
+        self._tracing = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def __enter__(self) -> "FakeDevice":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _send(self, data:bytes):
+        os.write(self._master, data)
+
+    def _serve(self):
+        buffer = b""
+        next_trace = 0.0
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._master], [], [], self.trace_interval if self._tracing else 0.05)
+            if readable:
+                try:
+                    buffer += os.read(self._master, 4096)
+                except OSError:
+                    continue
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    self._line(line.decode(errors="replace").strip())
+            if self._tracing and time.monotonic() >= next_trace:
+                next_trace = time.monotonic() + self.trace_interval
+                frames = []
+                for _ in range(self.trace_burst):
+                    self.machine.run(1)
+                    frames.append(self._csv())
+                self._send(b"".join(frames))
+                self.trace_times.extend([time.perf_counter()] * len(frames))
+
+    def _csv(self) -> bytes:
+        dump = self.machine.registers()
+        return (",".join(str(v) for v in dump["regs"] + [dump["pc"], dump["inst"]]) + "\r\n").encode()
+
+    def _line(self, line:str):
+        if self._loading is not None:
+            self._record(line)
+            return
+        if not line or line == "\x03":
+            return
+        self.commands.append(line)
+        self.command_times.append(time.perf_counter())
+        if self._tracing:
+            if line.lower() == "q":
+                self._tracing = False
+            return
+        if line in ("l", "p"):
+            self._loading = {} if line == "l" else dict(enumerate(self.rom))
+            self._send(self.ready)
+        elif line == "rc":
+            self.machine.run(1000)
+            self._send(b"R0,R1,R2,R3,R4,R5,R6,R7,R8,R9,R10,R11,R12,R13,R14,R15,PC,INST\r\n" + self._csv())
+        elif line == "t":
+            self._send(b"Trace start\r\nR0,R1,R2,R3,R4,R5,R6,R7,R8,R9,R10,R11,R12,R13,R14,R15,PC,INST\r\n")
+            self._tracing = True
+        elif line.startswith("c") and line[1:].replace(",", "", 1).isdigit() and "," in line:
+            start, end = map(int, line[1:].split(","))
+            data = bytes(self.rom[address] if address < len(self.rom) else 0xFF for address in range(start, end))
+            self._send(f"[CRC] {zlib.crc32(data):08x}\r\n".encode())
+        elif line.startswith("b") and line[1:].isdigit():
+            rate = int(line[1:])
+            if rate > self.max_baudrate:
+                self._send(b"[NG]\r\n")
+            else:
+                self._send(b"[OK]\r\n")
+                self.baudrate = rate
+        else:
+            self._send(f"Unknown command: {line}\r\n".encode())
+
+    def _record(self, line:str):
+        loading = self._loading
+        assert loading is not None
+        if not line:
+            return
+        time.sleep(self.record_delay)
+        try:
+            record = bytes.fromhex(line[1:])
+            if not line.startswith(":") or len(record) != record[0] + 5 or sum(record) & 0xFF:
+                raise ValueError(line)
+        except ValueError:
+            self._loading = None
+            self._send(f"[ERR] bad record: {line}\r\n".encode())
+            return
+        if record[3] == 0x00:
+            address = record[1] << 8 | record[2]
+            for n, byte in enumerate(record[4:-1]):
+                if address + n in self.flaky:
+                    self.flaky.discard(address + n)
+                    byte ^= 1
+                loading[address + n] = byte
+        if record[3] == 0x01:
+            self._loading = None
+            self.rom = [loading.get(address, 0xFF) for address in range(max(loading) + 1)] if loading else []
+            self.machine = hcxsim.Machine(self.rom, self.arch)
+            self._send(b"[OK]\r\n")
+        elif self.ack:
+            self._send(b".\r\n")
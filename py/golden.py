@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Golden-file tests for the assembler
+
+使用方法:
+    python py/golden.py [--manifest py/test_files/manifest.json] [-j 4] [--timing timing.json]
+                        [--baseline timing.json --max-slowdown 2.0]
+
+Every py/test_files/*.asm needs an entry in the manifest naming its expected
+output, format and architecture:
+    {"fixtures": [{"source": "alltest.asm", "expected": "alltest.hex", "format": "ihex", "arch": "HC4"}]}
+The fixtures are assembled in-process with hcxasm.assemble_in_memory, spread
+over worker processes, and compared byte for byte with the expected files; a
+unified diff is printed only for the ones that differ. The best of --repeat
+runs of every fixture is reported per stage and can be written as JSON and
+compared with an earlier report, so a slower assembler fails the run.
+"""
+
+import argparse
+import difflib
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Sequence
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hcxasm
+import testfuncs
+
+MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_files', 'manifest.json')
+INCLUDE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'include')
+# a fixture is reported as slower only if it lost this much against the baseline as well
+MIN_SLOWDOWN_MS = 5.0
+
+def load_manifest(filename:str=MANIFEST) -> list[dict]:
+    """
+    Fixtures of a manifest, with source and expected as paths.\n
+    Every .asm file next to the manifest must be listed, so a new fixture can
+    not be left out by accident.
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    base = os.path.dirname(filename)
+    fixtures = []
+    for entry in manifest['fixtures']:
+        missing = {'source', 'expected', 'format', 'arch'} - set(entry)
+        if missing:
+            raise ValueError(f"[Error] Manifest entry {entry} has no {', '.join(sorted(missing))}")
+        fixture = dict(entry)
+        fixture['name'] = entry.get('name', os.path.splitext(entry['source'])[0] + ':' + entry['format'])
+        fixture['source'] = os.path.join(base, entry['source'])
+        fixture['expected'] = os.path.join(base, entry['expected'])
+        for key in ('source', 'expected'):
+            if not os.path.exists(fixture[key]):
+                raise FileNotFoundError(f"[Error] '{fixture[key]}' of fixture {fixture['name']} does not exist.")
+        fixtures.append(fixture)
+    listed = {os.path.abspath(f['source']) for f in fixtures}
+    unlisted = [s for s in sorted(glob.glob(os.path.join(base, '*.asm'))) if os.path.abspath(s) not in listed]
+    if unlisted:
+        raise ValueError(f"[Error] Not in {filename}: {', '.join(unlisted)}")
+    return fixtures
+
+def rendered(outputs:dict[str, str], format_type:str) -> bytes:
+    """File contents hcxasm.py would write for an output of assemble_in_memory."""
+    if format_type == 'binary':
+        return bytes.fromhex(outputs[format_type])
+    return outputs[format_type].encode('utf-8')
+
+def diff(expected:bytes, output:bytes, fixture:dict) -> str:
+    """Unified diff of two outputs; binary outputs are compared as one hex byte per line."""
+    if fixture['format'] == 'binary':
+        expected_lines = [f"{b:02X}\n" for b in expected]
+        output_lines = [f"{b:02X}\n" for b in output]
+    else:
+        expected_lines = expected.decode(errors='replace').splitlines(keepends=True)
+        output_lines = output.decode(errors='replace').splitlines(keepends=True)
+    return ''.join(difflib.unified_diff(expected_lines, output_lines, fromfile=fixture['expected'], tofile=fixture['name']))
+
+def run_fixture(fixture:dict, repeat:int=1) -> dict:
+    """
+    Assemble one fixture repeat times and compare the output with its expected file.
+    Returns name, ok, ms and per-stage ms (best of the runs), and diff or error on failure.
+    Runs in a worker process.
+    """
+    result: dict = {'name': fixture['name'], 'ok': False}
+    try:
+        with open(fixture['source'], 'r', encoding='utf-8') as f:
+            source = f.read()
+        with open(fixture['expected'], 'rb') as f:
+            expected = f.read()
+        include_paths = [os.path.dirname(fixture['source'])] + list(fixture.get('include_paths', [])) + [INCLUDE_DIR]
+        best: Optional[dict[str, float]] = None
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            response = hcxasm.assemble_in_memory(source, fixture['arch'], include_paths, [fixture['format']],
+                                                 record_length=fixture.get('record_length', hcxasm.hexfile.RECORD_LENGTH))
+            timing = dict(response['timing'], ms=(time.perf_counter() - start) * 1000)
+            if best is None or timing['ms'] < best['ms']:
+                best = timing
+        assert best is not None
+        result.update(best)
+        output = rendered(response['outputs'], fixture['format'])
+        result['size'] = response['size']
+        result['ok'] = output == expected
+        if not result['ok']:
+            result['diff'] = diff(expected, output, fixture)
+    except Exception as e:
+        message = e.args[0] if isinstance(e, KeyError) and e.args else str(e)
+        result['error'] = str(message)
+    return result
+
+def run_fixtures(fixtures:Sequence[dict], jobs:int=0, repeat:int=1) -> list[dict]:
+    """Results of run_fixture for every fixture, in order, using jobs worker processes (0: one per CPU)."""
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(fixtures) <= 1:
+        return [run_fixture(f, repeat) for f in fixtures]
+    with ProcessPoolExecutor(max_workers=min(jobs, len(fixtures))) as pool:
+        return list(pool.map(run_fixture, fixtures, [repeat] * len(fixtures)))
+
+def timing_report(results:Sequence[dict]) -> dict:
+    """The per-fixture timing of results, as written by --timing."""
+    stages = ('ms', 'preprocess_ms', 'assemble_ms', 'output_ms')
+    return {'fixtures': {r['name']: {s: round(r[s], 3) for s in stages if s in r} for r in results}}
+
+def slower_than(results:Sequence[dict], baseline:dict, max_slowdown:float, min_ms:float=MIN_SLOWDOWN_MS) -> list[str]:
+    """Fixtures that took more than max_slowdown times (and min_ms more than) their time in a baseline report."""
+    slower = []
+    for r in results:
+        before = baseline.get('fixtures', {}).get(r['name'], {}).get('ms')
+        if before is not None and 'ms' in r and r['ms'] > before * max_slowdown and r['ms'] - before > min_ms:
+            slower.append(f"{r['name']}: {r['ms']:.1f} ms, was {before:.1f} ms")
+    return slower
+
+def arg_parse(argv:Optional[Sequence[str]]=None):
+    parser = argparse.ArgumentParser(description='Golden-file tests for hcxasm')
+    parser.add_argument('--manifest', default=MANIFEST, help='Fixture manifest (default: py/test_files/manifest.json)')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='Worker processes (default: number of CPUs)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per fixture, the best time is reported (default: 3)')
+    parser.add_argument('--timing', help='Write the per-fixture timing to this JSON file')
+    parser.add_argument('--baseline', help='Timing JSON of an earlier run to compare with')
+    parser.add_argument('--max-slowdown', type=float, default=2.0,
+                        help='Fail if a fixture is this many times slower than in --baseline (default: 2.0)')
+    return parser.parse_args(argv)
+
+def main(argv:Optional[Sequence[str]]=None) -> int:
+    args = arg_parse(argv)
+    start = time.perf_counter()
+    results = run_fixtures(load_manifest(args.manifest), args.jobs, args.repeat)
+    wall = time.perf_counter() - start
+    failed = [r for r in results if not r['ok']]
+    for r in results:
+        if r['ok']:
+            print(f"[OK] {r['name']} ({r['size']} bytes, {r['ms']:.2f} ms: preprocess {r['preprocess_ms']:.2f}, "
+                  f"assemble {r['assemble_ms']:.2f}, output {r['output_ms']:.2f})")
+        elif 'error' in r:
+            print(f"[FAIL] {r['name']}: {r['error']}")
+        else:
+            print(f"[FAIL] {r['name']} does not match its expected output:\n{r['diff']}")
+    if args.timing:
+        with open(args.timing, 'w', encoding='utf-8') as f:
+            json.dump(timing_report(results), f, indent=1)
+    slower: list[str] = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            slower = slower_than(results, json.load(f), args.max_slowdown)
+        for line in slower:
+            print(f"[FAIL] Slower than the baseline: {line}")
+    print(f"[Info] {len(results)} fixtures: {len(results) - len(failed)} passed, {len(failed)} failed in {wall:.2f} s.")
+    return 1 if failed or slower else 0
+
+def self_test():
+    fixture = {'name': 'x', 'expected': 'x.bin', 'format': 'binary'}
+    testfuncs.expect(b"\x01\xab", rendered, {'binary': '01AB'}, 'binary')
+    testfuncs.expect("--- x.bin\n+++ x\n@@ -1 +1 @@\n-01\n+02\n", diff, b"\x01", b"\x02", fixture)
+    results = [{'name': 'a', 'ms': 30.0}, {'name': 'b', 'ms': 3.0}, {'name': 'c', 'ms': 1.0}]
+    baseline = {'fixtures': {'a': {'ms': 10.0}, 'b': {'ms': 1.0}}}
+    # b is three times slower, but only by 2 ms
+    testfuncs.expect(["a: 30.0 ms, was 10.0 ms"], slower_than, results, baseline, 2.0)
+    testfuncs.expect({'fixtures': {'a': {'ms': 1.235}}}, timing_report, [{'name': 'a', 'ms': 1.23456, 'ok': True}])
+    print("[OK] golden.py : All tests passed.")
+
+if __name__ == "__main__":
+    sys.exit(main())
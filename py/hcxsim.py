@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+"""
+HC4 / HC4E simulator
+
+使用方法:
+    python py/hcxsim.py program.asm [-a HC4E] [--steps 100000] [--input 3] [-j]
+    python py/hcxsim.py program.hex -a HC4E --steps 1000 -j
+
+Runs machine code as produced by assembler.assemble / adrlist2bitstream. Every
+instruction takes one cycle. The ROM is decoded once into an operation and an
+operand per address, so the run loop never looks at instruction bits.
+
+Machine model (InstructionList.md):
+    - Loads push onto the stack: C <= B, B <= A, A <= value. HC4E has only A and B.
+    - SU r: r <= A - B. The carry flag is set on borrow (A < B).
+    - AD r: r <= A + B. The carry flag is set if the sum does not fit in 4 bits.
+    - The zero flag is set from the value written by SU, AD, XR, OR, AN, SA, SC and SM.
+    - SM / LM access the 256 nibbles of data memory at [B A] (HC4 only).
+    - JP jumps to [C B A] on HC4 (12-bit PC) and to [B A] on HC4E (8-bit PC).
+    - HC4E: reading r14 returns the input port, writing r14 / r15 sets the output latches.
+
+A run stops at a reserved instruction (unused ROM is 0xFF), and, unless disabled,
+when a jump over nothing but LI / NP reaches the same stack again: the usual
+`END: LI #END:1 / LI #END:0 / JP` ending.
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import Optional, Sequence
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import assembler
+import hexfile
+import testfuncs
+
+try:
+    import numpy as np
+except ImportError:  # only BatchMachine needs numpy
+    np = None
+
+# decoded operations
+OP_SM, OP_SC, OP_SU, OP_AD, OP_XR, OP_OR, OP_AN, OP_SA, OP_LM, OP_LD, OP_LI, OP_JP, OP_NP, OP_IN, OP_RESERVED = range(15)
+
+_MNEMONIC_OPS = {
+    "SM": OP_SM, "SC": OP_SC, "SU": OP_SU, "AD": OP_AD, "XR": OP_XR, "OR": OP_OR, "AN": OP_AN,
+    "SA": OP_SA, "LM": OP_LM, "LD": OP_LD, "LI": OP_LI, "JP": OP_JP, "NP": OP_NP,
+}
+
+PC_BITS = {"HC4": 12, "HC4E": 8}
+
+def build_decoder(arch:str) -> list[tuple[int, int]]:
+    """(operation, operand) for every instruction byte, built from INST_DICT_M."""
+    inst_dict = assembler.INST_DICT_M.get(arch)
+    if inst_dict is None:
+        raise KeyError(f"[Error] Unsupported architecture: {arch}")
+    table = [(OP_RESERVED, 0)] * 256
+    for mnemonic, opcode in inst_dict.items():
+        op = _MNEMONIC_OPS[mnemonic]
+        match assembler.INST_TYPES[mnemonic]:
+            case assembler.insttype.REGISTER | assembler.insttype.IMMEDIATE:
+                for operand in range(16):
+                    table[opcode + operand] = (op, operand)
+            case assembler.insttype.JUMP:
+                table[opcode] = (op, 0)
+                for flag in assembler.JMP_FLAGS.values():
+                    table[opcode + flag] = (op, flag)
+            case assembler.insttype.INHERENT:
+                table[opcode] = (op, 0)
+    if arch == "HC4E":
+        # r14 reads the input port
+        table[inst_dict["LD"] + 14] = (OP_IN, 14)
+    return table
+
+DECODERS = {arch: build_decoder(arch) for arch in assembler.INST_DICT_M}
+
+class Machine:
+    """
+    One HC4 / HC4E.\n
+    rom is a list of instruction bytes or the MachineCode (address -> (code, lineno))
+    returned by assembler.assemble. Unused ROM is filled with 0xFF, which is
+    a reserved instruction and halts the machine.
+    """
+    def __init__(self, rom, arch:str="HC4", input_port:int=0, stop_on_loop:bool=True, record_io:bool=False):
+        if arch not in DECODERS:
+            raise KeyError(f"[Error] Unsupported architecture: {arch}")
+        self.arch = arch
+        self.pc_mask = (1 << PC_BITS[arch]) - 1
+        # programs usually end in a jump back over LI / NP only, which never leaves
+        self.stop_on_loop = stop_on_loop
+        self.record_io = record_io
+        self.input_port = input_port
+        if isinstance(rom, (dict, assembler.MachineCode)):
+            rom = assembler.adrlist2bitstream(rom, 0xFF)
+        self.rom: list[int] = [0xFF] * (self.pc_mask + 1)
+        if len(rom) > len(self.rom):
+            raise ValueError(f"[Error] Program of {len(rom)} bytes does not fit in the {len(self.rom)} bytes of {arch} ROM")
+        self.rom[:len(rom)] = list(rom)
+        decoder = DECODERS[arch]
+        self._ops = [decoder[code][0] for code in self.rom]
+        self._args = [decoder[code][1] for code in self.rom]
+        # first address of the run of LI / NP instructions that ends right before each address
+        self._idle_from: list[int] = []
+        start = 0
+        for address, op in enumerate(self._ops):
+            self._idle_from.append(start)
+            if op != OP_LI and op != OP_NP:
+                start = address + 1
+        self.reset()
+
+    def __repr__(self) -> str:
+        return (f"Machine(arch={self.arch}, pc={self.pc:03X}, A={self.a:X}, B={self.b:X}, C={self.c:X}, "
+                f"carry={int(self.carry)}, zero={int(self.zero)}, cycles={self.cycles}, halted={self.halted!r})")
+
+    def reset(self):
+        self.regs = [0] * 16
+        self.mem = [0] * 256
+        self.a = self.b = self.c = 0
+        self.carry = False
+        self.zero = False
+        self.pc = 0
+        self.cycles = 0
+        self.halted: Optional[str] = None
+        # (pc, A, B, C) of the last jump back over LI / NP only
+        self._idle: Optional[tuple[int, int, int, int]] = None
+        # (cycle, port, value) of every write to r14 / r15 on HC4E, if record_io
+        self.io: list[tuple[int, int, int]] = []
+
+    def step(self) -> int:
+        return self.run(1)
+
+    def run(self, max_steps:int) -> int:
+        """Execute up to max_steps instructions. Returns the number executed; stops early when halted."""
+        if self.halted is not None:
+            return 0
+        ops = self._ops
+        args = self._args
+        regs = self.regs
+        mem = self.mem
+        a, b, c, carry, zero, pc = self.a, self.b, self.c, self.carry, self.zero, self.pc
+        mask = self.pc_mask
+        hc4e = self.arch == "HC4E"
+        io = self.io if self.record_io and hc4e else None
+        input_port = self.input_port & 0xF
+        idle_from = self._idle_from if self.stop_on_loop else None
+        idle = self._idle
+        steps = 0
+        while steps < max_steps:
+            op = ops[pc]
+            x = args[pc]
+            steps += 1
+            if op == OP_LI:
+                c = b
+                b = a
+                a = x
+            elif op == OP_LD:
+                c = b
+                b = a
+                a = regs[x]
+            elif op == OP_JP:
+                if x == 0 or (x == 2 and carry) or (x == 3 and not carry) or (x == 4 and zero) or (x == 5 and not zero):
+                    target = (b << 4 | a) if hc4e else (c << 8 | b << 4 | a)
+                    if idle_from is not None and idle_from[pc] <= target <= pc:
+                        # only LI / NP since the last time here: the same state again means the loop never ends
+                        key = (pc, a, b, 0 if hc4e else c)
+                        if idle == key:
+                            steps -= 1
+                            self.halted = f"loop at {pc:03X}"
+                            break
+                        idle = key
+                    pc = target
+                    continue
+            elif op <= OP_SA:
+                if op == OP_AD:
+                    value = a + b
+                    carry = value > 15
+                    value &= 15
+                elif op == OP_SA:
+                    value = a
+                elif op == OP_SU:
+                    value = (a - b) & 15
+                    carry = a < b
+                elif op == OP_XR:
+                    value = a ^ b
+                elif op == OP_OR:
+                    value = a | b
+                elif op == OP_AN:
+                    value = a & b
+                elif op == OP_SC:
+                    value = c
+                else:  # OP_SM
+                    value = c
+                    zero = value == 0
+                    mem[b << 4 | a] = value
+                    pc = (pc + 1) & mask
+                    continue
+                zero = value == 0
+                regs[x] = value
+                if io is not None and x >= 14:
+                    io.append((self.cycles + steps, x, value))
+            elif op == OP_IN:
+                c = b
+                b = a
+                a = input_port
+            elif op == OP_LM:
+                c = b
+                b = a
+                a = mem[c << 4 | b]
+            elif op == OP_RESERVED:
+                steps -= 1
+                self.halted = f"reserved instruction {self.rom[pc]:02X} at {pc:03X}"
+                break
+            # OP_NP and untaken jumps fall through
+            pc = (pc + 1) & mask
+        if hc4e:
+            c = 0
+        self.a, self.b, self.c, self.carry, self.zero, self.pc = a, b, c, carry, zero, pc
+        self._idle = idle
+        self.cycles += steps
+        return steps
+
+    def registers(self) -> dict:
+        """Register dump in the shape of `load4e.py register --json`."""
+        return {"regs": list(self.regs), "pc": self.pc, "inst": self.rom[self.pc]}
+
+def _alu_results():
+    """Value written by each ALU operation, indexed by [op, A, B, C]."""
+    table = np.zeros((OP_SA + 1, 16, 16, 16), dtype=np.uint8)
+    a, b, c = np.meshgrid(np.arange(16), np.arange(16), np.arange(16), indexing="ij")
+    for op, value in ((OP_SM, c), (OP_SC, c), (OP_SU, (a - b) & 15), (OP_AD, (a + b) & 15),
+                      (OP_XR, a ^ b), (OP_OR, a | b), (OP_AN, a & b), (OP_SA, a)):
+        table[op] = value
+    return table
+
+_ALU_RESULTS = _alu_results() if np is not None else None
+
+# BatchMachine.status
+RUNNING, HALTED_LOOP, HALTED_RESERVED = 0, 1, 2
+
+class BatchMachine:
+    """
+    Many instances of one ROM, run in lock step with NumPy (requires numpy).\n
+    Every lane has its own registers, data memory, stack, flags, PC and input
+    port. Each step decodes the instruction at every lane's PC and applies it
+    with masked updates, so lanes may take different branches. A lane that
+    halts (see Machine) stays where it stopped while the others go on.
+    """
+    def __init__(self, rom, arch:str="HC4", lanes:Optional[int]=None, input_ports=None, registers=None, stop_on_loop:bool=True):
+        if np is None:
+            raise ImportError("[Error] BatchMachine requires numpy (pip install numpy)")
+        # the scalar machine checks the ROM and builds the decoded tables
+        scalar = Machine(rom, arch, stop_on_loop=stop_on_loop)
+        self.arch = arch
+        self.pc_mask = scalar.pc_mask
+        self.stop_on_loop = stop_on_loop
+        self.rom = np.array(scalar.rom, dtype=np.uint8)
+        self._ops = np.array(scalar._ops, dtype=np.uint8)
+        self._args = np.array(scalar._args, dtype=np.uint8)
+        self._idle_from = np.array(scalar._idle_from, dtype=np.int32)
+        if lanes is None:
+            lanes = len(input_ports) if input_ports is not None else len(registers) if registers is not None else 1
+        self.lanes = lanes
+        self.input_ports = np.zeros(lanes, dtype=np.uint8) if input_ports is None else np.asarray(input_ports, dtype=np.uint8) & 0xF
+        self.initial_registers = np.zeros((lanes, 16), dtype=np.uint8) if registers is None else np.asarray(registers, dtype=np.uint8) & 0xF
+        if self.input_ports.shape != (lanes,) or self.initial_registers.shape != (lanes, 16):
+            raise ValueError(f"[Error] Expected {lanes} input ports and a ({lanes}, 16) register file")
+        self.reset()
+
+    def reset(self):
+        n = self.lanes
+        self.regs = self.initial_registers.copy()
+        self.mem = np.zeros((n, 256), dtype=np.uint8)
+        self.a = np.zeros(n, dtype=np.uint8)
+        self.b = np.zeros(n, dtype=np.uint8)
+        self.c = np.zeros(n, dtype=np.uint8)
+        self.carry = np.zeros(n, dtype=bool)
+        self.zero = np.zeros(n, dtype=bool)
+        self.pc = np.zeros(n, dtype=np.int32)
+        self.cycles = np.zeros(n, dtype=np.int64)
+        self.status = np.full(n, RUNNING, dtype=np.uint8)
+        # pc << 12 | A << 8 | B << 4 | C of the last jump back over LI / NP only, -1 if none
+        self._idle = np.full(n, -1, dtype=np.int32)
+
+    @property
+    def halted(self):
+        return self.status != RUNNING
+
+    def run(self, max_steps:int) -> int:
+        """Execute up to max_steps instructions on every lane. Returns the number of steps taken; stops early when all lanes halted."""
+        lane = np.arange(self.lanes)
+        hc4e = self.arch == "HC4E"
+        steps = 0
+        while steps < max_steps:
+            active = self.status == RUNNING
+            if not active.any():
+                break
+            steps += 1
+            pc, a, b, c = self.pc, self.a, self.b, self.c
+            op = np.where(active, self._ops[pc], OP_NP)
+            x = self._args[pc]
+            next_pc = (pc + 1) & self.pc_mask
+
+            # stack loads
+            push = (op >= OP_LM) & (op <= OP_LI) | (op == OP_IN)
+            if push.any():
+                value = x.copy()
+                m = op == OP_LD
+                if m.any():
+                    value[m] = self.regs[lane[m], x[m]]
+                m = op == OP_IN
+                if m.any():
+                    value[m] = self.input_ports[m]
+                m = op == OP_LM
+                if m.any():
+                    value[m] = self.mem[lane[m], b[m].astype(np.int32) << 4 | a[m]]
+                self.c = np.where(push, 0 if hc4e else b, c)
+                self.b = np.where(push, a, b)
+                self.a = np.where(push, value, a)
+
+            # ALU and stores
+            alu = op <= OP_SA
+            if alu.any():
+                result = _ALU_RESULTS[np.minimum(op, OP_SA), a, b, c]
+                self.carry = np.where(op == OP_AD, a + b > 15, np.where(op == OP_SU, a < b, self.carry))
+                self.zero = np.where(alu, result == 0, self.zero)
+                m = alu & (op != OP_SM)
+                if m.any():
+                    self.regs[lane[m], x[m]] = result[m]
+                m = op == OP_SM
+                if m.any():
+                    self.mem[lane[m], b[m].astype(np.int32) << 4 | a[m]] = result[m]
+
+            # jumps
+            jump = op == OP_JP
+            if jump.any():
+                carry, zero = self.carry, self.zero
+                taken = jump & ((x == 0) | ((x == 2) & carry) | ((x == 3) & ~carry) | ((x == 4) & zero) | ((x == 5) & ~zero))
+                target = (b.astype(np.int32) << 4 | a) if hc4e else (c.astype(np.int32) << 8 | b.astype(np.int32) << 4 | a)
+                if self.stop_on_loop:
+                    idle = taken & (self._idle_from[pc] <= target) & (target <= pc)
+                    key = pc << 12 | a.astype(np.int32) << 8 | b.astype(np.int32) << 4 | c
+                    looped = idle & (self._idle == key)
+                    self._idle = np.where(idle, key, self._idle)
+                    self.status[looped] = HALTED_LOOP
+                    next_pc = np.where(looped, pc, next_pc)
+                next_pc = np.where(taken, target, next_pc)
+
+            reserved = op == OP_RESERVED
+            self.status[reserved] = HALTED_RESERVED
+            executed = active & ~(self.status != RUNNING)
+            self.pc = np.where(executed, next_pc, pc)
+            self.cycles += executed
+        return steps
+
+    def machine(self, lane:int) -> Machine:
+        """The state of one lane as a scalar Machine."""
+        machine = Machine(self.rom.tolist(), self.arch, int(self.input_ports[lane]), self.stop_on_loop)
+        machine.regs = self.regs[lane].tolist()
+        machine.mem = self.mem[lane].tolist()
+        machine.a, machine.b, machine.c = int(self.a[lane]), int(self.b[lane]), int(self.c[lane])
+        machine.carry, machine.zero = bool(self.carry[lane]), bool(self.zero[lane])
+        machine.pc, machine.cycles = int(self.pc[lane]), int(self.cycles[lane])
+        if self.status[lane] == HALTED_LOOP:
+            machine.halted = f"loop at {machine.pc:03X}"
+        elif self.status[lane] == HALTED_RESERVED:
+            machine.halted = f"reserved instruction {machine.rom[machine.pc]:02X} at {machine.pc:03X}"
+        return machine
+
+    def registers(self, lane:int) -> dict:
+        """Register dump of one lane in the shape of `load4e.py register --json`."""
+        pc = int(self.pc[lane])
+        return {"regs": self.regs[lane].tolist(), "pc": pc, "inst": int(self.rom[pc])}
+
+def read_program(filename:str, arch:str, include_pathes:Sequence[str]=()) -> list[int]:
+    """ROM image from an .asm source, an Intel HEX, a Verilog HEX or a binary file."""
+    if filename.lower().endswith(".asm"):
+        with open(filename, 'r', encoding='utf-8') as f:
+            text = f.read()
+        return assembler.assemble_source(text, arch, [os.path.dirname(filename), *include_pathes]).bitstream
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if not filename.lower().endswith(".hex"):
+        return list(data)
+    if data.lstrip().startswith(b":"):
+        return list(hexfile.read_intel_hex(data)[0])
+    return [int(line, 16) for line in data.decode('ascii').split()]
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description="HC4 / HC4E simulator")
+    parser.add_argument("program", help="Program to run (.asm, Intel HEX / Verilog HEX .hex or binary)")
+    parser.add_argument("-a", "--architecture", choices=["HC4", "HC4E"], default="HC4", help="Target architecture (default: HC4)")
+    parser.add_argument("--steps", type=int, default=1000000, help="Maximum number of instructions to run (default: 1000000)")
+    parser.add_argument("--input", type=lambda v: int(v, 0), default=0, help="Value of the HC4E input port r14 (default: 0)")
+    parser.add_argument("--no-stop-on-loop", action="store_true", help="Keep running when the program jumps to itself")
+    parser.add_argument("-L", "--include-path", action="append", default=[], help="Additional include path for .INCLUDE directives")
+    parser.add_argument("-j", "--json", action="store_true", help="Print the registers in the JSON shape of `load4e.py register --json`")
+    return parser.parse_args()
+
+def main():
+    args = arg_parse()
+    include_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'include')
+    rom = read_program(args.program, args.architecture, args.include_path + [include_dir])
+    machine = Machine(rom, args.architecture, args.input, stop_on_loop=not args.no_stop_on_loop)
+    machine.run(args.steps)
+    if args.json:
+        print(json.dumps(machine.registers()))
+        return
+    print("Registers:")
+    for i in range(16):
+        print(f"R{i}: {machine.regs[i]}", end='  ')
+    print()
+    print(f"PC: {machine.pc}, INST: {machine.rom[machine.pc]}")
+    print(f"[Info] {machine.cycles} cycles, " + (f"halted: {machine.halted}" if machine.halted else "step limit reached"))
+
+def _reference_run(rom:list[int], arch:str, steps:int, input_port:int=0) -> dict:
+    """Straightforward bit-decoding interpreter, the reference for Machine.run."""
+    regs, mem = [0] * 16, [0] * 256
+    a = b = c = 0
+    carry = zero = False
+    pc = 0
+    mask = (1 << PC_BITS[arch]) - 1
+    rom = rom + [0xFF] * (mask + 1 - len(rom))
+    names = {opcode: name for name, opcode in assembler.INST_DICT_M[arch].items()}
+    for _ in range(steps):
+        inst = rom[pc]
+        hi, lo = inst & 0xF0, inst & 0x0F
+        name = names.get(inst if hi == 0xE0 and lo == 1 else hi)
+        if name is None or (name == "JP" and lo not in (0, 2, 3, 4, 5)) or (name in ("SM", "LM") and lo != 0):
+            break
+        next_pc = (pc + 1) & mask
+        if name in ("SU", "AD", "XR", "OR", "AN", "SA", "SC", "SM"):
+            value = {"SU": (a - b) & 15, "AD": (a + b) & 15, "XR": a ^ b, "OR": a | b, "AN": a & b, "SA": a, "SC": c, "SM": c}[name]
+            if name == "SU":
+                carry = a < b
+            elif name == "AD":
+                carry = a + b > 15
+            zero = value == 0
+            if name == "SM":
+                mem[b << 4 | a] = value
+            else:
+                regs[lo] = value
+        elif name in ("LD", "LI", "LM"):
+            value = {"LD": input_port if arch == "HC4E" and lo == 14 else regs[lo], "LI": lo, "LM": mem[b << 4 | a]}[name]
+            a, b, c = value, a, (0 if arch == "HC4E" else b)
+        elif name == "JP":
+            if {0: True, 2: carry, 3: not carry, 4: zero, 5: not zero}[lo]:
+                next_pc = (b << 4 | a) if arch == "HC4E" else (c << 8 | b << 4 | a)
+        pc = next_pc
+    return {"regs": regs, "pc": pc, "mem": mem, "stack": (a, b, c), "flags": (carry, zero)}
+
+def _fuzz_machine(rounds:int=200, steps:int=300):
+    """Machine.run must agree with the reference interpreter on random programs."""
+    import random
+    rng = random.Random(99)
+    for n in range(rounds):
+        arch = "HC4" if n % 2 == 0 else "HC4E"
+        opcodes = sorted({code for code, (op, _) in enumerate(DECODERS[arch]) if op != OP_RESERVED})
+        rom = [rng.choice(opcodes) for _ in range(rng.randint(1, 64))]
+        input_port = rng.randrange(16)
+        machine = Machine(rom, arch, input_port, stop_on_loop=n % 4 < 2)
+        machine.run(steps)
+        expected = _reference_run(rom, arch, machine.cycles, input_port)
+        result = {"regs": machine.regs, "pc": machine.pc, "mem": machine.mem, "stack": (machine.a, machine.b, machine.c), "flags": (machine.carry, machine.zero)}
+        if result != expected:
+            raise AssertionError(f"[FAIL] Machine.run differs from the reference on {arch} ROM {rom}:\n{result}\n{expected}")
+    print(f"[OK] Machine.run matches the reference interpreter on {rounds} random programs")
+
+def _machine_state(machine:Machine) -> dict:
+    return {"regs": machine.regs, "pc": machine.pc, "mem": machine.mem, "stack": (machine.a, machine.b, machine.c),
+            "flags": (machine.carry, machine.zero), "cycles": machine.cycles, "halted": machine.halted}
+
+def _fuzz_batch(rounds:int=40, lanes:int=16, steps:int=300):
+    """Every BatchMachine lane must end in the same state as a Machine started the same way."""
+    import random
+    rng = random.Random(7)
+    for n in range(rounds):
+        arch = "HC4" if n % 2 == 0 else "HC4E"
+        opcodes = sorted({code for code, (op, _) in enumerate(DECODERS[arch]) if op != OP_RESERVED})
+        rom = [rng.choice(opcodes) for _ in range(rng.randint(1, 64))]
+        input_ports = [rng.randrange(16) for _ in range(lanes)]
+        registers = [[rng.randrange(16) for _ in range(16)] for _ in range(lanes)]
+        batch = BatchMachine(rom, arch, input_ports=input_ports, registers=registers, stop_on_loop=n % 4 < 2)
+        # two runs, so that state carried between calls is covered as well
+        batch.run(steps // 2)
+        batch.run(steps - steps // 2)
+        for lane in range(lanes):
+            machine = Machine(rom, arch, input_ports[lane], stop_on_loop=n % 4 < 2)
+            machine.regs[:] = registers[lane]
+            machine.run(steps // 2)
+            machine.run(steps - steps // 2)
+            result, expected = _machine_state(batch.machine(lane)), _machine_state(machine)
+            if result != expected:
+                raise AssertionError(f"[FAIL] BatchMachine lane {lane} differs from Machine on {arch} ROM {rom}:\n{result}\n{expected}")
+    print(f"[OK] BatchMachine matches Machine on {rounds} random programs x {lanes} lanes")
+
+def self_test():
+    def run(source:str, arch:str="HC4", steps:int=1000, input_port:int=0) -> Machine:
+        machine = Machine(assembler.assemble_source(source, arch).machine_code, arch, input_port)
+        machine.run(steps)
+        return machine
+
+    # AD sets carry above 15, SU borrows
+    testfuncs.expect([0xF, 0x0, True, True], lambda m: [m.regs[0], m.regs[1], m.carry, m.zero], run("LI #8\nLI #7\nAD r0\nLI #9\nAD r1"))
+    testfuncs.expect([0xE, True, False], lambda m: [m.regs[2], m.carry, m.zero], run("LI #3\nLI #1\nSU r2"))
+    testfuncs.expect([0, True], lambda m: [m.regs[3], m.zero], run("LI #5\nLI #5\nXR r3"))
+    # SM stores C at [B A], LM loads it back
+    testfuncs.expect([9, 9], lambda m: [m.mem[0x21], m.regs[4]], run("LI #9\nLI #2\nLI #1\nSM\nLI #2\nLI #1\nLM\nSA r4"))
+    # conditional jumps, and a loop counting r0 down to zero
+    testfuncs.expect([0, "loop at 00A", 10], lambda m: [m.regs[0], m.halted, m.pc], run(
+        "LI #5\nSA r0\nLOOP: LD r0\nLI #15\nAD r0\nLI #LOOP:1\nLI #LOOP:0\nJP NZ\nEND: LI #END:1\nLI #END:0\nJP", "HC4E"))
+    # HC4E: r14 reads the input port, writes to r14 / r15 set the outputs
+    machine = Machine(assembler.assemble_source("LD r14\nSA r15\nLI #3\nSA r14\nEND: LI #END:1\nLI #END:0\nJP", "HC4E").machine_code,
+                      "HC4E", input_port=6, record_io=True)
+    machine.run(100)
+    testfuncs.expect([(2, 15, 6), (4, 14, 3)], lambda m: m.io, machine)
+    testfuncs.expect({"regs": [0] * 14 + [3, 6], "pc": 6, "inst": 0xE0}, Machine.registers, machine)
+    testfuncs.expect("reserved instruction FF at 001", lambda m: m.halted, run("NP"))
+    testfuncs.expect_raises(ValueError, Machine, [0xE1] * 257, "HC4E")
+    _fuzz_machine()
+    # Intel HEX goes through hexfile: extended address records are applied, checksums checked
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "p.hex")
+        with open(filename, "w", encoding="ascii") as f:
+            f.write(":020000040001F9\n:01000000A15E\n:00000001FF\n")
+        testfuncs.expect([0x10000, 0xA1], lambda rom: [len(rom) - 1, rom[-1]], read_program(filename, "HC4"))
+        with open(filename, "w", encoding="ascii") as f:
+            f.write(":01000000A15F\n:00000001FF\n")
+        testfuncs.expect_raises(ValueError, read_program, filename, "HC4")
+    if np is None:
+        print("[Skip] numpy is not installed, BatchMachine is not tested")
+    else:
+        batch = BatchMachine(assembler.assemble_source("LD r14\nSA r15\nEND: LI #END:1\nLI #END:0\nJP", "HC4E").machine_code,
+                             "HC4E", input_ports=range(16))
+        batch.run(100)
+        testfuncs.expect(list(range(16)), lambda m: m.regs[:, 15].tolist(), batch)
+        testfuncs.expect([HALTED_LOOP] * 16, lambda m: m.status.tolist(), batch)
+        testfuncs.expect({"regs": [0] * 15 + [9], "pc": 4, "inst": 0xE0}, BatchMachine.registers, batch, 9)
+        _fuzz_batch()
+    print("[OK] hcxsim.py : All tests passed.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Trace capture format
+
+使用方法:
+    python py/hcxtrace.py trace.hxt [-j] [--every 1000]
+
+load4e.py capture parses the CSV trace lines of the board in bulk into a ring
+buffer of frames and writes them to a gzip file:
+    b"HCXT" + version (1 byte) + fields per frame (1 byte)
+    then blocks of little-endian uint16 frames: R0..R15, PC, INST
+This module holds the parser, the ring buffer, the writer and the offline reader.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import threading
+from array import array
+from typing import Iterator, Optional
+
+import testfuncs
+
+MAGIC = b"HCXT"
+VERSION = 1
+# R0..R15, PC, INST
+FIELDS = 18
+
+class FrameParser:
+    """
+    Turns raw trace bytes into flat array('H') frames. Lines may be split across
+    reads; lines that are not 18 numbers (headers, messages) are skipped.
+    """
+    def __init__(self):
+        self._rest = b""
+        self.skipped = 0
+
+    def feed(self, data:bytes) -> array:
+        data = self._rest + data
+        end = data.rfind(b"\n") + 1
+        self._rest = data[end:]
+        lines = data[:end].replace(b"\r", b"")
+        values = array("H")
+        if not lines:
+            return values
+        count = lines.count(b"\n")
+        fields = lines[:-1].replace(b"\n", b",").split(b",")
+        # fast path: the whole block is frames
+        if len(fields) == count * FIELDS:
+            try:
+                values.extend(map(int, fields))
+                return values
+            except (ValueError, OverflowError):
+                del values[:]
+        for line in lines.split(b"\n"):
+            fields = line.split(b",")
+            if len(fields) != FIELDS:
+                if line.strip():
+                    self.skipped += 1
+                continue
+            try:
+                values.extend(map(int, fields))
+            except (ValueError, OverflowError):
+                del values[len(values) - len(values) % FIELDS:]
+                self.skipped += 1
+        return values
+
+class TraceRing:
+    """
+    Preallocated ring buffer of frames, filled by the serial reader and drained by
+    the writer. When the writer falls behind the oldest frames are overwritten
+    and counted in dropped.
+    """
+    def __init__(self, capacity:int):
+        self.capacity = capacity
+        self.data = array("H", bytes(2 * FIELDS * capacity))
+        self.written = 0
+        self.read = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.written - self.read
+
+    def push(self, values:array):
+        """Append flat frames (a multiple of FIELDS values)."""
+        frames = len(values) // FIELDS
+        if frames > self.capacity:
+            self.dropped += frames - self.capacity
+            values = values[-self.capacity * FIELDS:]
+            frames = self.capacity
+        with self._lock:
+            start = self.written % self.capacity * FIELDS
+            first = min(len(values), len(self.data) - start)
+            self.data[start:start + first] = values[:first]
+            self.data[:len(values) - first] = values[first:]
+            self.written += frames
+            if self.written - self.read > self.capacity:
+                self.dropped += self.written - self.read - self.capacity
+                self.read = self.written - self.capacity
+
+    def drain(self) -> array:
+        """Frames pushed since the last drain, oldest first."""
+        with self._lock:
+            frames = self.written - self.read
+            start = self.read % self.capacity * FIELDS
+            end = start + frames * FIELDS
+            if end <= len(self.data):
+                values = self.data[start:end]
+            else:
+                values = self.data[start:] + self.data[:end - len(self.data)]
+            self.read = self.written
+        return values
+
+class TraceWriter:
+    """Writes frames to a trace file. compresslevel 1 keeps up with the fastest boards."""
+    def __init__(self, filename:str, compresslevel:int=1):
+        self.file = gzip.open(filename, "wb", compresslevel=compresslevel)
+        self.file.write(MAGIC + bytes([VERSION, FIELDS]))
+        self.frames = 0
+
+    def write(self, values:array):
+        if sys.byteorder == "big":
+            values = array("H", values)
+            values.byteswap()
+        self.file.write(values.tobytes())
+        self.frames += len(values) // FIELDS
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self) -> "TraceWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_trace(filename:str, block:int=4096) -> Iterator[dict]:
+    """Frames of a trace file in the shape of `load4e.py register --json`."""
+    with gzip.open(filename, "rb") as f:
+        header = f.read(6)
+        if header[:4] != MAGIC or header[4] != VERSION or header[5] != FIELDS:
+            raise ValueError(f"[Error] Not a version {VERSION} trace file: {filename}")
+        while True:
+            data = f.read(block * FIELDS * 2)
+            if not data:
+                return
+            values = array("H")
+            values.frombytes(data[:len(data) - len(data) % (FIELDS * 2)])
+            if sys.byteorder == "big":
+                values.byteswap()
+            for i in range(0, len(values), FIELDS):
+                yield {"regs": values[i:i + 16].tolist(), "pc": values[i + 16], "inst": values[i + 17]}
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description="Read a trace file written by load4e.py capture")
+    parser.add_argument("trace", help="Trace file")
+    parser.add_argument("-j", "--json", action="store_true", help="Print every frame as JSON")
+    parser.add_argument("--every", type=int, default=1, help="Print every Nth frame (default: 1)")
+    return parser.parse_args()
+
+def main():
+    args = arg_parse()
+    count = 0
+    frame: Optional[dict] = None
+    for count, frame in enumerate(read_trace(args.trace), 1):
+        if (count - 1) % args.every:
+            continue
+        if args.json:
+            print(json.dumps(frame))
+        else:
+            print(f"{count - 1:>10}  PC: {frame['pc']:03X}  INST: {frame['inst']:02X}  " + " ".join(f"{r:X}" for r in frame["regs"]))
+    print(f"[Info] {count} frames", file=sys.stderr)
+
+def self_test():
+    frame = lambda n: ",".join(str((n + i) % 16) for i in range(16)) + f",{n},{n % 256}\r\n"
+    stream = ("Trace start\r\nR0,R1\r\n" + "".join(frame(n) for n in range(100))).encode()
+    parser = FrameParser()
+    # lines split at every possible place across reads
+    values = array("H")
+    for i in range(0, len(stream), 7):
+        values.extend(parser.feed(stream[i:i + 7]))
+    expected = array("H", [int(v) for n in range(100) for v in frame(n).strip().split(",")])
+    testfuncs.expect([True, 2], lambda: [values == expected, parser.skipped])
+    testfuncs.expect(array("H", [1] * 18), FrameParser().feed, b"1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1\nbad,line\n")
+
+    ring = TraceRing(8)
+    ring.push(values[:5 * FIELDS])
+    testfuncs.expect(True, lambda: ring.drain() == values[:5 * FIELDS])
+    # wraps around the end, then overruns: only the newest 8 frames are kept
+    ring.push(values[5 * FIELDS:11 * FIELDS])
+    testfuncs.expect(True, lambda: ring.drain() == values[5 * FIELDS:11 * FIELDS])
+    ring.push(values[11 * FIELDS:31 * FIELDS])
+    testfuncs.expect([True, 12], lambda: [ring.drain() == values[23 * FIELDS:31 * FIELDS], ring.dropped])
+
+    os.makedirs("./__temp__", exist_ok=True)
+    filename = "./__temp__/hcxtrace_test.hxt"
+    with TraceWriter(filename) as writer:
+        writer.write(values[:40 * FIELDS])
+        writer.write(values[40 * FIELDS:])
+    frames = list(read_trace(filename, block=16))
+    testfuncs.expect([100, {"regs": [(7 + i) % 16 for i in range(16)], "pc": 7, "inst": 7}], lambda: [len(frames), frames[7]])
+    with gzip.open(filename, "wb") as f:
+        f.write(b"NOPE")
+    testfuncs.expect_raises(ValueError, lambda: list(read_trace(filename)))
+    print("[OK] hcxtrace.py : All tests passed.")
+
+if __name__ == "__main__":
+    main()
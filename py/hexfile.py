@@ -0,0 +1,204 @@
+"""
+Intel HEX and Verilog HEX files
+
+Writers for the images hcxasm.py produces and a reader for Intel HEX, shared
+by the assembler, load4e.py and the tests. Records are assembled in binary from
+memoryview slices of the image and converted with one bytes.hex() call, so a
+1 MiB image is formatted without a Python loop over its bytes. Images above
+64 KiB get extended linear address (type 04) records.
+"""
+
+import struct
+import zlib
+from typing import Optional, Sequence
+
+import testfuncs
+
+# bytes per data record unless asked otherwise
+RECORD_LENGTH = 16
+
+# record length, offset, type of a record; data and checksum follow
+_HEADER = struct.Struct(">BHB")
+
+def _record(address:int, record_type:int, data) -> str:
+    header = _HEADER.pack(len(data), address & 0xFFFF, record_type)
+    checksum = -(sum(header) + sum(data)) & 0xFF
+    return f":{header.hex()}{bytes(data).hex()}{checksum:02x}\n"
+
+def _data_records(view:memoryview, start:int, end:int, record_length:int) -> str:
+    """Data records for start..end, which lie in one 64 KiB segment."""
+    full_end = start + (end - start) // record_length * record_length
+    text = ""
+    if full_end > start:
+        # the full records are assembled in binary and turned into hex in one call
+        binary = bytearray()
+        for address in range(start, full_end, record_length):
+            chunk = view[address:address + record_length]
+            offset = address & 0xFFFF
+            binary += _HEADER.pack(record_length, offset, 0)
+            binary += chunk
+            # the low 16 bits of adler32 are 1 + the byte sum for up to 256 bytes (at most
+            # 1 + 256 * 255 < 65521, the adler32 modulus), and record_length is at most 255
+            binary.append(-((zlib.adler32(chunk) & 0xFFFF) - 1 + record_length + (offset >> 8) + (offset & 0xFF)) & 0xFF)
+        text = ":" + binary.hex("\n", record_length + 5).replace("\n", "\n:") + "\n"
+    if full_end < end:
+        text += _record(full_end, 0x00, view[full_end:end])
+    return text
+
+def format_intel_hex(data, regions:Optional[Sequence[tuple[int, int]]]=None, record_length:int=RECORD_LENGTH) -> str:
+    """
+    Intel HEX text of data (a bytes-like image from address 0).\n
+    Only the (start, end) address ranges in regions are written, all of data if
+    regions is None. Data records hold up to record_length bytes and never cross
+    a 64 KiB boundary; an extended linear address record precedes the first
+    record of every 64 KiB segment above the first.
+    """
+    if not 1 <= record_length <= 255:
+        raise ValueError(f"[Error] Record length must be 1 to 255 bytes, not {record_length}")
+    view = memoryview(data if isinstance(data, (bytes, bytearray, memoryview)) else bytes(data)).cast("B")
+    if regions is None:
+        regions = [(0, len(view))]
+    records: list[str] = []
+    segment = 0
+    for start, end in regions:
+        address = start
+        while address < end:
+            if address >> 16 != segment:
+                segment = address >> 16
+                if segment > 0xFFFF:
+                    raise ValueError(f"[Error] Address {address:X} does not fit in Intel HEX")
+                records.append(_record(0, 0x04, segment.to_bytes(2, "big")))
+            segment_end = min(end, (address | 0xFFFF) + 1)
+            records.append(_data_records(view, address, segment_end, record_length))
+            address = segment_end
+    records.append(":00000001ff\n")
+    return "".join(records).upper()
+
+def changed_regions(old, new, record_length:int=RECORD_LENGTH) -> list[tuple[int, int]]:
+    """
+    (start, end) ranges of the record_length aligned blocks in which two images
+    of the same length differ, merged where they touch. format_intel_hex(new,
+    changed_regions(old, new)) writes one record per changed block.
+    """
+    if len(old) != len(new):
+        raise ValueError(f"[Error] Images of {len(old)} and {len(new)} bytes can not be compared")
+    a = memoryview(old).cast("B")
+    b = memoryview(new).cast("B")
+    regions: list[tuple[int, int]] = []
+    if a == b:
+        return regions
+    for start in range(0, len(b), record_length):
+        end = min(start + record_length, len(b))
+        if a[start:end] != b[start:end]:
+            if regions and regions[-1][1] == start:
+                regions[-1] = (regions[-1][0], end)
+            else:
+                regions.append((start, end))
+    return regions
+
+def format_verilog_hex(data) -> str:
+    """Verilog $readmemh text of data: one byte per line."""
+    view = memoryview(data if isinstance(data, (bytes, bytearray, memoryview)) else bytes(data)).cast("B")
+    if not len(view):
+        return ""
+    return view.hex("\n").upper() + "\n"
+
+def read_intel_hex(text, filler:int=0xFF) -> tuple[bytearray, list[tuple[int, int]]]:
+    """
+    Parse Intel HEX text (str or bytes) into (image, regions).\n
+    image is a bytearray from address 0 to the highest address written, unused
+    addresses filled with filler; regions are the (start, end) ranges the data
+    records covered, merged where they touch. Extended segment (02) and
+    extended linear (04) address records are applied; start address records
+    (03, 05) are ignored. Raises ValueError for malformed records, bad
+    checksums and data after the end of file record.
+    """
+    if isinstance(text, str):
+        text = text.encode("ascii", errors="replace")
+    image = bytearray()
+    regions: list[tuple[int, int]] = []
+    base = 0
+    ended = False
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if ended:
+            raise ValueError(f"[Error] Intel HEX data after the end of file record (line {lineno})")
+        try:
+            if line[:1] != b":":
+                raise ValueError
+            record = bytes.fromhex(line[1:].decode("ascii"))
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError(f"[Error] Not an Intel HEX record (line {lineno}): {line[:40].decode(errors='replace')}")
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ValueError(f"[Error] Intel HEX record length does not match its byte count (line {lineno})")
+        if sum(record) & 0xFF:
+            raise ValueError(f"[Error] Intel HEX checksum error (line {lineno})")
+        record_type = record[3]
+        payload = record[4:-1]
+        if record_type == 0x00:
+            address = base + (record[1] << 8 | record[2])
+            end = address + len(payload)
+            if end > len(image):
+                image += bytes([filler]) * (end - len(image))
+            image[address:end] = payload
+            if regions and regions[-1][1] == address:
+                regions[-1] = (regions[-1][0], end)
+            elif payload:
+                regions.append((address, end))
+        elif record_type == 0x01:
+            ended = True
+        elif record_type in (0x02, 0x04):
+            if len(payload) != 2:
+                raise ValueError(f"[Error] Intel HEX address record needs 2 data bytes (line {lineno})")
+            value = payload[0] << 8 | payload[1]
+            base = value << 4 if record_type == 0x02 else value << 16
+        elif record_type not in (0x03, 0x05):
+            raise ValueError(f"[Error] Unknown Intel HEX record type {record_type:02X} (line {lineno})")
+    if not ended:
+        raise ValueError("[Error] Intel HEX end of file record missing")
+    regions.sort()
+    merged: list[tuple[int, int]] = []
+    for start, end in regions:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return image, merged
+
+def self_test():
+    image = bytes(range(40))
+    testfuncs.expect(":10000000000102030405060708090A0B0C0D0E0F78\n:10001000101112131415161718191A1B1C1D1E1F68\n"
+                     ":080020002021222324252627BC\n:00000001FF\n", format_intel_hex, image)
+    testfuncs.expect("00\n01\n0A\n", format_verilog_hex, [0, 1, 10])
+    testfuncs.expect("", format_verilog_hex, b"")
+    testfuncs.expect((bytearray(image), [(0, 40)]), read_intel_hex, format_intel_hex(image, record_length=7))
+    # only the regions are written, gaps read back as filler
+    testfuncs.expect((bytearray(b"\x01\x02\x00\x00\x05"), [(0, 2), (4, 5)]), read_intel_hex,
+                     format_intel_hex(b"\x01\x02\xFF\xFF\x05", [(0, 2), (4, 5)]), 0)
+    # above 64 KiB: records split at the boundary, extended linear address records
+    big = bytes(n * 7 & 0xFF for n in range(0x10000 + 300))
+    text = format_intel_hex(big, [(0xFFF8, len(big))], record_length=32)
+    lines = text.split("\n")
+    testfuncs.expect([":08FFF800", ":020000040001F9", ":20000000"], lambda: [lines[0][:9], lines[1], lines[2][:9]])
+    image_read, regions = read_intel_hex(text)
+    testfuncs.expect([True, [(0xFFF8, len(big))]], lambda: [image_read[0xFFF8:] == big[0xFFF8:], regions])
+    testfuncs.expect_raises(ValueError, read_intel_hex, ":0100000001FF\n:00000001FF\n")
+    testfuncs.expect_raises(ValueError, read_intel_hex, ":10000000000102\n:00000001FF\n")
+    testfuncs.expect_raises(ValueError, read_intel_hex, "00\n01\n")
+    testfuncs.expect_raises(ValueError, read_intel_hex, ":0100000001FE\n")
+    testfuncs.expect_raises(ValueError, format_intel_hex, image, None, 0)
+    # one record per changed 16 byte block
+    edited = bytearray(image)
+    edited[3] = edited[39] = 0xFF
+    testfuncs.expect([(0, 16), (32, 40)], changed_regions, image, edited)
+    testfuncs.expect([], changed_regions, image, image)
+    edited[17] = 0xFF
+    testfuncs.expect([(0, 40)], changed_regions, image, edited)
+    testfuncs.expect(2, lambda: format_intel_hex(edited, changed_regions(image, bytes(edited[:32]) + image[32:])).count(":10"))
+    testfuncs.expect_raises(ValueError, changed_regions, image, image[:8])
+    print("[OK] hexfile.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
@@ -0,0 +1,629 @@
+"""
+Peephole optimizer for HC4 / HC4E machine code
+
+Runs between assemble and adrlist2bitstream (hcxasm.py -O). The program is cut
+into basic blocks at labels and after jumps. In every block instructions are
+removed one at a time as long as a symbolic run of the block, from a state
+nothing is known about, still ends the same way: the same registers, the same
+memory and I/O writes in the same order, the same jump, and the same stack
+levels and flags wherever a following block can read them (liveness over the
+jumps whose target is a label; anything else may read everything). With the
+machine model of each architecture (HC4E has no stack level C and its I/O at
+r14 / r15) that removes, among others:
+    - NP, which changes nothing,
+    - LD rX right after SA rX when the copy it pushes is pushed out unread,
+    - the LI #label:1 (HC4: #label:2) of a jump when the stack already holds
+      that nibble, i.e. the target is on the current page.
+The last kind depends on where labels end up, so after every round the label
+addresses are worked out again from the removed instructions and the blocks
+are checked once more with them, trying only what the round before removed:
+the removed instructions can only get fewer, and the sizes settle. The
+remaining lines are assembled again, and the original and optimized programs
+are run side by side in hcxsim, block by block, for the cycles saved and to
+check that they take the same path and leave the same registers.
+
+A program whose jumps use fixed addresses (LI #3 rather than LI #label:0) is
+left as it is, since moving code would break it, and so is one that does not
+behave the same in the side by side run, e.g. because it computes with the
+label nibbles a jump leaves on the stack. The instruction at address 0 is
+never removed: the programs start with an NP there, after reset.
+"""
+
+import os
+import sys
+from typing import Callable, Optional, Sequence
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import assembler
+import hcxsim
+import testfuncs
+from hcxsim import OP_SM, OP_SC, OP_SU, OP_AD, OP_XR, OP_OR, OP_AN, OP_SA, OP_LM, OP_LD, OP_LI, OP_JP, OP_NP, OP_IN
+
+# stack levels and flags, for liveness
+A, B, C, ZERO, CARRY = 1, 2, 4, 8, 16
+ALL = A | B | C | ZERO | CARRY
+
+# longer blocks are reduced in windows of this many instructions, with everything live between them
+WINDOW = 32
+# instructions the original program runs for in the side by side check
+VERIFY_STEPS = 20000
+
+_PUSHES = (OP_LI, OP_LD, OP_LM, OP_IN)
+_FLAG_READS = {2: CARRY, 3: CARRY, 4: ZERO, 5: ZERO}
+
+class _Terms:
+    """
+    Interned symbolic values.\n
+    0 to 15 stand for themselves and flags may be True or False; every other
+    value is an int from 16 up naming a node (operation, *operands), so equal
+    values are equal ints however they were built.
+    """
+    def __init__(self):
+        self.table: dict[tuple, int] = {}
+        self.nodes: list[tuple] = []
+
+    def make(self, *node) -> int:
+        term = self.table.get(node)
+        if term is None:
+            term = self.table[node] = len(self.nodes) + 16
+            self.nodes.append(node)
+        return term
+
+    def node(self, term) -> Optional[tuple]:
+        return self.nodes[term - 16] if not isinstance(term, bool) and term >= 16 else None
+
+    def depends(self, term, leaves:set[int]) -> bool:
+        """Whether term is one of leaves or built from one."""
+        stack = [term]
+        seen = set()
+        while stack:
+            t = stack.pop()
+            if t in leaves:
+                return True
+            node = self.node(t)
+            if node is None or t in seen:
+                continue
+            seen.add(t)
+            stack.extend(x for x in node[1:] if isinstance(x, int))
+        return False
+
+class _State:
+    """End state of a symbolic block run."""
+    __slots__ = ("stack", "zero", "carry", "regs", "effects")
+
+    def __init__(self, stack:tuple, zero, carry, regs:list, effects:list):
+        self.stack = stack
+        self.zero = zero
+        self.carry = carry
+        self.regs = regs
+        self.effects = effects
+
+    def same(self, other:"_State", live:int) -> bool:
+        """Whether both runs are alike to anything that reads live afterwards."""
+        if self.regs != other.regs or self.effects != other.effects:
+            return False
+        for bit, mine, theirs in ((A, self.stack[0], other.stack[0]), (B, self.stack[1], other.stack[1]),
+                                  (C, self.stack[2], other.stack[2]), (ZERO, self.zero, other.zero),
+                                  (CARRY, self.carry, other.carry)):
+            if live & bit and mine != theirs:
+                return False
+        return True
+
+def _negate(terms:_Terms, flag):
+    return not flag if isinstance(flag, bool) else terms.make("not", flag)
+
+def _execute(block:Sequence[tuple[int, int, Optional[tuple[str, int]]]], keep:Sequence[int], hc4e:bool,
+             terms:_Terms, label_value:Callable[[_Terms, tuple[str, int]], int]) -> _State:
+    """Run the instructions of block at the indices in keep from the unknown state every block starts in."""
+    a, b = terms.make("A"), terms.make("B")
+    c = 0 if hc4e else terms.make("C")
+    zero, carry = terms.make("Z"), terms.make("CY")
+    regs = [terms.make("r", n) for n in range(16)]
+    effects: list[tuple] = []
+    stores = 0
+    for i in keep:
+        op, x, ref = block[i]
+        if op in _PUSHES:
+            if op == OP_LI:
+                value = x if ref is None else label_value(terms, ref)
+            elif op == OP_LD:
+                value = regs[x]
+            elif op == OP_IN:
+                value = terms.make("in")
+            else:  # OP_LM reads [B A] as they were before the push
+                value = terms.make("mem", b, a, stores)
+            if not hc4e:
+                c = b
+            b = a
+            a = value
+        elif op == OP_NP:
+            continue
+        elif op == OP_JP:
+            if x == 0:
+                taken = True
+            elif x in (2, 3):
+                taken = carry if x == 2 else _negate(terms, carry)
+            else:
+                taken = zero if x == 4 else _negate(terms, zero)
+            effects.append(("jp", False) if taken is False else ("jp", taken, a, b, c))
+        else:
+            if op == OP_AD:
+                if a < 16 and b < 16:
+                    value, carry = (a + b) & 15, a + b > 15
+                else:
+                    low, high = min(a, b), max(a, b)
+                    value, carry = terms.make("add", low, high), terms.make("cadd", low, high)
+            elif op == OP_SU:
+                if a < 16 and b < 16:
+                    value, carry = (a - b) & 15, a < b
+                elif a == b:
+                    value, carry = 0, False
+                else:
+                    value, carry = terms.make("sub", a, b), terms.make("borrow", a, b)
+            elif op in (OP_XR, OP_OR, OP_AN):
+                if a < 16 and b < 16:
+                    value = a ^ b if op == OP_XR else a | b if op == OP_OR else a & b
+                elif a == b:
+                    value = 0 if op == OP_XR else a
+                else:
+                    value = terms.make(op, min(a, b), max(a, b))
+            elif op == OP_SA:
+                value = a
+            else:  # OP_SC, OP_SM
+                value = c
+            zero = value == 0 if value < 16 else terms.make("z", value)
+            if op == OP_SM:
+                effects.append(("sm", b, a, value))
+                stores += 1
+                continue
+            regs[x] = value
+            if hc4e and x >= 14:
+                effects.append(("io", x, value))
+    return _State((a, b, c), zero, carry, regs, effects)
+
+def _opaque_label(terms:_Terms, ref:tuple[str, int]) -> int:
+    return terms.make("lbl", *ref)
+
+class _Program:
+    """The decoded instructions of a MachineCode with their label references, cut into basic blocks."""
+    def __init__(self, machine_code:assembler.MachineCode, ls:assembler.LinkState, arch:str):
+        if machine_code.start != 0:
+            raise ValueError(f"[Error] The optimizer needs a program that starts at address 0, not {machine_code.start:X}")
+        decoder = hcxsim.DECODERS[arch]
+        self.arch = arch
+        self.hc4e = arch == "HC4E"
+        self.labels = {name.upper(): address for name, address in ls.labels.items()}
+        self.instructions: list[tuple[int, int, Optional[tuple[str, int]]]] = []
+        for address, code in enumerate(machine_code.codes):
+            ref = ls.unresolved.get(address)
+            if ref is not None:
+                name, _, nibble = ref.partition(":")
+                ref = (name.upper(), int(nibble))
+            op, x = decoder[code]
+            self.instructions.append((op, x, ref))
+        n = len(self.instructions)
+        leaders = {0} | {address for address in self.labels.values() if address < n}
+        leaders |= {address + 1 for address, inst in enumerate(self.instructions) if inst[0] == OP_JP and address + 1 < n}
+        starts = sorted(leaders) if n else []
+        # (start, end) of every block, and the block of every address
+        self.blocks = list(zip(starts, starts[1:] + [n]))
+        self.block_of = [0] * n
+        self._address_registers: Optional[tuple[set[int], bool]] = None
+        for index, (start, end) in enumerate(self.blocks):
+            self.block_of[start:end] = [index] * (end - start)
+
+    def block(self, index:int) -> list[tuple[int, int, Optional[tuple[str, int]]]]:
+        start, end = self.blocks[index]
+        return self.instructions[start:end]
+
+    def jump_targets(self) -> dict[int, Optional[str]]:
+        """
+        Label every block ending in a jump goes to (None if it is worked out at run time).
+        Raises ValueError for a jump to a fixed address, which could not be moved.
+        """
+        targets: dict[int, Optional[str]] = {}
+        for index, (start, end) in enumerate(self.blocks):
+            block = self.block(index)
+            if block[-1][0] != OP_JP:
+                continue
+            terms = _Terms()
+            jump = _execute(block, range(len(block)), self.hc4e, terms, _opaque_label).effects[-1]
+            if jump[1] is False:
+                continue
+            nibbles = jump[2:4] if self.hc4e else jump[2:5]
+            # the label each nibble is from, "" for a fixed value, None for anything else
+            sources = []
+            for level, term in enumerate(nibbles):
+                node = terms.node(term)
+                if node is None:
+                    sources.append("")
+                else:
+                    sources.append(node[1] if node[0] == "lbl" and node[2] == level else None)
+            names = {s for s in sources if s}
+            if "" in sources and (names or all(s == "" for s in sources)):
+                raise ValueError(f"[Error] Jump to a fixed address at address {end - 1:03X}: the program can not be moved")
+            targets[index] = sources[0] if len(names) == 1 and None not in sources else None
+        return targets
+
+    def live_out(self, targets:dict[int, Optional[str]]) -> list[int]:
+        """Stack levels and flags a later block may read, at the end of every block."""
+        count = len(self.blocks)
+        live_in = [0] * count
+        live_out = [0] * count
+        mask = ALL & ~C if self.hc4e else ALL
+        changed = True
+        while changed:
+            changed = False
+            for index in reversed(range(count)):
+                block = self.block(index)
+                last_op, last_x, _ = block[-1]
+                following = live_in[index + 1] if index + 1 < count else 0
+                if last_op == OP_JP:
+                    if index in targets:
+                        target = targets[index]
+                        address = self.labels.get(target) if target is not None else None
+                        if target is None:
+                            out = mask
+                        elif address is not None and address < len(self.instructions):
+                            out = live_in[self.block_of[address]]
+                        else:
+                            out = 0
+                    else:  # never taken
+                        out = 0
+                    if last_x != 0:
+                        out |= following
+                else:
+                    out = following
+                live = out
+                for op, x, _ in reversed(block):
+                    if op in _PUSHES:
+                        live = (A if live & B else 0) | (B if live & C else 0) | (A | B if op == OP_LM else 0)
+                    elif op == OP_JP:
+                        live |= A | B | (0 if self.hc4e else C) | _FLAG_READS.get(x, 0)
+                    elif op in (OP_AD, OP_SU):
+                        live = live & ~(ZERO | CARRY) | A | B
+                    elif op in (OP_XR, OP_OR, OP_AN):
+                        live = live & ~ZERO | A | B
+                    elif op == OP_SA:
+                        live = live & ~ZERO | A
+                    elif op == OP_SC:
+                        live = live & ~ZERO | C
+                    elif op == OP_SM:
+                        live = live & ~ZERO | A | B | C
+                live &= mask
+                if live != live_in[index] or out != live_out[index]:
+                    live_in[index] = live
+                    live_out[index] = out
+                    changed = True
+        return live_out
+
+    def address_registers(self) -> tuple[set[int], bool]:
+        """
+        Registers that may hold a label nibble (or something made from one) at
+        the end of a block or when written to I/O, and whether memory may;
+        their values move with the code and are not compared by the side by
+        side check.
+        """
+        if self._address_registers is None:
+            self._address_registers = self._find_address_registers()
+        return self._address_registers
+
+    def _find_address_registers(self) -> tuple[set[int], bool]:
+        registers: set[int] = set()
+        # stack levels a block may start with a label nibble in, at a label or after an untaken jump
+        stack: set[str] = set()
+        memory = False
+        changed = True
+        while changed:
+            changed = False
+            for index in range(len(self.blocks)):
+                block = self.block(index)
+                terms = _Terms()
+                state = _execute(block, range(len(block)), self.hc4e, terms, _opaque_label)
+                leaves = {term for term, node in enumerate(terms.nodes, 16) if node[0] == "lbl"}
+                leaves |= {terms.make("r", r) for r in registers} | {terms.make(level) for level in stack}
+                for r, value in enumerate(state.regs):
+                    if r not in registers and terms.depends(value, leaves):
+                        registers.add(r)
+                        changed = True
+                # a port written with an address in the middle of the block, overwritten by its end
+                for e in state.effects:
+                    if e[0] == "io" and e[1] not in registers and terms.depends(e[2], leaves):
+                        registers.add(e[1])
+                        changed = True
+                for level, value in zip("ABC", state.stack):
+                    if level not in stack and terms.depends(value, leaves):
+                        stack.add(level)
+                        changed = True
+                if not memory and any(e[0] == "sm" and terms.depends(e[3], leaves) for e in state.effects):
+                    memory = changed = True
+        return registers, memory
+
+def _reduce(block:list, live_out:int, hc4e:bool, label_value:Callable, candidates:Sequence[int]) -> list[int]:
+    """Indices of block left after removing those of candidates that do not change its end state."""
+    terms = _Terms()
+    reference = _execute(block, range(len(block)), hc4e, terms, label_value)
+    kept = list(range(len(block)))
+    changed = True
+    while changed:
+        changed = False
+        for i in candidates:
+            if i not in kept or block[i][0] == OP_JP:
+                continue
+            trial = [k for k in kept if k != i]
+            if reference.same(_execute(block, trial, hc4e, terms, label_value), live_out):
+                kept = trial
+                changed = True
+    return kept
+
+def _removals(program:_Program, live_out:list[int], labels:dict[str, int], fixed:dict[int, set[int]],
+              allowed:Optional[set[int]]=None) -> set[int]:
+    """
+    Addresses of the instructions that can go, of those in allowed if given,
+    with label references worth their address in labels. fixed keeps the
+    result of every window without label references across calls.
+    """
+    def label_value(terms:_Terms, ref:tuple[str, int]) -> int:
+        return (labels[ref[0]] >> (ref[1] * 4)) & 0x0F
+    removed: set[int] = set()
+    for index, (start, end) in enumerate(program.blocks):
+        for window_start in range(start, end, WINDOW):
+            window_end = min(end, window_start + WINDOW)
+            if window_start in fixed:
+                removed |= fixed[window_start]
+                continue
+            window = program.instructions[window_start:window_end]
+            live = live_out[index] if window_end == end else ALL
+            # the instruction at address 0 stays
+            candidates = [a - window_start for a in range(max(window_start, 1), window_end) if allowed is None or a in allowed]
+            kept = _reduce(window, live, program.hc4e, label_value, candidates)
+            gone = set(range(window_start, window_end)) - {window_start + k for k in kept}
+            if all(ref is None for _, _, ref in window):
+                fixed[window_start] = gone
+            removed |= gone
+    return removed
+
+def _relocated(labels:dict[str, int], removed:set[int]) -> dict[str, int]:
+    """Label addresses once the instructions at removed are gone."""
+    ordered = sorted(removed)
+    result = {}
+    for name, address in labels.items():
+        below = 0
+        while below < len(ordered) and ordered[below] < address:
+            below += 1
+        result[name] = address - below
+    return result
+
+def _remaining_lines(lines:assembler.ProcessedLines, removed:set[int], new_address:Sequence[int]) -> assembler.ProcessedLines:
+    """lines without the instructions at removed (a label on the same line stays), at their new addresses."""
+    result = assembler.ProcessedLines()
+    for text, lineno, source, address in lines:
+        line = text.strip()
+        if line and address in removed:
+            tok = line.split(" ")
+            if not tok[0].endswith(":"):
+                continue
+            if len(tok) > 1:
+                # a label on the line of a removed instruction stays
+                text = tok[0]
+        result.add(text, lineno, source, new_address[address] if address < len(new_address) else address - len(removed))
+    return result
+
+class Equivalence:
+    """What the side by side run of the original and optimized programs found."""
+    def __init__(self, cycles_before:int, cycles_after:int, halted:bool, inputs:Sequence[int]):
+        self.cycles_before = cycles_before
+        self.cycles_after = cycles_after
+        self.halted = halted
+        self.inputs = list(inputs)
+
+    def __repr__(self) -> str:
+        return f"Equivalence(cycles={self.cycles_before}->{self.cycles_after}, halted={self.halted}, inputs={self.inputs})"
+
+def run_side_by_side(program:_Program, original:Sequence[int], optimized:Sequence[int], new_address:Sequence[int],
+                     steps:int=VERIFY_STEPS, input_port:int=0) -> tuple[int, int, bool]:
+    """
+    Run both ROMs in hcxsim one block of the original at a time and compare
+    where they are and their registers (except those holding addresses) after
+    every block, and memory and I/O writes at the end. Stops when the original
+    halts or has run steps instructions. Returns the cycles of both and whether
+    the original halted; raises ValueError at the first difference.\n
+    Only the original stops at a loop that never ends: a removed instruction
+    can turn a loop the original keeps running into one over LI / NP only,
+    which is the same loop, so the optimized program just has to be there too.
+    """
+    registers, memory = program.address_registers()
+    compared = [r for r in range(16) if r not in registers]
+    before = hcxsim.Machine(original, program.arch, input_port, record_io=True)
+    after = hcxsim.Machine(optimized, program.arch, input_port, stop_on_loop=False, record_io=True)
+    n = len(program.instructions)
+    removed = n - len(optimized)
+
+    def moved(address:int) -> int:
+        return new_address[address] if address < n else address - removed
+
+    while before.halted is None and before.cycles < steps:
+        pc = before.pc
+        end = program.blocks[program.block_of[pc]][1] if pc < n else pc + 1
+        before.run(end - pc)
+        looped = before.halted is not None and before.halted.startswith("loop")
+        # up to the jump the original stopped at, if it did
+        after.run(moved(before.pc if looped else end) - moved(pc))
+        # a jump out of the program lands in unused ROM in both, wherever exactly
+        outside = before.pc >= n and after.pc >= len(optimized)
+        if (before.halted is None or looped) != (after.halted is None) or (after.pc != moved(before.pc) and not outside):
+            raise ValueError(f"[Error] Optimized program went astray after the block at {pc:03X}: original at {before.pc:03X}"
+                             f" ({before.halted or 'running'}), optimized at {after.pc:03X} ({after.halted or 'running'})"
+                             f" instead of {moved(before.pc):03X}")
+        for r in compared:
+            if before.regs[r] != after.regs[r]:
+                raise ValueError(f"[Error] Optimized program differs in r{r} after the block at {pc:03X}:"
+                                 f" {after.regs[r]} instead of {before.regs[r]}")
+    if not memory and before.mem != after.mem:
+        raise ValueError("[Error] Optimized program leaves different data memory")
+    io_before = [(port, value) for _, port, value in before.io if port not in registers]
+    io_after = [(port, value) for _, port, value in after.io if port not in registers]
+    if io_before != io_after:
+        raise ValueError("[Error] Optimized program writes different values to r14 / r15")
+    return before.cycles, after.cycles, before.halted is not None
+
+class OptimizeResult:
+    """An optimized program, ready for build_image and format_list, with what was saved."""
+    def __init__(self, lines:assembler.ProcessedLines, machine_code:assembler.MachineCode, ls:assembler.LinkState,
+                 bytes_before:int, removed:dict[str, int], rounds:int,
+                 equivalence:Optional[Equivalence], note:Optional[str]=None):
+        self.lines = lines
+        self.machine_code = machine_code
+        self.ls = ls
+        self.bytes_before = bytes_before
+        self.bytes_after = len(machine_code)
+        # mnemonic -> instructions removed
+        self.removed = removed
+        # rounds of label resolution
+        self.rounds = rounds
+        self.equivalence = equivalence
+        # why nothing was done, if so
+        self.note = note
+
+    def __repr__(self) -> str:
+        return f"OptimizeResult(bytes={self.bytes_before}->{self.bytes_after}, removed={self.removed}, {self.equivalence})"
+
+    def report(self) -> dict:
+        """The numbers of the summary, as JSON."""
+        report = {'bytes_before': self.bytes_before, 'bytes_after': self.bytes_after, 'removed': dict(self.removed),
+                  'rounds': self.rounds, 'note': self.note}
+        if self.equivalence is not None:
+            report.update(cycles_before=self.equivalence.cycles_before, cycles_after=self.equivalence.cycles_after,
+                          halted=self.equivalence.halted, inputs=self.equivalence.inputs)
+        return report
+
+    def summary(self) -> str:
+        if self.note is not None:
+            return f"[Info] Not optimized: {self.note}"
+        if not self.removed:
+            return f"[Info] Optimized: nothing to remove in {self.bytes_before} bytes."
+        text = f"[Info] Optimized: {self.bytes_before} -> {self.bytes_after} bytes (-{self.bytes_before - self.bytes_after})"
+        if self.equivalence is not None:
+            e = self.equivalence
+            span = "to halt" if e.halted else f"over the first {e.cycles_before} cycles"
+            text += f", {e.cycles_before} -> {e.cycles_after} cycles {span} (-{e.cycles_before - e.cycles_after})"
+        if self.removed:
+            text += "; removed " + ", ".join(f"{count} {name}" for name, count in sorted(self.removed.items()))
+        return text + "."
+
+_MNEMONICS = {op: name for name, op in hcxsim._MNEMONIC_OPS.items()}
+_MNEMONICS[OP_IN] = "LD"
+
+def optimize(lines:assembler.ProcessedLines, machine_code:assembler.MachineCode, ls:assembler.LinkState, arch:str,
+             steps:int=VERIFY_STEPS) -> OptimizeResult:
+    """
+    Optimize an assembled program (the preprocessed lines, machine code and
+    link state of one assembly). The result holds new lines, machine code and
+    link state with the labels resolved again. A program that can not be
+    moved, or whose optimized version does not behave like the original in
+    the simulator, is returned as it is with a note saying why.
+    """
+    program = _Program(machine_code, ls, arch)
+    bytes_before = len(machine_code)
+
+    def unchanged(e:ValueError, rounds:int=0) -> OptimizeResult:
+        return OptimizeResult(lines, machine_code, ls, bytes_before, {}, rounds, None, str(e.args[0]).replace("[Error] ", ""))
+
+    try:
+        targets = program.jump_targets()
+    except ValueError as e:
+        return unchanged(e)
+    live_out = program.live_out(targets)
+    fixed: dict[int, set[int]] = {}
+    removed = _removals(program, live_out, program.labels, fixed)
+    rounds = 1
+    while removed:
+        # the same or fewer with the labels where these removals put them
+        rounds += 1
+        found = _removals(program, live_out, _relocated(program.labels, removed), fixed, removed)
+        if found == removed:
+            break
+        removed = found
+    if not removed:
+        return OptimizeResult(lines, machine_code, ls, bytes_before, {}, rounds, None)
+
+    new_address = []
+    address = 0
+    for old in range(bytes_before):
+        new_address.append(address)
+        if old not in removed:
+            address += 1
+    new_lines = _remaining_lines(lines, removed, new_address)
+    new_ls = assembler.LinkState()
+    new_code = assembler.assemble(new_lines, new_ls, arch)
+    # HC4E programs that read the input port are run with every input value
+    reads_input = arch == "HC4E" and any(op == OP_IN for op, _, _ in program.instructions)
+    inputs = range(16) if reads_input else [0]
+    try:
+        if len(new_code) != bytes_before - len(removed):
+            raise ValueError(f"[Error] Optimizer lost track of the code: {len(new_code)} bytes instead of {bytes_before - len(removed)}")
+        original = machine_code.bitstream(0xFF)
+        optimized = new_code.bitstream(0xFF)
+        runs = [run_side_by_side(program, original, optimized, new_address, steps, value) for value in inputs]
+    except ValueError as e:
+        return unchanged(e, rounds)
+    equivalence = Equivalence(runs[0][0], runs[0][1], runs[0][2], inputs)
+    names: dict[str, int] = {}
+    for address in removed:
+        name = _MNEMONICS[program.instructions[address][0]]
+        names[name] = names.get(name, 0) + 1
+    return OptimizeResult(new_lines, new_code, new_ls, bytes_before, names, rounds, equivalence)
+
+def optimize_source(text:str, arch:str="HC4", include_paths:Optional[Sequence[str]]=None,
+                    steps:int=VERIFY_STEPS) -> OptimizeResult:
+    """Assemble program text in a fresh session and optimize it."""
+    result = assembler.assemble_source(text, arch, include_paths)
+    return optimize(result.lines, result.machine_code, result.ls, arch, steps)
+
+def self_test():
+    include = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "include")]
+    # NP runs go, the NP at address 0 stays
+    result = optimize_source("np\nli #1\nnp\nnp\nsa r1\nend:\nli #end:1\nli #end:0\njp\n", "HC4E")
+    testfuncs.expect([{"NP": 2}, 8, 6], lambda: [result.removed, result.bytes_before, result.bytes_after])
+    testfuncs.expect({"END": 3}, lambda: dict(result.ls.labels))
+    # HC4E: the copy LD pushes after SA is pushed out by the next two loads before anything reads it...
+    text = ".INC \"vasm.inc\"\nnp\nMOV r1 r2\nADD r3 r1 r4\nSA r5\nHALT\n"
+    testfuncs.expect({"LD": 1}, lambda: optimize_source(text, "HC4E", include).removed)
+    # ...but on HC4 it is still in C, which SC stores
+    testfuncs.expect({}, lambda: optimize_source(text.replace("SA r5", "SC r5"), "HC4", include).removed)
+    # the high nibble of a jump on the current page is on the stack already after li #0
+    page = "loop:\nld r1\nli #1\nad r1\nli #0\nsa r2\nli #loop:1\nli #loop:0\njp nc\nli #end:1\nli #end:0\nend:\njp\n"
+    result = optimize_source("np\n" + page, "HC4E")
+    testfuncs.expect([{"LI": 1}, 11], lambda: [result.removed, result.bytes_after])
+    # the loop body runs 16 times
+    testfuncs.expect([True, 132, 116], lambda: [result.equivalence.halted, result.equivalence.cycles_before, result.equivalence.cycles_after])
+    # not once loop is on page 1
+    far = "np\n" + "".join(f"li #{n}\nsa r{n + 2}\n" for n in range(1, 9)) + page
+    testfuncs.expect({}, lambda: optimize_source(far, "HC4E").removed)
+    # flags a conditional jump reads are live: the SA setting Z before JP Z stays
+    flags = "np\nld r1\nsa r1\nli #x:1\nli #x:0\njp z\nx:\nsa r3\n"
+    testfuncs.expect({}, lambda: optimize_source(flags, "HC4E").removed)
+    # without JP Z nothing reads it, and LD r1 / SA r1 both go
+    testfuncs.expect({"LD": 1, "SA": 1}, lambda: optimize_source(flags.replace("jp z", "jp"), "HC4E").removed)
+    # a jump to a fixed address is left alone
+    testfuncs.expect("Jump to a fixed address", lambda: optimize_source("np\nnp\nli #0\nli #0\nli #0\njp\n").note[:23])
+    # without LD r12 the loop is over LI only, which only stops the original in the simulator
+    result = optimize_source("np\nli #0\nsa r1\nloop:\nld r12\nli #loop:1\nli #loop:0\njp z\n", "HC4E")
+    testfuncs.expect([{"LD": 1}, None, False], lambda: [result.removed, result.note, result.equivalence.halted])
+    # the label nibble the jump leaves on the stack is written to r15 and moves with the code
+    result = optimize_source("np\nli #0\nsa r1\nli #x:1\nli #x:0\njp z\nnp\nx:\nsa r15\nli #3\nsa r15\nli #e:1\nli #e:0\ne:\njp\n", "HC4E")
+    testfuncs.expect([{"NP": 1, "LI": 1}, None], lambda: [result.removed, result.note])
+    # XR compares the address of x with 12: moved, the program takes the other way and is left as it is
+    text = "np\nnp\nnp\nli #x:0\nli #12\nxr r1\nli #x:1\nli #x:0\njp z\nli #e:1\nli #e:0\ne:\njp\nx:\nli #15\nsa r2\njp\n"
+    result = optimize_source(text, "HC4E")
+    testfuncs.expect([{}, 15, "Optimized program went astray"], lambda: [result.removed, result.bytes_after, result.note[:29]])
+    # the example programs keep working: every input on HC4E, the return addresses in registers of countlcd
+    for name, arch in (("dice4e", "HC4E"), ("countlcd", "HC4"), ("inctest", "HC4E"), ("macrotest", "HC4")):
+        source = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_files", name + ".asm")
+        with open(source, "r", encoding="utf-8") as f:
+            result = optimize_source(f.read(), arch, [os.path.dirname(source)] + include)
+        testfuncs.expect(True, lambda: result.bytes_after <= result.bytes_before)
+    print("[OK] optimizer.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
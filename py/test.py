@@ -1,43 +1,72 @@
+import os
+import shutil
 import testfuncs as tf
 import assembler
+import hcxsim
+import hcxtrace
+import hexfile
+import golden
+import buildcache
+import optimizer
 
 if __name__ == "__main__":
+    # hcxasm.py runs of the tests keep their build cache here, not in the user's cache
+    os.environ['HCXASM_CACHE_DIR'] = './__temp__/hcxasm_cache'
+    shutil.rmtree(os.environ['HCXASM_CACHE_DIR'], ignore_errors=True)
     tf.self_test()
     assembler.self_test()
-    tf.expect_assemble(
-        expected_file='py/test_files/alltest.hex',
-        infile='py/test_files/alltest.asm',
-        outfile='./__temp__/alltest.hex',
-        format_type='ihex',
+    hcxsim.self_test()
+    hcxtrace.self_test()
+    hexfile.self_test()
+    golden.self_test()
+    buildcache.self_test()
+    optimizer.self_test()
+    tf.expect_golden()
+    tf.expect_assemble_formats(
+        expected_vhex_file='py/test_files/macrotest.hex',
+        infile='py/test_files/macrotest.asm',
+        output_base='./__temp__/macrotest_all',
         arch='HC4'
     )
-    tf.expect_assemble(
-        expected_file='py/test_files/countlcd.hex',
-        infile='py/test_files/countlcd.asm',
-        outfile='./__temp__/countlcd.hex',
+    tf.expect_build_cache(infile='py/test_files/alltest.asm', arch='HC4')
+    tf.expect_optimize(arch='HC4E')
+    tf.expect_batch(
+        expected_files=['py/test_files/alltest.hex', 'py/test_files/countlcd.hex'],
+        pattern='py/test_files/[ac]*.asm',
+        outdir='./__temp__/batch',
         format_type='ihex',
         arch='HC4'
     )
-    tf.expect_assemble(
+    tf.expect_serve(
         expected_file='py/test_files/dice4e.hex',
         infile='py/test_files/dice4e.asm',
-        outfile='./__temp__/dice4e.hex',
         format_type='ihex',
         arch='HC4E'
     )
-    tf.expect_assemble(
-        expected_file='py/test_files/macrotest.hex',
-        infile='py/test_files/macrotest.asm',
-        outfile='./__temp__/macrotest.hex',
-        format_type='vhex',
-        arch='HC4'
-    )
-    tf.expect_assemble(
+    tf.expect_serve(
         expected_file='py/test_files/inctest.hex',
         infile='py/test_files/inctest.asm',
-        outfile='./__temp__/inctest.hex',
         format_type='vhex',
         arch='HC4E'
     )
+    tf.expect_serve_upload(infile='py/test_files/dice4e.asm')
+    try:
+        import serial  # noqa: F401
+    except ImportError:
+        print("[Skip] pyserial is not installed, load4e.py is not tested")
+    else:
+        tf.expect_load(hex_file='py/test_files/dice4e.hex')
+        tf.expect_load(hex_file='py/test_files/dice4e.hex', extra_args=['--window', '4'], device_args={'ack': True})
+        tf.expect_load(hex_file='py/test_files/countlcd.hex', arch='HC4', extra_args=['--chunk', '64'])
+        tf.expect_load(hex_file='py/test_files/dice4e.hex', extra_args=['--baudrate', 'auto'],
+                       device_args={'max_baudrate': 460800}, expect_baudrate=460800)
+        tf.expect_load(hex_file='py/test_files/alltest.hex', arch='HC4', device_args={'ready': b''})
+        tf.expect_load(hex_file='py/test_files/macrotest.hex', expect_success=False)
+        tf.expect_load_differential(hex_file='py/test_files/dice4e.hex')
+        tf.expect_verify(hex_file='py/test_files/countlcd.hex', arch='HC4')
+        tf.expect_load_many(hex_file='py/test_files/countlcd.hex', arch='HC4')
+        tf.expect_device_serve(hex_file='py/test_files/dice4e.hex')
+        tf.expect_capture(hex_file='py/test_files/dice4e.hex')
+        tf.expect_trace(hex_file='py/test_files/dice4e.hex')
 
     print("[OK] test.py : All tests passed.")
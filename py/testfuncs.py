@@ -1,9 +1,12 @@
 from types import FunctionType
+import contextlib
 import difflib
 import os
 from pathlib import Path
+import shutil
 import sys
 import subprocess
+import json
 
 def expect(expected, func : FunctionType, *args, **kwargs):
     result = func(*args, **kwargs)
@@ -59,6 +62,462 @@ def expect_assemble(expected_file, infile, outfile, format_type='ihex', arch='HC
     print(f"[OK] Assembled output matches expected for {infile}.")
 
 
+def expect_golden(manifest=None, jobs=2):
+    """マニフェストの全フィクスチャをプロセス内で並列にアセンブルし、期待ファイルと一致するか確認する"""
+    import golden
+    fixtures = golden.load_manifest(manifest or golden.MANIFEST)
+    results = golden.run_fixtures(fixtures, jobs)
+    failures = [f"{r['name']}: {r.get('error') or r['diff']}" for r in results if not r['ok']]
+    if failures:
+        raise AssertionError("[FAIL] Golden files do not match:\n" + "\n".join(failures))
+    # a changed expected file is reported with a diff
+    project_root = Path(__file__).parent.parent
+    broken = dict(fixtures[0], expected=str(project_root / '__temp__' / 'golden_broken.hex'))
+    with open(fixtures[0]['expected'], 'rb') as f:
+        expected_data = f.read()
+    (project_root / '__temp__').mkdir(exist_ok=True)
+    with open(broken['expected'], 'wb') as f:
+        f.write(expected_data.replace(b'\n', b'\nXX\n', 1))
+    result = golden.run_fixture(broken)
+    if result['ok'] or '-XX\n' not in result.get('diff', ''):
+        raise AssertionError(f"[FAIL] A changed golden file was not reported: {result}")
+    timing = ", ".join(f"{r['name']} {r['ms']:.1f} ms" for r in results)
+    print(f"[OK] {len(results)} golden files match ({timing}).")
+
+
+def expect_assemble_formats(expected_vhex_file, infile, output_base, arch='HC4'):
+    """1回のアセンブルで複数形式 (-f vhex,ihex,binary,list) を出力し、全形式の内容が一致するか確認する"""
+    project_root = Path(__file__).parent.parent
+    (project_root / '__temp__').mkdir(exist_ok=True)
+    cmd = [sys.executable, 'hcxasm.py', infile, '--format', 'vhex,ihex,binary,list', '--architecture', arch,
+           '--output', output_base + '.hex']
+    subprocess.run(cmd, check=True, capture_output=True, cwd=project_root)
+    base = project_root / output_base
+    with open(project_root / expected_vhex_file, 'r', encoding='utf-8') as f:
+        expected_text = f.read()
+    expected = bytes(int(line, 16) for line in expected_text.split())
+    with open(str(base) + '.hex', 'r', encoding='utf-8') as f:
+        vhex = f.read()
+    with open(str(base) + '.ihex', 'r', encoding='utf-8') as f:
+        ihex = f.read()
+    with open(str(base) + '.bin', 'rb') as f:
+        binary = f.read()
+    with open(str(base) + '.lst', 'r', encoding='utf-8') as f:
+        listing = f.read()
+    import hexfile
+    ihex_data, _ = hexfile.read_intel_hex(ihex)
+    if vhex != expected_text or binary != expected or bytes(ihex_data) != expected:
+        raise AssertionError(f"[FAIL] Formats written in one run disagree for {infile}.")
+    if f"Generated machine code: {len(expected)} bytes" not in listing:
+        raise AssertionError(f"[FAIL] List file of {infile} does not describe {len(expected)} bytes.")
+    print(f"[OK] One assembly wrote matching vhex, ihex, binary and list files for {infile}.")
+
+
+def expect_build_cache(infile, arch='HC4'):
+    """2回目のアセンブルがビルドキャッシュから同じ出力を返し、インクルードファイルの変更で再アセンブルされることを確認する"""
+    project_root = Path(__file__).parent.parent
+    work = project_root / '__temp__' / 'build_cache'
+    if work.exists():
+        shutil.rmtree(work)
+    work.mkdir(parents=True)
+    shutil.copy(project_root / infile, work / 'main.asm')
+    (work / 'lib.inc').write_text('.DEF REG r1\n', encoding='utf-8')
+    with open(work / 'main.asm', 'a', encoding='utf-8') as f:
+        f.write('\n.INCLUDE "lib.inc"\nLD REG\n')
+    cmd = [sys.executable, 'hcxasm.py', str(work / 'main.asm'), '--format', 'ihex,list', '--architecture', arch,
+           '--output', str(work / 'out.hex'), '--cache-dir', str(work / 'cache'), '--verbose']
+    outputs = []
+    for content, expected in (('.DEF REG r1\n', 'miss'), ('.DEF REG r1\n', 'hit'), ('.DEF REG r2\n', 'miss')):
+        (work / 'lib.inc').write_text(content, encoding='utf-8')
+        run = subprocess.run(cmd, check=True, capture_output=True, text=True, cwd=project_root)
+        if f"Build cache {expected}" not in run.stdout:
+            raise AssertionError(f"[FAIL] Expected a build cache {expected} with {content.strip()!r} in lib.inc:\n{run.stdout}")
+        outputs.append(((work / 'out.hex').read_text(encoding='utf-8'), (work / 'out.lst').read_text(encoding='utf-8')))
+    if outputs[0] != outputs[1] or outputs[0][0] == outputs[2][0]:
+        raise AssertionError(f"[FAIL] Build cache outputs of {infile} do not match the assembled ones.")
+    print(f"[OK] Build cache returned the outputs of {infile} and noticed the changed include file.")
+
+
+def expect_optimize(arch='HC4E'):
+    """-O で出力が小さくなり、最適化後のHEXが元のプログラムと同じレジスタで停止することを確認する (vasm.incのマクロを使うHC4E向けのプログラム)"""
+    project_root = Path(__file__).parent.parent
+    work = project_root / '__temp__' / 'optimize'
+    work.mkdir(parents=True, exist_ok=True)
+    (work / 'count.asm').write_text(
+        '.INCLUDE "vasm.inc"\n    NP\n    MOVI r1 #0\nloop:\n    ADDI r1 r1 #1\n    MOV r2 r1\n    ADD r3 r2 r1\n'
+        '    NP\n    NP\n    GOTO_IF NC loop\n    HALT\n', encoding='utf-8')
+    outputs = {}
+    for name, extra in (('plain', []), ('optimized', ['-O'])):
+        cmd = [sys.executable, 'hcxasm.py', str(work / 'count.asm'), '--format', 'ihex', '--architecture', arch,
+               '--output', str(work / f"{name}.hex"), '--no-cache'] + extra
+        run = subprocess.run(cmd, check=True, capture_output=True, text=True, cwd=project_root)
+        outputs[name] = run.stdout
+    if "[Info] Optimized:" not in outputs['optimized']:
+        raise AssertionError(f"[FAIL] hcxasm.py -O did not report the optimization:\n{outputs['optimized']}")
+    import hcxsim
+    plain = hcxsim.read_program(str(work / 'plain.hex'), arch)
+    optimized = hcxsim.read_program(str(work / 'optimized.hex'), arch)
+    machines = [hcxsim.Machine(rom, arch) for rom in (plain, optimized)]
+    for machine in machines:
+        machine.run(100000)
+    if len(optimized) >= len(plain) or machines[0].regs != machines[1].regs or not machines[1].halted \
+            or machines[1].cycles >= machines[0].cycles:
+        raise AssertionError(f"[FAIL] -O on {arch}: {len(plain)} -> {len(optimized)} bytes, {machines}")
+    print(f"[OK] -O on {arch}: {len(plain)} -> {len(optimized)} bytes, {machines[0].cycles} -> {machines[1].cycles} cycles, same registers.")
+
+
+def expect_serve(expected_file, infile, format_type='ihex', arch='HC4'):
+    """常駐モード(hcxasm.py --serve)のアセンブル結果が期待通りか確認する"""
+    project_root = Path(__file__).parent.parent
+    with open(project_root / infile, 'r', encoding='utf-8') as f:
+        source = f.read()
+    request = {
+        'id': 1,
+        'source': source,
+        'arch': arch,
+        'include_paths': [str((project_root / infile).parent)],
+        'formats': [format_type],
+        'profile': True,
+    }
+    # the same source again, without profile, comes from the build cache
+    repeated = dict(request, id=2, profile=False)
+    cache_dir = project_root / '__temp__' / 'serve_cache'
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    proc = subprocess.run([sys.executable, 'hcxasm.py', '--serve', '--cache-dir', str(cache_dir)],
+                          input=json.dumps(request) + '\n' + json.dumps(repeated) + '\n',
+                          capture_output=True, text=True, check=True, cwd=project_root)
+    response, cached = [json.loads(line) for line in proc.stdout.splitlines()[:2]]
+    if not response['ok']:
+        raise AssertionError(f"[FAIL] Daemon reported an error for {infile}: {response['diagnostics']}")
+
+    with open(project_root / expected_file, 'r', encoding='utf-8') as f:
+        expected_data = f.read()
+    output_data = response['outputs'][format_type]
+    if expected_data != output_data:
+        diff = difflib.unified_diff(
+            expected_data.splitlines(keepends=True),
+            output_data.splitlines(keepends=True),
+            fromfile='expected',
+            tofile='output'
+        )
+        diff_text = ''.join(diff)
+        raise AssertionError(f"[FAIL] Daemon output does not match expected.\nDiff:\n{diff_text}")
+    stages = [stage['name'] for stage in response['profile']['stages']]
+    if stages != ['cache', 'preprocess', 'assemble', 'image', f"output {format_type}"]:
+        raise AssertionError(f"[FAIL] Unexpected profile stages {stages} for {infile}.")
+    if not cached.get('cached') or cached['outputs'] != response['outputs'] or cached['labels'] != response['labels']:
+        raise AssertionError(f"[FAIL] Repeated daemon request for {infile} was not answered from the build cache: {cached}")
+
+    print(f"[OK] Daemon output matches expected for {infile}, repeated request answered from the build cache.")
+
+
+def expect_serve_upload(infile, arch='HC4E'):
+    """エディタのアップロードと同じ要求(session, profile付き)を2回送り、2回目がビルドキャッシュから返ることを確認する"""
+    project_root = Path(__file__).parent.parent
+    source = (project_root / infile).read_text(encoding='utf-8')
+    # the request of main.js
+    request = {'source': source, 'arch': arch, 'formats': ['ihex'], 'session': 'editor', 'profile': True}
+    cache_dir = project_root / '__temp__' / 'serve_upload_cache'
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    proc = subprocess.run([sys.executable, 'hcxasm.py', '--serve', '--cache-dir', str(cache_dir)],
+                          input=(json.dumps(request) + '\n') * 2, capture_output=True, text=True, check=True, cwd=project_root)
+    first, second = [json.loads(line) for line in proc.stdout.splitlines()[:2]]
+    if first.get('cached') or not second.get('cached') or second['outputs'] != first['outputs']:
+        raise AssertionError(f"[FAIL] The repeated upload of {infile} was not answered from the build cache: {second}")
+    if [stage['name'] for stage in second['profile']['stages']] != ['cache']:
+        raise AssertionError(f"[FAIL] Unexpected profile of a build cache hit: {second['profile']}")
+    print(f"[OK] The repeated editor upload of {infile} was answered from the build cache.")
+
+
+def expect_batch(expected_files, pattern, outdir, format_type='ihex', arch='HC4'):
+    """複数ファイルの並列アセンブル結果と、変更のないファイルの再アセンブル省略を確認する"""
+    project_root = Path(__file__).parent.parent
+    out_path = project_root / outdir
+    if out_path.exists():
+        shutil.rmtree(out_path)
+    cmd = [sys.executable, 'hcxasm.py', pattern, '--output', outdir, '--format', format_type,
+           '--architecture', arch, '--jobs', '2']
+    first = subprocess.run(cmd, check=True, capture_output=True, text=True, cwd=project_root)
+    for expected_file in expected_files:
+        output_file = out_path / Path(expected_file).name
+        with open(project_root / expected_file, 'rb') as f:
+            expected_data = f.read()
+        with open(output_file, 'rb') as f:
+            output_data = f.read()
+        if expected_data != output_data:
+            raise AssertionError(f"[FAIL] Batch output {output_file} does not match {expected_file}.\n{first.stdout}")
+    built = f"{len(expected_files)} files: {len(expected_files)} assembled"
+    if built not in first.stdout:
+        raise AssertionError(f"[FAIL] Batch build did not assemble every file:\n{first.stdout}")
+    second = subprocess.run(cmd, check=True, capture_output=True, text=True, cwd=project_root)
+    skipped = f"0 assembled, {len(expected_files)} up to date"
+    if skipped not in second.stdout:
+        raise AssertionError(f"[FAIL] Unchanged files were assembled again:\n{second.stdout}")
+
+    # editing a file that is only reached through .INCLUDE must trigger a rebuild
+    src_path = out_path / 'src'
+    src_path.mkdir()
+    (src_path / 'main.asm').write_text('.INCLUDE "lib.inc"\nLD REG\n', encoding='utf-8')
+    (src_path / 'lib.inc').write_text('.DEF REG r1\n', encoding='utf-8')
+    cmd = [sys.executable, 'hcxasm.py', str(src_path / '*.asm'), '--output', str(out_path / 'inc'),
+           '--format', format_type, '--architecture', arch]
+    for content, expected in (('.DEF REG r1\n', '1 assembled'), ('.DEF REG r1\n', '0 assembled'), ('.DEF REG r2\n', '1 assembled')):
+        (src_path / 'lib.inc').write_text(content, encoding='utf-8')
+        run = subprocess.run(cmd, check=True, capture_output=True, text=True, cwd=project_root)
+        if expected not in run.stdout:
+            raise AssertionError(f"[FAIL] Expected '{expected}' after writing {content.strip()!r} to lib.inc:\n{run.stdout}")
+    print(f"[OK] Batch output matches expected for {pattern}, unchanged files skipped.")
+
+
+PROJECT_ROOT = Path(__file__).parent.parent
+
+
+@contextlib.contextmanager
+def _fake_device(arch='HC4E', **device_args):
+    """疑似デバイス(pty)を起動し、終了時に閉じる (pyserialの有無はtest.pyで確認する)"""
+    from fakedevice import FakeDevice
+    with FakeDevice(arch, **device_args) as device:
+        yield device
+
+
+def _load4e(*args, timeout=30, stdin=None):
+    """プロジェクトルートでload4e.pyを実行し、その結果(テキスト)を返す"""
+    return subprocess.run([sys.executable, 'load4e.py', *map(str, args)], capture_output=True, text=True,
+                          cwd=PROJECT_ROOT, timeout=timeout, stdin=stdin)
+
+
+def _load4e_process(*args, stderr=subprocess.PIPE):
+    """load4e.pyを標準入出力をパイプにして起動する (serve / trace用)"""
+    return subprocess.Popen([sys.executable, 'load4e.py', *map(str, args)], cwd=PROJECT_ROOT,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr, text=True)
+
+
+def _rom(hex_file):
+    """Intel HEXファイルのROMイメージ (未使用アドレスは0xFF)"""
+    import hexfile
+    return list(hexfile.read_intel_hex((PROJECT_ROOT / hex_file).read_bytes())[0])
+
+
+def expect_load(hex_file, arch='HC4E', extra_args=None, device_args=None, expect_baudrate=None, expect_success=True):
+    """疑似デバイス(pty)へのload4e.py loadの転送結果を確認する"""
+    with _fake_device(arch, **(device_args or {})) as device:
+        run = _load4e('load', '--file', hex_file, '--port', device.port, *(extra_args or []))
+        if (run.returncode == 0) != expect_success:
+            raise AssertionError(f"[FAIL] load4e.py load exited with {run.returncode}:\n{run.stdout}{run.stderr}")
+        if not expect_success:
+            print(f"[OK] load4e.py load failed as expected for {hex_file} {' '.join(extra_args or [])}.")
+            return
+        if device.rom != _rom(hex_file):
+            raise AssertionError(f"[FAIL] Device ROM {device.rom} does not match {hex_file}.")
+        if expect_baudrate is not None and (device.baudrate != expect_baudrate or f"at {expect_baudrate} baud" not in run.stdout):
+            raise AssertionError(f"[FAIL] Expected {expect_baudrate} baud, device at {device.baudrate}:\n{run.stdout}")
+        if "bytes/s" not in run.stdout:
+            raise AssertionError(f"[FAIL] load4e.py load did not report the transfer rate:\n{run.stdout}")
+    print(f"[OK] load4e.py load transferred {hex_file} {' '.join(extra_args or [])}.")
+
+
+def expect_load_differential(hex_file, arch='HC4E'):
+    """2回目以降のload4e.py loadが変更されたレコードだけを送り、デバイスの内容が違えば全体を送り直すことを確認する"""
+    import hexfile
+    temp_dir = PROJECT_ROOT / '__temp__' / 'differential'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    temp_dir.mkdir(parents=True)
+    image, regions = hexfile.read_intel_hex((PROJECT_ROOT / hex_file).read_bytes())
+    edited = bytearray(image)
+    edited[len(edited) // 2] ^= 0x0F
+    edited_file = temp_dir / 'edited.hex'
+    edited_file.write_text(hexfile.format_intel_hex(edited, regions), encoding='ascii')
+    with _fake_device(arch) as device:
+
+        def load(filename, expected):
+            run = _load4e('load', '--file', filename, '--port', device.port, '--state-dir', temp_dir / 'state')
+            if run.returncode != 0 or expected not in run.stdout:
+                raise AssertionError(f"[FAIL] Expected '{expected}' from load4e.py load {filename}:\n{run.stdout}{run.stderr}")
+            if device.rom != _rom(filename):
+                raise AssertionError(f"[FAIL] Device ROM {device.rom} does not match {filename}.")
+            return run.stdout
+
+        load(hex_file, 'full upload: no image recorded')
+        output = load(edited_file, '1 of ')
+        sent = int(output.split(' bytes sent')[0].split()[-3])
+        if sent >= len(edited_file.read_bytes()) or 'saved' not in output:
+            raise AssertionError(f"[FAIL] The differential load sent {sent} bytes:\n{output}")
+        # another tool changed the device: the checksum differs, everything is sent again
+        device.rom = device.rom[:-1] + [device.rom[-1] ^ 1]
+        load(hex_file, 'full upload: checksum mismatch')
+        load(hex_file, '0 of ')
+    if [c[0] for c in device.commands if c[0] in 'lpc'] != ['l', 'c', 'p', 'c', 'l', 'c', 'p']:
+        raise AssertionError(f"[FAIL] Unexpected device commands {device.commands}.")
+    print(f"[OK] load4e.py load sent only the changed records of {hex_file} ({sent} bytes).")
+
+
+def expect_verify(hex_file, arch='HC4', flaky=(0x23, 0x150)):
+    """load4e.py verifyがCRCの二分探索で異なるレコードを見つけ、それだけを送り直すことを確認する"""
+    import hexfile
+    image = _rom(hex_file)
+    records = (len(image) + hexfile.RECORD_LENGTH - 1) // hexfile.RECORD_LENGTH
+    # a range is halved per round trip down to one record, then the whole image is checked again
+    max_trips = (records - 1).bit_length() + 2
+    state_dir = PROJECT_ROOT / '__temp__' / 'verify_state'
+    shutil.rmtree(state_dir, ignore_errors=True)
+    with _fake_device(arch, flaky=flaky) as device:
+
+        def run(command, *extra):
+            return _load4e(command, '--file', hex_file, '--port', device.port, '--state-dir', state_dir, *extra)
+
+        def verify(expected_differing):
+            run_verify = run('verify', '--json')
+            result = json.loads(run_verify.stdout.splitlines()[-1])
+            differing = [tuple(region) for region in result['differing']]
+            if run_verify.returncode != 0 or not result['ok'] or differing != expected_differing or result['round_trips'] > max_trips:
+                raise AssertionError(f"[FAIL] load4e.py verify: {result}, expected {expected_differing} in {max_trips} round trips")
+            return result
+
+        expected = [(address & ~15, (address & ~15) + 16) for address in sorted(flaky)]
+        loaded = run('load', '--verify')
+        ranges = ", ".join(f"{start:04X}-{end - 1:04X}" for start, end in expected)
+        if loaded.returncode != 0 or f"[OK] {ranges} differed" not in loaded.stdout:
+            raise AssertionError(f"[FAIL] load4e.py load --verify did not repair {ranges}:\n{loaded.stdout}{loaded.stderr}")
+        verify([])
+        device.rom = device.rom[:0x1F0] + [device.rom[0x1F0] ^ 0x80] + device.rom[0x1F1:]
+        result = verify([(0x1F0, 0x200)])
+        if result['resent'] > 64 or device.rom != image:
+            raise AssertionError(f"[FAIL] load4e.py verify sent {result['resent']} bytes, device ROM {device.rom}")
+    print(f"[OK] load4e.py verify found the differing records of {hex_file} in {result['round_trips']} round trips and sent them again.")
+
+
+def expect_load_many(hex_file, arch='HC4'):
+    """load4e.py loadが複数のポートへ同時に書き込み、遅い・失敗するボードが他を止めないことを確認する"""
+    state_dir = PROJECT_ROOT / '__temp__' / 'load_many_state'
+    shutil.rmtree(state_dir, ignore_errors=True)
+    missing = str(PROJECT_ROOT / '__temp__' / 'no_such_port')
+    with _fake_device(arch) as fast, _fake_device(arch, ack=True) as acked, _fake_device(arch, record_delay=0.02) as slow:
+        # --port may come before the command
+        run = _load4e('--port', fast.port, '--port', slow.port, 'load', '--file', hex_file, '--port', acked.port,
+                      '--port', missing, '--state-dir', state_dir, timeout=60)
+        summary = json.loads(run.stdout.splitlines()[-1])
+        results = {result['port']: result for result in summary['ports']}
+        roms = [device.rom == _rom(hex_file) for device in (fast, acked, slow)]
+    if run.returncode != 1 or [summary['passed'], summary['failed']] != [3, 1] or not all(roms) or results[missing]['ok']:
+        raise AssertionError(f"[FAIL] load4e.py load on several ports: {summary}, ROMs {roms}\n{run.stderr}")
+    # the slow board does not hold up the others
+    if max(results[fast.port]['total_s'], results[acked.port]['total_s']) * 2 > results[slow.port]['total_s']:
+        raise AssertionError(f"[FAIL] The fast boards waited for the slow one: {summary}")
+    if f"[{slow.port}] 100%" not in run.stderr:
+        raise AssertionError(f"[FAIL] No progress for {slow.port}:\n{run.stderr}")
+    print(f"[OK] load4e.py load wrote {hex_file} to 3 ports at once, the slow one in {results[slow.port]['total_s']:.2f} s, and reported the missing one.")
+
+
+def expect_device_serve(hex_file, arch='HC4E'):
+    """load4e.py serveが1つのポートでload / register / traceを順に処理することを確認する"""
+    with _fake_device(arch) as device:
+        proc = _load4e_process('serve', '--port', device.port, stderr=subprocess.DEVNULL)
+        frames = []
+
+        def request(message, ok=True):
+            proc.stdin.write(json.dumps(message) + '\n')
+            proc.stdin.flush()
+            while True:
+                line = proc.stdout.readline()
+                if not line:
+                    raise AssertionError(f"[FAIL] load4e.py serve exited while waiting for {message}")
+                response = json.loads(line)
+                if response.get('id') == message['id']:
+                    if response['ok'] != ok:
+                        raise AssertionError(f"[FAIL] load4e.py serve answered {message} with {response}")
+                    return response
+                frames.append(response['frame'])
+
+        try:
+            # malformed requests get an error reply and the daemon stays up
+            request({'id': 0, 'op': 'load', 'hex': 1}, ok=False)
+            request({'id': 0, 'op': 'load', 'chunk': 'x'}, ok=False)
+            request({'id': 1, 'op': 'load', 'file': hex_file})
+            first = request({'id': 2, 'op': 'register'})['registers']
+            request({'id': 3, 'op': 'trace', 'action': 'start'})
+            while len(frames) < 3:
+                frames.append(json.loads(proc.stdout.readline())['frame'])
+            request({'id': 4, 'op': 'register'})
+            count = len(frames)
+            while len(frames) < count + 3:
+                frames.append(json.loads(proc.stdout.readline())['frame'])
+            request({'id': 5, 'op': 'trace', 'action': 'stop'})
+            request({'id': 6, 'op': 'shutdown'})
+            proc.wait(timeout=10)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdin.close()
+            proc.stdout.close()
+        # the same read without the daemon, --port before the command
+        run = _load4e('--port', device.port, 'register', '--json')
+        if run.returncode != 0 or set(json.loads(run.stdout)) != {'regs', 'pc', 'inst'}:
+            raise AssertionError(f"[FAIL] load4e.py --port {device.port} register:\n{run.stdout}{run.stderr}")
+    if device.rom != _rom(hex_file):
+        raise AssertionError(f"[FAIL] Device ROM {device.rom} does not match {hex_file}.")
+    if set(first) != {'regs', 'pc', 'inst'} or len(first['regs']) != 16:
+        raise AssertionError(f"[FAIL] Unexpected register dump {first}.")
+    # the trace is stopped for the register read and started again
+    if [c for c in device.commands if c in ('l', 'rc', 't', 'q')] != ['l', 'rc', 't', 'q', 'rc', 't', 'q', 'rc']:
+        raise AssertionError(f"[FAIL] Unexpected device commands {device.commands}.")
+    print(f"[OK] load4e.py serve loaded {hex_file}, read registers and traced {len(frames)} frames on one port.")
+
+
+def expect_capture(hex_file, arch='HC4E', frames=500):
+    """load4e.py captureで記録したトレースが、シミュレータで1命令ずつ実行した状態と一致するか確認する"""
+    import hcxsim
+    import hcxtrace
+    output = PROJECT_ROOT / '__temp__' / 'capture_test.hxt'
+    with _fake_device(arch, trace_interval=0.001, trace_burst=32) as device:
+        if _load4e('load', '--file', hex_file, '--port', device.port).returncode != 0:
+            raise AssertionError(f"[FAIL] load4e.py load {hex_file} failed before the capture.")
+        run = _load4e('capture', '--port', device.port, '--frames', frames, '--output', output, '--summary', '0.1')
+        if run.returncode != 0 or f"{frames} frames in" not in run.stdout or ", 0 dropped" not in run.stdout:
+            raise AssertionError(f"[FAIL] load4e.py capture did not record {frames} frames:\n{run.stdout}{run.stderr}")
+    machine = hcxsim.Machine(_rom(hex_file), arch)
+    for n, frame in enumerate(hcxtrace.read_trace(str(output))):
+        machine.run(1)
+        if frame != machine.registers():
+            raise AssertionError(f"[FAIL] Frame {n} {frame} differs from the simulator {machine.registers()}.")
+    if n + 1 != frames:
+        raise AssertionError(f"[FAIL] {output} holds {n + 1} frames, expected {frames}.")
+    print(f"[OK] load4e.py capture recorded {frames} frames of {hex_file} matching the simulator.")
+
+
+def expect_trace(hex_file, arch='HC4E', frames=5):
+    """load4e.py trace -jのフレームがシミュレータと一致し、qですぐに終了することを確認する"""
+    import hcxsim
+    machine = hcxsim.Machine(_rom(hex_file), arch)
+    with _fake_device(arch, trace_interval=0.02) as device:
+        if _load4e('load', '--file', hex_file, '--port', device.port).returncode != 0:
+            raise AssertionError(f"[FAIL] load4e.py load {hex_file} failed before the trace.")
+        proc = _load4e_process('trace', '-j', '--port', device.port)
+        try:
+            for n in range(frames):
+                frame = json.loads(proc.stdout.readline())
+                machine.run(1)
+                if frame != machine.registers():
+                    raise AssertionError(f"[FAIL] Trace frame {n} {frame} differs from the simulator {machine.registers()}.")
+            proc.stdin.write('q\n')
+            proc.stdin.flush()
+            _, stderr = proc.communicate(timeout=2)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.communicate()
+    if proc.returncode != 0 or 'keypress -> device' not in stderr or device.commands[-1] != 'q':
+        raise AssertionError(f"[FAIL] load4e.py trace did not stop cleanly ({proc.returncode}):\n{stderr}")
+    # commands from a file (trace < cmds.txt), which the event loop can not watch
+    commands = PROJECT_ROOT / '__temp__' / 'trace_commands.txt'
+    commands.parent.mkdir(exist_ok=True)
+    commands.write_text('q\n')
+    with _fake_device(arch, trace_interval=0.02) as device, open(commands) as f:
+        run = _load4e('trace', '-j', '--port', device.port, stdin=f)
+    if run.returncode != 0 or device.commands[-1] != 'q':
+        raise AssertionError(f"[FAIL] load4e.py trace < {commands.name} exited with {run.returncode}:\n{run.stderr}")
+    print(f"[OK] load4e.py trace printed {frames} frames of {hex_file} matching the simulator and stopped on q.")
+
+
 def self_test():
     expect(2, lambda x,y: x + y, 1, 1)
     expect(3, lambda x, y, z: (x + z) * y, 1, z=2, y=1)